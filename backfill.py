@@ -0,0 +1,127 @@
+"""
+Building the change log of existing history (see `git smart backfill`).
+
+Every commit is compared with its first parent exactly like pre-commit compares the index with HEAD. Commits don't depend
+on each other, so they are spread across worker processes, and the results are assembled in commit order.
+"""
+import time
+from typing import List, Dict, Any, Tuple, Optional, Iterable, NamedTuple
+
+import git
+from git.objects.util import altz_to_utctz_str
+
+from change_log import NotesChangeLog
+from repo_state import TreeBackedRepoState
+from smart_repo import SmartRepo, stats
+from utils.repo import detect_changes, encode_changes_json_line, next_index, CHANGES_FILE_NAME, EntryHeader
+from utils.workers import map_in_workers
+
+# The hash of the empty tree, which root commits are compared with.
+EMPTY_TREE_SHA = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+ChangesJson = List[Dict[str, Any]]
+
+
+class BackfillResult(NamedTuple):
+    commits: List[git.Commit]
+    # The detected changes of each commit, serialized with `Change.to_json`.
+    changes: List[ChangesJson]
+    # The header of each commit's change log line.
+    headers: List[EntryHeader]
+    parses: int
+    seconds: float
+
+    @property
+    def commits_per_second(self) -> float:
+        return len(self.commits) / self.seconds if self.seconds else 0.
+
+    @property
+    def parses_per_second(self) -> float:
+        return self.parses / self.seconds if self.seconds else 0.
+
+
+def _detect(repo: SmartRepo, trees: Tuple[str, str]) -> Tuple[ChangesJson, EntryHeader, int]:
+    """
+    Detect the changes between two trees, returning them as JSON along with their header and the number of parses it
+    took.
+    """
+    from_tree, to_tree = (git.Tree.new_from_sha(repo, bytes.fromhex(hexsha)) for hexsha in trees)
+    from_tree.path = to_tree.path = ''
+    parses = stats['parses']
+    changes = detect_changes(repo, from_tree, to_tree)
+    # Blobs are rarely shared between unrelated commits, don't let the content store grow with the history.
+    repo.end_session()
+    return [change.to_json() for change in changes], EntryHeader.of(changes), stats['parses'] - parses
+
+
+def backfill(repo: SmartRepo, revision_range: str, jobs: int = 1) -> BackfillResult:
+    """
+    Detect the changes made by every commit in the given range, following first parents only.
+
+    :param repo: The repository to backfill.
+    :param revision_range: The commits to process, e.g. 'v1.0..master'.
+    :param jobs: The number of worker processes. With a single job, everything runs in this process.
+    :return: The processed commits (oldest first) with their changes, and how long it took.
+    """
+    commits = list(repo.iter_commits(revision_range, first_parent=True, reverse=True))
+    trees = [(commit.parents[0].tree.hexsha if commit.parents else EMPTY_TREE_SHA, commit.tree.hexsha)
+             for commit in commits]
+    start = time.perf_counter()
+    results = map_in_workers(repo, _detect, trees, jobs)
+    seconds = time.perf_counter() - start
+    return BackfillResult(commits, [changes for changes, _, _ in results], [header for _, header, _ in results],
+                          sum(parses for _, _, parses in results), seconds)
+
+
+def _base_log(repo: SmartRepo, commit: git.Commit) -> List[bytes]:
+    """ The lines of the change log that the given commit's changes are appended to. """
+    if not commit.parents:
+        return []
+    return repo.contents(CHANGES_FILE_NAME, commit.parents[0].hexsha) or []
+
+
+def _entries(repo: SmartRepo, result: BackfillResult) -> Iterable[Tuple[git.Commit, Optional[bytes]]]:
+    """ Yield every commit with its line in the change log, or None if no changes were detected in it. """
+    index = next_index(_base_log(repo, result.commits[0])) if result.commits else 0
+    for commit, changes, header in zip(result.commits, result.changes, result.headers):
+        if changes:
+            yield commit, encode_changes_json_line(index, changes, header) + b'\n'
+            index += 1
+        else:
+            yield commit, None
+
+
+def write_branch(repo: SmartRepo, result: BackfillResult, branch: str) -> git.Head:
+    """
+    Rewrite the processed commits onto a new branch, adding the change log up to each commit as its .changes file.
+
+    Authors, committers, dates and messages are preserved. Merge commits keep their other parents as they are.
+    """
+    if not result.commits:
+        raise ValueError('No commits to rewrite')
+    log = _base_log(repo, result.commits[0])
+    parent = result.commits[0].parents[0] if result.commits[0].parents else None
+    for commit, entry in _entries(repo, result):
+        if entry is not None:
+            log.append(entry)
+        state = TreeBackedRepoState(repo, commit.tree)
+        state[CHANGES_FILE_NAME] = log
+        parents = ([parent] if parent is not None else []) + list(commit.parents[1:])
+        parent = git.Commit.create_from_tree(
+            repo, state.tree, commit.message, parent_commits=parents, author=commit.author, committer=commit.committer,
+            author_date=f'{commit.authored_date} {altz_to_utctz_str(commit.author_tz_offset)}',
+            commit_date=f'{commit.committed_date} {altz_to_utctz_str(commit.committer_tz_offset)}')
+    return repo.create_head(branch, parent)
+
+
+def write_notes(repo: SmartRepo, result: BackfillResult) -> int:
+    """
+    Attach the change log line of each processed commit to it as a note, under NOTES_REF (see `change_log`).
+
+    All notes are added with a single commit to the notes ref, existing notes of other commits are kept.
+    :return: The number of notes written.
+    """
+    entries = {commit.hexsha: entry for commit, entry in _entries(repo, result) if entry is not None}
+    if entries:
+        NotesChangeLog(repo).attach_all(entries, 'Notes added by git smart backfill')
+    return len(entries)
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark of line diffs: rendering `difflib.unified_diff` and parsing it back with unidiff (the way
+`TextualChange.detect` used to do it) against the hunks of `utils.diff`.
+
+Usage: python -m benchmarks.diff [--lines N] [--edits N] [--seed N]
+
+Both approaches diff a large synthetic C file with a version of it with scattered edits, and both edit scripts must turn
+the first version into the second one.
+"""
+import difflib
+import random
+import time
+from typing import List
+
+import click
+import unidiff
+
+from benchmarks.synthetic import _SourceFile
+from utils.diff import diff
+
+# The number of lines a synthetic function with the default number of variables renders to.
+_FUNCTION_LINES = 14
+
+
+def _edit(lines: List[bytes], edits: int, rng: random.Random) -> List[bytes]:
+    """ Delete, insert or replace lines at random places. """
+    lines = list(lines)
+    for i in range(edits):
+        position = rng.randrange(len(lines))
+        kind = rng.choice(['delete', 'insert', 'replace'])
+        if kind == 'delete':
+            del lines[position]
+        elif kind == 'insert':
+            lines.insert(position, b'    /* inserted %d */\n' % i)
+        else:
+            lines[position] = b'    /* replaced %d */\n' % i
+    return lines
+
+
+@click.command()
+@click.option('--lines', default=50000, help='Approximate number of lines of the generated file.')
+@click.option('--edits', default=500, help='Number of edited lines.')
+@click.option('--seed', default=0, help='Seed of the edits.')
+def main(lines: int, edits: int, seed: int):
+    source = _SourceFile(0, lines // _FUNCTION_LINES, 10).render().encode('utf-8')
+    before = source.splitlines(keepends=True)
+    after = _edit(before, edits, random.Random(seed))
+    click.echo(f'{len(before)} lines, {edits} edits', err=True)
+
+    start = time.perf_counter()
+    text_before, text_after = [line.decode('utf-8') for line in before], [line.decode('utf-8') for line in after]
+    patch = unidiff.PatchSet.from_string(''.join(difflib.unified_diff(text_before, text_after, 'a', 'a')))
+    patched = list(text_before)
+    for hunk in reversed(patch[0]):
+        patched[hunk.source_start - 1:hunk.source_start - 1 + hunk.source_length] = \
+            [line.value for line in hunk if not line.is_removed]
+    with_difflib = time.perf_counter() - start
+    assert patched == text_after
+
+    start = time.perf_counter()
+    hunks = diff(before, after)
+    with_hunks = time.perf_counter() - start
+    patched = list(before)
+    for hunk in reversed(hunks):
+        patched[hunk.a_start:hunk.a_end] = after[hunk.b_start:hunk.b_end]
+    assert patched == after
+
+    click.echo(f'difflib + unidiff: {with_difflib:.3f}s ({len(patch[0])} hunks)')
+    click.echo(f'utils.diff:        {with_hunks:.3f}s ({len(hunks)} hunks), {with_difflib / with_hunks:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
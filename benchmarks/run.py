@@ -0,0 +1,166 @@
+"""
+End-to-end benchmarks of `git smart pre-commit` and `git smart merge` over synthetic repositories.
+
+Usage: python -m benchmarks.run <libclang-path> [--scenario <name>]... [--output results.json]
+                                [--reference results.json] [--update-baseline]
+
+Every smart git command runs in its own process, exactly as the git hook would run it. For each phase we record the
+total and maximal wall time, the peak RSS and the number of clang parses.
+
+The number of parses doesn't depend on the machine, so it is compared with the stored baseline, and any difference
+fails (a lower count too, for the baseline to be updated with it). Times and memory only compare with results of the
+same machine, so they are only compared with a reference run given by --reference (e.g. the --output of a run of the
+commit before a change).
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Any
+
+import click
+import git
+
+from benchmarks.synthetic import SCENARIOS, Scenario, Commit, generate, INITIAL_BRANCH
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SMART_GIT = os.path.join(ROOT, 'smart_git.py')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Metrics that are the same on every machine, which the baseline holds and are compared with it exactly.
+BASELINE_METRICS = ('runs', 'parses')
+
+# Metrics compared with a reference run on the same machine, and by how much (relatively) each of them may grow before
+# failing.
+TOLERANCES = {'wall_time': 0.25, 'peak_rss_kb': 0.25}
+
+
+def _run_smart_git(*args: str) -> Dict[str, Any]:
+    """ Run a smart git command in a new process and measure it. """
+    with tempfile.TemporaryDirectory(prefix='smart-git-bench-') as stats_dir:
+        stats_path = os.path.join(stats_dir, 'stats.json')
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, SMART_GIT, *args], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE, env=dict(os.environ, SMART_GIT_STATS=stats_path))
+        stderr = process.stderr.read()
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode:
+            raise click.ClickException(f'`smart_git.py {" ".join(args)}` failed:\n{stderr.decode()}')
+        with open(stats_path) as stats_file:
+            stats = json.load(stats_file)
+    return {'wall_time': wall_time, 'peak_rss_kb': rusage.ru_maxrss, 'parses': stats.get('parses', 0)}
+
+
+def _accumulate(phase: Dict[str, Any], measurement: Dict[str, Any]) -> None:
+    phase['runs'] = phase.get('runs', 0) + 1
+    phase['wall_time'] = phase.get('wall_time', 0) + measurement['wall_time']
+    phase['max_wall_time'] = max(phase.get('max_wall_time', 0), measurement['wall_time'])
+    phase['peak_rss_kb'] = max(phase.get('peak_rss_kb', 0), measurement['peak_rss_kb'])
+    phase['parses'] = phase.get('parses', 0) + measurement['parses']
+
+
+def run_scenario(scenario: Scenario, libclang_path: str) -> Dict[str, Dict[str, Any]]:
+    results = {'pre_commit': {}, 'merge': {}}
+    with tempfile.TemporaryDirectory(prefix=f'smart-git-bench-{scenario.name}-') as repo_path:
+        repo = git.Repo.init(repo_path)
+        repo.git.symbolic_ref('HEAD', f'refs/heads/{INITIAL_BRANCH}')
+        try:
+            subprocess.run([sys.executable, SMART_GIT, 'install', repo_path, libclang_path, '--silent'], check=True)
+            for step in generate(scenario):
+                if isinstance(step, Commit):
+                    if step.branch not in repo.heads and repo.head.is_valid():
+                        repo.git.branch(step.branch, INITIAL_BRANCH)
+                    if repo.head.is_valid() and repo.active_branch.name != step.branch:
+                        repo.git.checkout(step.branch)
+                    for name, content in step.files.items():
+                        with open(os.path.join(repo_path, name), 'w') as file:
+                            file.write(content)
+                    repo.git.add(*step.files)
+                    _accumulate(results['pre_commit'], _run_smart_git('pre-commit', repo_path))
+                    repo.git.commit('--no-verify', '-m', step.message)
+                else:
+                    repo.git.checkout(step.into)
+                    _accumulate(results['merge'], _run_smart_git('merge', repo_path, step.branch))
+        finally:
+            repo.git.clear_cache()
+            repo.close()
+    return results
+
+
+def compare(results: Dict[str, Any], reference: Dict[str, Any], tolerances: Dict[str, float]) -> List[str]:
+    """ Return a description of every metric in results that regressed compared to the reference results. """
+    regressions = []
+    for scenario, phases in results.items():
+        for phase, metrics in phases.items():
+            for metric, tolerance in tolerances.items():
+                base = reference.get(scenario, {}).get(phase, {}).get(metric)
+                if base is not None and metrics[metric] > base * (1 + tolerance):
+                    regressions.append(f'{scenario}/{phase}/{metric}: {metrics[metric]:.6g} (reference {base:.6g}, '
+                                       f'tolerance {tolerance:.0%})')
+    return regressions
+
+
+def compare_baseline(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """ Return a description of every metric in results that differs from the baseline. """
+    differences = []
+    for scenario, phases in results.items():
+        for phase, metrics in phases.items():
+            for metric in BASELINE_METRICS:
+                base = baseline.get(scenario, {}).get(phase, {}).get(metric)
+                if base is not None and metrics[metric] != base:
+                    differences.append(f'{scenario}/{phase}/{metric}: {metrics[metric]} (baseline {base})')
+    return differences
+
+
+@click.command()
+@click.argument('libclang_path', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(sorted(SCENARIOS)),
+              help='Scenarios to run (default: all).')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Write the results to this JSON file.')
+@click.option('--reference', type=click.Path(exists=True, dir_okay=False),
+              help='Compare times and memory with the results of an earlier run on this machine (see --output).')
+@click.option('--update-baseline', is_flag=True, default=False, help='Store the results as the new baseline.')
+def main(libclang_path: str, scenarios: List[str], output: str, reference: str, update_baseline: bool):
+    results = {}
+    for name in scenarios or sorted(SCENARIOS):
+        click.echo(f'Running scenario {name}...', err=True)
+        results[name] = run_scenario(SCENARIOS[name], os.path.abspath(libclang_path))
+    click.echo(json.dumps(results, indent=2))
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    baseline = {}
+    if os.path.isfile(BASELINE_PATH):
+        with open(BASELINE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)
+    if update_baseline:
+        baseline.update({scenario: {phase: {metric: metrics[metric] for metric in BASELINE_METRICS}
+                                    for phase, metrics in phases.items()}
+                         for scenario, phases in results.items()})
+        with open(BASELINE_PATH, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        return
+    failed = False
+    differences = compare_baseline(results, baseline)
+    if differences:
+        click.secho('Differences from the baseline (run with --update-baseline if they are expected):\n'
+                    + '\n'.join(differences), fg='red', err=True)
+        failed = True
+    if reference:
+        with open(reference) as reference_file:
+            regressions = compare(results, json.load(reference_file), TOLERANCES)
+        if regressions:
+            click.secho('Performance regressions:\n' + '\n'.join(regressions), fg='red', err=True)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
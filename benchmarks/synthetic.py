@@ -0,0 +1,116 @@
+"""
+Deterministic generator of synthetic C repository histories, used to benchmark smart git.
+
+A history starts with a commit adding `files` C files, followed by `commits` commits on each of two divergent branches
+('master' and 'feature'), and ends by merging 'feature' into 'master'. Every commit applies one randomly chosen
+mutation, weighted by the scenario:
+ - rename: rename a local variable (and its usages) in one function.
+ - insertion: insert a new statement into one function.
+ - edit: change the header comment of a file (a purely textual change).
+
+The two branches mutate disjoint halves of the files, so that the merge never runs into conflicts.
+"""
+import copy
+import random
+from typing import NamedTuple, List, Dict, Iterable, Union
+
+INITIAL_BRANCH = 'master'
+FEATURE_BRANCH = 'feature'
+
+
+class Scenario(NamedTuple):
+    name: str
+    files: int = 20
+    functions: int = 4
+    variables: int = 3
+    commits: int = 10
+    renames: int = 1
+    insertions: int = 1
+    edits: int = 1
+    seed: int = 0
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (
+    Scenario('small'),
+    Scenario('wide', files=200, commits=10),
+    Scenario('long', files=20, commits=60),
+)}
+
+
+class Commit(NamedTuple):
+    branch: str
+    message: str
+    files: Dict[str, str]
+
+
+class Merge(NamedTuple):
+    branch: str
+    into: str
+
+
+Step = Union[Commit, Merge]
+
+
+class _Function:
+
+    def __init__(self, name: str, variables: int):
+        self.name = name
+        self.variables = [f'v{i}' for i in range(variables)]
+        # Inserted statements, as (variable index, increment) pairs.
+        self.statements = []
+
+    def render(self) -> List[str]:
+        lines = [f'int {self.name}(int x) {{']
+        previous = 'x'
+        for variable in self.variables:
+            lines.append(f'    int {variable} = {previous} + 1;')
+            previous = variable
+        for variable_index, increment in self.statements:
+            lines.append(f'    {self.variables[variable_index]} += {increment};')
+        lines.append(f'    return {previous};')
+        lines.append('}')
+        return lines
+
+
+class _SourceFile:
+
+    def __init__(self, index: int, functions: int, variables: int):
+        self.name = f'file{index}.c'
+        self.revision = 0
+        self.functions = [_Function(f'file{index}_func{j}', variables) for j in range(functions)]
+
+    def render(self) -> str:
+        lines = [f'/* {self.name} revision {self.revision} */', '']
+        for function in self.functions:
+            lines.extend(function.render())
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def generate(scenario: Scenario) -> Iterable[Step]:
+    """ Generate the steps of the history described by the scenario. The same scenario always yields the same steps. """
+    rng = random.Random(scenario.seed)
+    files = [_SourceFile(i, scenario.functions, scenario.variables) for i in range(scenario.files)]
+    yield Commit(INITIAL_BRANCH, 'Initial commit', {file.name: file.render() for file in files})
+
+    branches = {INITIAL_BRANCH: files, FEATURE_BRANCH: copy.deepcopy(files)}
+    owned_files = {INITIAL_BRANCH: range(0, scenario.files // 2),
+                   FEATURE_BRANCH: range(scenario.files // 2, scenario.files)}
+    renamed = 0
+    for i in range(scenario.commits):
+        for branch in (INITIAL_BRANCH, FEATURE_BRANCH):
+            file = branches[branch][rng.choice(owned_files[branch])]
+            function = rng.choice(file.functions)
+            mutation = rng.choice(['rename'] * scenario.renames + ['insertion'] * scenario.insertions
+                                  + ['edit'] * scenario.edits)
+            if mutation == 'rename':
+                renamed += 1
+                variable_index = rng.randrange(len(function.variables))
+                function.variables[variable_index] = f'r{renamed}_{function.variables[variable_index]}'
+            elif mutation == 'insertion':
+                function.statements.insert(rng.randrange(len(function.statements) + 1),
+                                           (rng.randrange(len(function.variables)), rng.randrange(1, 100)))
+            else:
+                file.revision += 1
+            yield Commit(branch, f'{mutation} in {file.name} ({branch} #{i + 1})', {file.name: file.render()})
+    yield Merge(FEATURE_BRANCH, INITIAL_BRANCH)
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of comparing subtrees by their tokens: one libclang tokenization per cursor (the way
+`SubASTInserted.detect_ast_insertions` used to do it) against slices of a per-translation-unit token table.
+
+Usage: python -m benchmarks.tokens <libclang-path> [--functions N] [--variables N]
+
+Both approaches compute the token keys of every function and statement of a large synthetic C file, and must agree on
+which of them are equal.
+"""
+import os
+import tempfile
+import time
+
+import click
+import clang.cindex
+
+from benchmarks.synthetic import _SourceFile
+from utils.tokens import TokenTable
+
+
+def _cursors(translation_unit: clang.cindex.TranslationUnit):
+    """ The functions of the translation unit, and the statements of their bodies. """
+    for function in translation_unit.cursor.get_children():
+        yield function
+        for body in function.get_children():
+            yield from body.get_children()
+
+
+@click.command()
+@click.argument('libclang_path', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option('--functions', default=2000, help='Functions in the generated file.')
+@click.option('--variables', default=10, help='Variables in each function.')
+def main(libclang_path: str, functions: int, variables: int):
+    clang.cindex.Config.set_library_file(os.path.abspath(libclang_path))
+    source = _SourceFile(0, functions, variables).render()
+    with tempfile.NamedTemporaryFile('w', suffix='.c') as file:
+        file.write(source)
+        file.flush()
+        translation_unit = clang.cindex.Index.create().parse(file.name)
+    cursors = list(_cursors(translation_unit))
+    click.echo(f'{len(source.splitlines())} lines, {len(cursors)} cursors', err=True)
+
+    start = time.perf_counter()
+    token_keys = [tuple((token.kind.value, token.spelling) for token in cursor.get_tokens()) for cursor in cursors]
+    per_cursor = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table = TokenTable(translation_unit)
+    tokenize = time.perf_counter() - start
+    table_keys = [table.key(cursor) for cursor in cursors]
+    with_table = time.perf_counter() - start
+
+    assert len(set(token_keys)) == len(set(table_keys))
+    assert len(set(zip(token_keys, table_keys))) == len(set(token_keys))
+    click.echo(f'per-cursor tokenization: {per_cursor:.3f}s')
+    click.echo(f'token table:             {with_table:.3f}s (of which tokenizing {tokenize:.3f}s), '
+               f'{per_cursor / with_table:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+"""
+Where the change log of a repository is stored.
+
+Configured with smart.changeLog in git config:
+ - 'file' (the default): the change log is the tracked .changes file, and every commit's tree holds the whole log up to
+   that commit. Every commit that records changes rewrites the file.
+ - 'notes': every commit's change set is a git note on the commit itself, under NOTES_REF. The change log of a commit
+   is made of the notes of its first-parent ancestors, oldest first, so nothing but the note is written per commit.
+   Since the note can only be attached once the commit exists, pre-commit leaves it in the git directory and the
+   post-commit hook attaches it.
+Both backends store the same lines (see `utils.repo.encode_changes_line`), and `git smart migrate-log` converts a
+repository from one to the other.
+
+Change logs only grow, so `git smart compact` folds the entries up to a commit that all branches contain into a single
+checkpoint line (see `ChangeLog.compact`), and readers start from the latest checkpoint. The folded entries stay in the
+history (in earlier commits' change log files, or in earlier commits of NOTES_REF). Once a branch's change log grows
+past smart.compactThreshold entries after its latest checkpoint, recording a change set compacts it too. With notes,
+recording only reads the latest note, and tells how much the log grew from the index it was last compacted up to, which
+is kept in smart.compactedIndex.
+"""
+import itertools
+import os
+from io import BytesIO
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, Union
+
+import git
+from git.objects.fun import tree_to_stream
+from gitdb import IStream
+
+from changes.change import Change
+from smart_repo import SmartRepo
+from utils.repo import CHANGES_FILE_NAME, encode_changes_line, encode_checkpoint_line, is_checkpoint, line_index, \
+    next_index
+
+FILE = 'file'
+NOTES = 'notes'
+DEFAULT_BACKEND = FILE
+
+NOTES_REF = 'refs/notes/smart'
+
+# The change log entry of the commit being created, left in the git directory by pre-commit for post-commit.
+PENDING_FILE_NAME = 'smart-pending-changes'
+
+# The number of change log entries after the latest checkpoint beyond which recording a change set compacts the log.
+DEFAULT_COMPACT_THRESHOLD = 10000
+
+
+class MissingChangeLog(Exception):
+    """ A revision to merge has no change log. """
+
+    def __init__(self, revision: str):
+        super(MissingChangeLog, self).__init__(revision)
+        self.revision = revision
+
+
+class ChangeLog:
+    """ A way of storing the change log, which is a line per change set (see `utils.repo.encode_changes_line`). """
+
+    name: str = None
+
+    def __init__(self, repo: SmartRepo):
+        self.repo = repo
+
+    def lines(self, revision: str = 'HEAD') -> Iterator[bytes]:
+        """ The lines of the change log of the given revision, oldest first. """
+        raise NotImplementedError
+
+    def merge_logs(self, into: git.Commit, revisions: List[Tuple[str, git.Commit]]) \
+            -> Tuple[int, Iterable[bytes], List[Iterable[bytes]]]:
+        """
+        The change logs to merge some revisions into another one with (see `smart_merge.MergeSession`).
+
+        Backends may leave out a prefix that all the logs share, since merging skips it anyway.
+        :param into: The commit to merge into.
+        :param revisions: The revisions to merge, by name.
+        :return: The number of change log entries left out, and the remaining lines of the logs of the commit to merge
+                 into and of every revision.
+        :raises MissingChangeLog: If a revision to merge has no change log.
+        """
+        raise NotImplementedError
+
+    def entries(self, commit: git.Commit) -> List[bytes]:
+        """ The lines that a commit added to the change log of its first parent. """
+        raise NotImplementedError
+
+    def record(self, changes: List[Change]) -> None:
+        """ Record the change set of the commit being created (by pre-commit), if there are any changes. """
+        raise NotImplementedError
+
+    def committed(self, commit: git.Commit) -> None:
+        """ Called (by post-commit) once a commit was created. """
+
+    def compact(self, onto: git.Commit) -> int:
+        """
+        Fold the change log entries up to a commit into a checkpoint, for readers to skip them.
+
+        Branches that don't contain the commit can't be merged with the compacted log anymore, see `checkpoint`.
+        :param onto: A commit on HEAD's first-parent chain.
+        :return: The number of entries folded, 0 if they already were.
+        :raises ValueError: If the commit's change log isn't part of HEAD's.
+        """
+        raise NotImplementedError
+
+    def compact_threshold(self) -> int:
+        """ The number of entries after the latest checkpoint beyond which recording compacts the log, 0 for never. """
+        return int(self.repo.config_reader().get_value('smart', 'compactThreshold', DEFAULT_COMPACT_THRESHOLD))
+
+    def first_parents(self, revision: str) -> List[str]:
+        """ The hexshas of the revision and its first-parent ancestors, newest first. """
+        try:
+            return self.repo.git.rev_list('--first-parent', revision, '--').split()
+        except git.GitCommandError:
+            return []
+
+    def checkpoint(self) -> Optional[git.Commit]:
+        """
+        The newest commit on HEAD's first-parent chain that all branches (local and remote-tracking) contain, which is
+        the newest one the change log can be compacted onto, or None if the branches share no history.
+        """
+        heads = set(self.repo.git.for_each_ref('--format=%(objectname)', 'refs/heads', 'refs/remotes').split())
+        heads.add(self.repo.head.commit.hexsha)
+        try:
+            base = self.repo.git.merge_base('--octopus', *sorted(heads)) if len(heads) > 1 else heads.pop()
+        except git.GitCommandError:
+            return None
+        first_parents = self.first_parents('HEAD')
+        if base not in first_parents:
+            # The merge base is only reachable through merged branches, whose entries HEAD's log holds rebased.
+            ancestors = set(self.repo.git.rev_list(base, '--').split())
+            base = next((commit for commit in first_parents if commit in ancestors), None)
+        return None if base is None else self.repo.commit(base)
+
+    def stage_merge(self, session) -> None:
+        """
+        Record the change log of a merge (or of a commit being rebased) in its state, before it is committed.
+
+        :param session: The `smart_merge.MergeSession` of the merge.
+        """
+
+    def commit_merge(self, commit: git.Commit, session) -> None:
+        """ Record the change log of a merge once its commit was created. """
+
+    def commit_rebase(self, entries: Dict[str, bytes]) -> None:
+        """ Record the change log entries of rebased commits (by hexsha) once they were all created. """
+
+
+class FileChangeLog(ChangeLog):
+    """ The change log as a tracked file (CHANGES_FILE_NAME) in every commit. """
+
+    name = FILE
+
+    def _blob(self, revision: str) -> Optional[git.Blob]:
+        try:
+            tree = self.repo.rev_parse(revision).tree
+        except (git.BadName, ValueError):
+            return None
+        return tree[CHANGES_FILE_NAME] if CHANGES_FILE_NAME in tree else None
+
+    def lines(self, revision: str = 'HEAD') -> Iterator[bytes]:
+        blob = self._blob(revision)
+        return iter(()) if blob is None else self.repo.content_store.iter_lines(blob)
+
+    def merge_logs(self, into: git.Commit, revisions: List[Tuple[str, git.Commit]]) \
+            -> Tuple[int, Iterable[bytes], List[Iterable[bytes]]]:
+        logs = []
+        for name, revision in revisions:
+            if CHANGES_FILE_NAME not in revision.tree:
+                raise MissingChangeLog(name)
+            logs.append(self.repo.content_store.iter_lines(revision.tree[CHANGES_FILE_NAME]))
+        return 0, self.lines(into.hexsha), logs
+
+    def entries(self, commit: git.Commit) -> List[bytes]:
+        # The commit may also have compacted the log, so its entries are told apart by their indices.
+        start = next_index(list(self.lines(commit.parents[0].hexsha))) if commit.parents else 0
+        return [line for line in self.lines(commit.hexsha) if line_index(line) >= start and not is_checkpoint(line)]
+
+    def _compacted(self, lines: List[bytes], onto: git.Commit) -> Tuple[List[bytes], int]:
+        """ The given change log lines with the entries up to a commit folded, and the number of entries folded. """
+        onto_lines = list(self.lines(onto.hexsha))
+        if not onto_lines:
+            return lines, 0
+        last = line_index(onto_lines[-1])
+        folded = list(itertools.takewhile(lambda line: line_index(line) <= last, lines))
+        if folded and is_checkpoint(folded[-1]):
+            return lines, 0
+        if not folded or folded[-1].rstrip(b'\n') != onto_lines[-1].rstrip(b'\n'):
+            raise ValueError(f"The change log of {onto.hexsha} is not part of HEAD's")
+        count = sum(1 for line in folded if not is_checkpoint(line))
+        if not count:
+            return lines, 0
+        return [encode_checkpoint_line(last, onto.hexsha) + b'\n'] + lines[len(folded):], count
+
+    def _write(self, lines: List[bytes], previous_lines: List[bytes]) -> None:
+        """
+        Write and stage the change log file.
+
+        :raises OSError: If the index can't be written (in which case the previous lines are restored).
+        """
+        path = os.path.join(self.repo.working_dir, CHANGES_FILE_NAME)
+        with open(path, 'wb') as changes_file:
+            changes_file.write(b''.join(lines))
+        try:
+            self.repo.index.add([CHANGES_FILE_NAME])
+        except OSError:
+            if previous_lines:
+                with open(path, 'wb') as changes_file:
+                    changes_file.write(b''.join(previous_lines))
+            else:
+                os.remove(path)
+            raise
+
+    def record(self, changes: List[Change]) -> None:
+        """
+        Append the change set to the change log file, and stage it.
+
+        :raises OSError: If the index can't be written (in which case the file is restored).
+        """
+        if not changes:
+            return
+        # The previous entries are copied as they are, without being decoded.
+        previous_lines = list(self.lines()) if self.repo.head.is_valid() else []
+        lines = previous_lines
+        threshold = self.compact_threshold()
+        if threshold and len(previous_lines) > threshold:
+            onto = self.checkpoint()
+            if onto is not None:
+                try:
+                    lines, _ = self._compacted(previous_lines, onto)
+                except ValueError:
+                    pass
+        self._write(lines + [encode_changes_line(next_index(previous_lines), changes) + b'\n'], previous_lines)
+
+    def compact(self, onto: git.Commit) -> int:
+        """ Replace the entries in the change log file with a checkpoint, and stage it. """
+        previous_lines = list(self.lines())
+        lines, count = self._compacted(previous_lines, onto)
+        if count:
+            self._write(lines, previous_lines)
+        return count
+
+    def stage_merge(self, session) -> None:
+        session.write_log()
+
+
+class NotesChangeLog(ChangeLog):
+    """ The change log as git notes (under NOTES_REF), each holding the change log entries of the commit it is on. """
+
+    name = NOTES
+
+    def __init__(self, repo: SmartRepo):
+        super(NotesChangeLog, self).__init__(repo)
+        # The notes looked up so far (None for commits without one), the tree of NOTES_REF, and the entries of the
+        # notes trees read so far (by binsha).
+        self._notes: Dict[str, Optional[bytes]] = {}
+        self._notes_tree: Optional[git.Tree] = None
+        self._tree_entries: Dict[bytes, Dict[str, Union[git.Blob, git.Tree]]] = {}
+
+    @property
+    def pending_path(self) -> str:
+        return os.path.join(self.repo.git_dir, PENDING_FILE_NAME)
+
+    def note(self, commit: str) -> Optional[bytes]:
+        """ The binary SHA of the blob of a commit's (by hexsha) note, if it has one. """
+        if commit not in self._notes:
+            if self._notes_tree is None:
+                try:
+                    self._notes_tree = self.repo.commit(NOTES_REF).tree
+                except (git.BadName, ValueError):
+                    return None
+            # Only the trees on the path to the note are read, rather than the whole notes tree, which may fan out into
+            # subtrees named by the first hex digits of the commits.
+            tree, name, binsha = self._notes_tree, commit, None
+            while tree is not None and binsha is None:
+                if tree.binsha not in self._tree_entries:
+                    self._tree_entries[tree.binsha] = {item.name: item for item in tree}
+                entries = self._tree_entries[tree.binsha]
+                if name in entries:
+                    binsha = entries[name].binsha
+                else:
+                    subtree = entries.get(name[:2])
+                    tree, name = (subtree, name[2:]) if isinstance(subtree, git.Tree) else (None, name)
+            self._notes[commit] = binsha
+        return self._notes[commit]
+
+    def note_lines(self, commit: str) -> List[bytes]:
+        """ The change log entries of a commit (by hexsha). """
+        binsha = self.note(commit)
+        return [] if binsha is None else self.repo.content_store.lines(binsha)
+
+    def walk(self, revision: str) -> Iterator[str]:
+        """ The hexshas of the revision and its first-parent ancestors, newest first, read lazily for walks to stop. """
+        try:
+            commit = self.repo.commit(revision)
+        except (git.BadName, ValueError):
+            return
+        while True:
+            yield commit.hexsha
+            if not commit.parents:
+                return
+            commit = commit.parents[0]
+
+    def lines(self, revision: str = 'HEAD') -> Iterator[bytes]:
+        # Only the notes from the latest checkpoint on are read.
+        notes = []
+        for commit in self.walk(revision):
+            lines = self.note_lines(commit)
+            notes.append(lines)
+            if lines and is_checkpoint(lines[0]):
+                break
+        for lines in reversed(notes):
+            yield from lines
+
+    def entries(self, commit: git.Commit) -> List[bytes]:
+        return self.note_lines(commit.hexsha)
+
+    def _length(self, commits: Iterable[str]) -> int:
+        """ The number of change log entries up to the first of the given commits (newest first) that has any. """
+        for commit in commits:
+            lines = self.note_lines(commit)
+            if lines:
+                return next_index(lines)
+        return 0
+
+    def merge_logs(self, into: git.Commit, revisions: List[Tuple[str, git.Commit]]) \
+            -> Tuple[int, Iterable[bytes], List[Iterable[bytes]]]:
+        # First-parent chains that meet stay together from there on, so the notes of the commits all the chains share
+        # are never read, only those of the commits after them.
+        chains = [self.first_parents(commit.hexsha) for commit in [into] + [revision for _, revision in revisions]]
+        shared = set(chains[0]).intersection(*chains[1:])
+        divergent = [list(itertools.takewhile(lambda commit: commit not in shared, chain)) for chain in chains]
+        start = self._length(chains[0][len(divergent[0]):])
+        logs = [[line for commit in reversed(commits) for line in self.note_lines(commit)] for commits in divergent]
+        return start, logs[0], logs[1:]
+
+    def record(self, changes: List[Change]) -> None:
+        """ Leave the change set in the git directory, to be attached to the commit once it is created. """
+        if os.path.exists(self.pending_path):
+            # Left by a commit that was aborted after pre-commit.
+            os.remove(self.pending_path)
+        if not changes:
+            return
+        parent = self.repo.head.commit.hexsha if self.repo.head.is_valid() else ''
+        # The entry's index follows the latest note, the walk stops there.
+        index = self._length(self.walk(parent)) if parent else 0
+        with open(self.pending_path, 'wb') as pending_file:
+            pending_file.write(parent.encode('ascii') + b'\n')
+            pending_file.write(encode_changes_line(index, changes) + b'\n')
+        threshold = self.compact_threshold()
+        if parent and threshold and index - self._compacted_index() > threshold:
+            onto = self.checkpoint()
+            if onto is not None:
+                try:
+                    self.compact(onto)
+                except ValueError:
+                    pass
+            # Whether or not anything was folded, compaction isn't attempted again before the log grows as much.
+            self._set_compacted_index(index)
+
+    def _compacted_index(self) -> int:
+        """
+        The index that the log was last compacted up to (or that compaction was attempted at), for recording to tell
+        how much the log grew since without reading it.
+        """
+        return int(self.repo.config_reader().get_value('smart', 'compactedIndex', -1))
+
+    def _set_compacted_index(self, index: int) -> None:
+        with self.repo.config_writer() as config:
+            config.set_value('smart', 'compactedIndex', index)
+
+    def compact(self, onto: git.Commit) -> int:
+        """ Replace the commit's note with a checkpoint, which readers of all branches stop at. """
+        if onto.hexsha not in self.first_parents('HEAD'):
+            raise ValueError(f"The change log of {onto.hexsha} is not part of HEAD's")
+        lines = list(self.lines(onto.hexsha))
+        count = sum(1 for line in lines if not is_checkpoint(line))
+        if count:
+            self.attach(onto, encode_checkpoint_line(line_index(lines[-1]), onto.hexsha) + b'\n')
+            if line_index(lines[-1]) > self._compacted_index():
+                self._set_compacted_index(line_index(lines[-1]))
+        return count
+
+    def committed(self, commit: git.Commit) -> None:
+        """ Attach the change set that pre-commit left, if it was recorded on top of the commit's parent. """
+        try:
+            with open(self.pending_path, 'rb') as pending_file:
+                parent, _, entry = pending_file.read().partition(b'\n')
+        except FileNotFoundError:
+            return
+        os.remove(self.pending_path)
+        if parent.decode('ascii') == (commit.parents[0].hexsha if commit.parents else ''):
+            self.attach(commit, entry)
+
+    def commit_merge(self, commit: git.Commit, session) -> None:
+        entry = b''.join(session.new_lines())
+        if entry:
+            self.attach(commit, entry)
+
+    def commit_rebase(self, entries: Dict[str, bytes]) -> None:
+        if entries:
+            self.attach_all(entries, 'Notes added by git smart rebase')
+
+    def attach(self, commit: git.Commit, entry: bytes) -> None:
+        """ Attach a note with the given change log entries to a commit. """
+        binsha = self.repo.odb.store(IStream(git.Blob.type, len(entry), BytesIO(entry))).binsha
+        self.repo.git.notes('--ref', NOTES_REF, 'add', '--force', '-C', binsha.hex(), commit.hexsha)
+        self._notes[commit.hexsha] = binsha
+        self._notes_tree = None
+
+    def attach_all(self, entries: Dict[str, bytes], message: str) -> None:
+        """
+        Attach notes with the given change log entries to many commits (by hexsha), with a single commit to NOTES_REF.
+
+        Existing notes of other commits are kept.
+        """
+        tree_items = {}
+        parents = []
+        try:
+            notes_commit = self.repo.commit(NOTES_REF)
+        except (git.BadName, ValueError):
+            pass
+        else:
+            parents.append(notes_commit)
+            tree_items = {item.name: (item.binsha, item.mode) for item in notes_commit.tree}
+        for commit, entry in entries.items():
+            tree_items[commit] = (self.repo.odb.store(IStream(git.Blob.type, len(entry), BytesIO(entry))).binsha,
+                                  git.Blob.file_mode)
+        # git orders tree entries as if the names of subtrees (e.g. notes fanout directories) ended with a slash.
+        tree_entries = sorted(((binsha, mode, name) for name, (binsha, mode) in tree_items.items()),
+                              key=lambda entry: entry[2] + ('/' if entry[1] >> 12 == 0o4 else ''))
+        stream = BytesIO()
+        tree_to_stream(tree_entries, stream.write)
+        tree_binsha = self.repo.odb.store(IStream(git.Tree.type, len(stream.getvalue()),
+                                                  BytesIO(stream.getvalue()))).binsha
+        notes_commit = git.Commit.create_from_tree(self.repo, git.Tree(self.repo, tree_binsha), message,
+                                                   parent_commits=parents)
+        self.repo.git.update_ref(NOTES_REF, notes_commit.hexsha)
+        self._notes = {}
+        self._notes_tree = None
+
+
+def migrate(repo: SmartRepo, to_name: str) -> int:
+    """
+    Convert the repository's change log to another backend, and configure the repository to use it.
+
+    To notes, the entries that each commit (on HEAD's first-parent chain) added to the change log file become its note,
+    and the file is deleted (the deletion is staged, to be committed). To a file, HEAD's whole change log is written to
+    the file and staged - earlier commits have no change log file, so they can't be merged.
+    :return: The number of change log entries migrated.
+    """
+    source, target = change_log(repo), change_log(repo, to_name)
+    if source.name == target.name:
+        raise ValueError(f'The change log is already stored in {target.name}')
+    path = os.path.join(repo.working_dir, CHANGES_FILE_NAME)
+    migrated = 0
+    if isinstance(target, NotesChangeLog):
+        entries = {}
+        start = 0
+        for commit in reversed(target.first_parents('HEAD')):
+            # A commit's log starts with its first parent's log (possibly compacted), followed by the entries it added.
+            lines = [line for line in source.lines(commit) if line_index(line) >= start and not is_checkpoint(line)]
+            if lines:
+                entries[commit] = b''.join(lines)
+                start = next_index(lines)
+                migrated += len(lines)
+        if entries:
+            target.attach_all(entries, 'Notes added by git smart migrate-log')
+        if CHANGES_FILE_NAME in repo.head.commit.tree:
+            repo.index.remove([CHANGES_FILE_NAME], working_tree=True)
+    else:
+        lines = list(source.lines())
+        if lines:
+            with open(path, 'wb') as changes_file:
+                changes_file.write(b''.join(lines))
+            repo.index.add([CHANGES_FILE_NAME])
+        migrated = sum(1 for line in lines if not is_checkpoint(line))
+    with repo.config_writer() as config:
+        config.set_value('smart', 'changeLog', target.name)
+    return migrated
+
+
+BACKENDS = {backend.name: backend for backend in (FileChangeLog, NotesChangeLog)}
+
+
+def change_log(repo: SmartRepo, name: Optional[str] = None) -> ChangeLog:
+    """ The change log backend with the given name, by default the one configured for the repository. """
+    if name is None:
+        name = repo.config_reader().get_value('smart', 'changeLog', DEFAULT_BACKEND)
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown change log backend {name!r}, expected one of {", ".join(BACKENDS)}')
+    return BACKENDS[name](repo)
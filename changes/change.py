@@ -1,8 +1,9 @@
 import abc
-from typing import Dict, Any, Type, Iterable, TypeVar, Optional
+from typing import Dict, Any, Type, Iterable, TypeVar, Optional, Tuple
 
 import git
 
+from parse_options import ParseProfile, FULL
 from repo_state import RepoState
 from smart_repo import SmartRepo
 
@@ -16,6 +17,9 @@ class Change(metaclass=abc.ABCMeta):
     Make sure to add subclasses of this class to changes.CHANGE_CLASSES.
     """
 
+    # How much of each file detecting and applying this type of change needs clang to analyze (for types that parse).
+    parse_profile: ParseProfile = FULL
+
     @classmethod
     @abc.abstractmethod
     def name(cls) -> str:
@@ -63,6 +67,11 @@ class Change(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def touched_paths(self) -> Tuple[str, ...]:
+        """ Return the paths of the files this change modifies. """
+        raise NotImplementedError
+
     def __eq__(self, other):
         if not isinstance(other, Change):
             return False
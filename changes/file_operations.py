@@ -1,16 +1,44 @@
 import os
-from typing import Iterable, Dict, Any, Type, List
+from typing import Iterable, Dict, Any, Type, Sequence, Tuple
 
 import git
 
+import tracing
 from changes.change import Change, T, Conflict
 from repo_state import RepoState
 from smart_repo import SmartRepo
+from utils.similarity import pair_similar
+
+# The default minimal similarity of a deleted and an added file for them to be detected as a rename.
+DEFAULT_RENAME_THRESHOLD = 0.5
+
+
+def similar_renames(repo: SmartRepo, diff: git.DiffIndex) -> Dict[str, str]:
+    """
+    Find the deleted files of a diff that were (most likely) renamed to one of its added files, with their contents
+    possibly edited, beyond the renames git detected. The threshold is configured by smart.renameThreshold.
+
+    The result is kept on the diff, since FileAdded, FileDeleted and FileRenamed all detect changes from it.
+    :return: the new path of each renamed file, by its old path.
+    """
+    renames = getattr(diff, '_similar_renames', None)
+    if renames is None:
+        deleted = {file_diff.a_path: file_diff.a_blob for file_diff in diff.iter_change_type('D')}
+        added = {file_diff.b_path: file_diff.b_blob for file_diff in diff.iter_change_type('A')}
+        renames = {}
+        if deleted and added:
+            threshold = float(repo.config_reader().get_value('smart', 'renameThreshold', DEFAULT_RENAME_THRESHOLD))
+            with tracing.span('similar renames', deleted=len(deleted), added=len(added)):
+                pairs = pair_similar({path: repo.content_store.lines(blob) for path, blob in deleted.items()},
+                                     {path: repo.content_store.lines(blob) for path, blob in added.items()}, threshold)
+            renames = {from_name: to_name for from_name, to_name, _ in pairs}
+        diff._similar_renames = renames
+    return renames
 
 
 class FileAdded(Change):
 
-    def __init__(self, file_name: str, content: List[bytes]):
+    def __init__(self, file_name: str, content: Sequence[bytes]):
         self.file_name = file_name
         self.content = content
 
@@ -21,7 +49,10 @@ class FileAdded(Change):
     def apply(self, repo: git.Repo, repo_state: RepoState) -> None:
         repo_state[self.file_name] = self.content
 
-    def transform(self, other: 'Change'):
+    def touched_paths(self) -> Tuple[str, ...]:
+        return self.file_name,
+
+    def transform(self, repo: SmartRepo, other: 'Change'):
         if isinstance(other, FileAdded):
             if self.file_name != other.file_name:
                 return self
@@ -31,25 +62,33 @@ class FileAdded(Change):
         if isinstance(other, FileDeleted):
             # Even if we're deleting the file we're gonna add, no modifications are required.
             return self
+        if set(other.touched_paths()).isdisjoint(self.touched_paths()):
+            # A change to other files.
+            return self
         raise Conflict
 
     def to_json(self) -> Dict[str, Any]:
         return dict(super(FileAdded, self).to_json(), **{'file_name': self.file_name,
-                                                         'content': [line.decode('ascii') for line in self.content]})
+                                                         'content': [bytes(line).decode('ascii')
+                                                                     for line in self.content]})
 
     @classmethod
     def from_json(cls, repo: SmartRepo, json: Dict[str, Any]) -> 'FileAdded':
-        return FileAdded(file_name=json['file_name'], content=[line.encode('ascii') for line in json['content']])
+        return FileAdded(file_name=json['file_name'],
+                         content=repo.content_store.intern(line.encode('ascii') for line in json['content']))
 
     @classmethod
-    def detect(cls: Type[T], repo: git.Repo, diff: git.DiffIndex) -> Iterable[T]:
+    def detect(cls: Type[T], repo: SmartRepo, diff: git.DiffIndex) -> Iterable[T]:
+        renamed_to = set(similar_renames(repo, diff).values())
         for add in diff.iter_change_type('A'):
-            yield FileAdded(add.b_path, add.b_blob.data_stream.read().splitlines(keepends=True))
+            if add.b_path in renamed_to:
+                continue
+            yield FileAdded(add.b_path, repo.content_store.buffer(add.b_blob))
 
 
 class FileDeleted(Change):
 
-    def __init__(self, file_name: str, content: List[str]):
+    def __init__(self, file_name: str, content: Sequence[bytes]):
         self.file_name = file_name
         self.content = content
 
@@ -60,6 +99,9 @@ class FileDeleted(Change):
     def apply(self, repo: git.Repo, repo_state: RepoState) -> None:
         del repo_state[self.file_name]
 
+    def touched_paths(self) -> Tuple[str, ...]:
+        return self.file_name,
+
     def transform(self, repo: git.Repo, other: 'Change'):
         if isinstance(other, FileAdded):
             if self.file_name == other.file_name:
@@ -72,21 +114,32 @@ class FileDeleted(Change):
             return self
         if isinstance(other, FileRenamed):
             if self.file_name == other.from_name:
-                if open(os.path.join(repo.working_dir, other.to_name)).readlines() == self.content:
-                    return FileDeleted()
+                with open(os.path.join(repo.working_dir, other.to_name), 'rb') as file:
+                    renamed_content = file.read().splitlines(keepends=True)
+                if renamed_content == self.content:
+                    return FileDeleted(other.to_name, self.content)
+        if set(other.touched_paths()).isdisjoint(self.touched_paths()):
+            # A change to other files.
+            return self
         raise Conflict
 
     def to_json(self) -> Dict[str, Any]:
-        return dict(super(FileDeleted, self).to_json(), **{'file_name': self.file_name, 'content': self.content})
+        return dict(super(FileDeleted, self).to_json(), **{'file_name': self.file_name,
+                                                           'content': [bytes(line).decode('utf-8')
+                                                                       for line in self.content]})
 
     @classmethod
     def from_json(cls, repo: SmartRepo, json: Dict[str, Any]) -> 'FileDeleted':
-        return FileDeleted(file_name=json['file_name'], content=json['content'])
+        return FileDeleted(file_name=json['file_name'],
+                           content=repo.content_store.intern(line.encode('utf-8') for line in json['content']))
 
     @classmethod
-    def detect(cls: Type[T], repo: git.Repo, diff: git.DiffIndex) -> Iterable[T]:
+    def detect(cls: Type[T], repo: SmartRepo, diff: git.DiffIndex) -> Iterable[T]:
+        renamed_from = similar_renames(repo, diff)
         for delete in diff.iter_change_type('D'):
-            yield FileDeleted(delete.a_path, delete.a_blob.data_stream.read().splitlines(keepends=True))
+            if delete.a_path in renamed_from:
+                continue
+            yield FileDeleted(delete.a_path, repo.content_store.buffer(delete.a_blob))
 
 
 class FileRenamed(Change):
@@ -102,7 +155,10 @@ class FileRenamed(Change):
     def apply(self, repo: git.Repo, repo_state: RepoState) -> None:
         repo_state.rename(self.from_name, self.to_name)
 
-    def transform(self, other: 'Change'):
+    def touched_paths(self) -> Tuple[str, ...]:
+        return self.from_name, self.to_name
+
+    def transform(self, repo: SmartRepo, other: 'Change'):
         if isinstance(other, FileAdded):
             if self.to_name == other.file_name:
                 # We were about to rename a file to a name and someone else just added a file with that name.
@@ -121,6 +177,9 @@ class FileRenamed(Change):
                 # Someone renamed another file to our target name.
                 raise Conflict
             return self
+        if set(other.touched_paths()).isdisjoint(self.touched_paths()):
+            # A change to other files.
+            return self
         raise Conflict
 
     def to_json(self) -> Dict[str, Any]:
@@ -131,6 +190,12 @@ class FileRenamed(Change):
         return FileRenamed(from_name=json['from_name'], to_name=json['to_name'])
 
     @classmethod
-    def detect(cls, repo: git.Repo, diff: git.DiffIndex) -> Iterable['FileRenamed']:
+    def detect(cls, repo: SmartRepo, diff: git.DiffIndex) -> Iterable['FileRenamed']:
+        """
+        Detect the renames git found, as well as those it missed (see `similar_renames`). Edits to the renamed files are
+        detected afterwards, once the renames are applied.
+        """
         for rename in diff.iter_change_type('R'):
             yield FileRenamed(rename.a_path, rename.b_path)
+        for from_name, to_name in similar_renames(repo, diff).items():
+            yield FileRenamed(from_name, to_name)
@@ -1,25 +1,29 @@
-import difflib
-import itertools
-from typing import Iterable, Dict, Any, Optional, List
+from typing import Iterable, Dict, Any, Optional, Sequence, Tuple
 
 import git
-import unidiff
 from clang.cindex import Cursor, SourceLocation
-from unidiff import PatchedFile, Hunk
-from unidiff.patch import Line
 
+import tracing
 from changes.change import Change
 from cursor_path import CursorPath
+from detection_budget import may_parse
+from parse_options import FULL
 from repo_state import RepoState, SingleFileRepoState
 from smart_repo import SmartRepo
+from utils.diff import diff
 from utils.file import file_from_text, file_from_blob
+from utils.tokens import TokenTable
 
 
 class SubASTInserted(Change):
+    # Inserted statements are found within function bodies.
+    parse_profile = FULL
 
-    def __init__(self, repo: SmartRepo, file_lines: List[bytes], ast_path: CursorPath):
-        with file_from_text(file_lines, ast_path.file) as file:
-            translation_unit = repo.get_cindex().parse(file.name)
+    def __init__(self, repo: SmartRepo, file_lines: Sequence[bytes], ast_path: CursorPath):
+        # Insertions into the same file share its buffer.
+        file_lines = repo.content_store.intern(file_lines)
+        with file_from_text([file_lines.tobytes()], ast_path.file) as file:
+            translation_unit = repo.parse(file.name, ast_path.file, self.parse_profile)
         cursor = ast_path.locate(translation_unit, ast_path.file)
         parent_cursor = ast_path.drop(1).locate(translation_unit, ast_path.file)
         siblings = list(parent_cursor.get_children())
@@ -47,7 +51,7 @@ class SubASTInserted(Change):
         return 'insert-sub-ast'
 
     def apply(self, repo: SmartRepo, repo_state: RepoState) -> None:
-        ast = repo_state.ast(self.parent_path.file)
+        ast = repo_state.ast(self.parent_path.file, self.parse_profile)
         parent_cursor = self.parent_path.locate(ast, self.parent_path.file)
         if self.predecessor_path is None:
             siblings = list(parent_cursor.get_children())
@@ -59,11 +63,14 @@ class SubASTInserted(Change):
             from_location = predecessor_cursor.extent.end
         file_content = b''.join(repo_state[self.parent_path.file])
         new_content = file_content[:from_location.offset] \
-                      + b''.join(self.file_lines)[self.from_location:self.to_location + 1]\
+                      + self.file_lines.tobytes()[self.from_location:self.to_location + 1]\
                       + file_content[from_location.offset:]
         new_lines = new_content.splitlines(keepends=True)
         repo_state[self.parent_path.file] = new_lines
 
+    def touched_paths(self) -> Tuple[str, ...]:
+        return self.ast_path.file,
+
     def transform(self, repo: SmartRepo, other: 'Change') -> Optional['SubASTInserted']:
         from changes import FileRenamed, FileAdded, FileDeleted, TextualChange, VariableRenamed
         if isinstance(other, FileRenamed):
@@ -78,55 +85,51 @@ class SubASTInserted(Change):
             or isinstance(other, VariableRenamed) and other.path.file == self.ast_path.file:
             state = SingleFileRepoState(repo, self.ast_path.file, self.file_lines)
             other.apply(repo, state)
-            return SubASTInserted(repo, state[self.ast_path.file], self.ast_path)
+            return SubASTInserted(repo, state.content, self.ast_path)
         return self
 
     def to_json(self) -> Dict[str, Any]:
         return dict(super(SubASTInserted, self).to_json(),
-                    **{'file_lines': list(line.decode('utf-8') for line in self.file_lines),
+                    **{'file_lines': list(bytes(line).decode('utf-8') for line in self.file_lines),
                        'ast_path': self.ast_path.to_json()})
 
     @classmethod
     def from_json(cls, repo: SmartRepo, json: Dict[str, Any]) -> 'SubASTInserted':
-        return SubASTInserted(repo, list(line.encode('utf-8') for line in json['file_lines']),
+        return SubASTInserted(repo, repo.content_store.intern(line.encode('utf-8') for line in json['file_lines']),
                               CursorPath.from_json(json['ast_path']))
 
     def are_asts_equal(self, a: Cursor, b: Cursor):
-        for a, b in itertools.zip_longest(a.get_tokens(), b.get_tokens()):
-            if a is None or b is None or a.spelling != b.spelling:
-                return False
-        return True
+        return TokenTable.of(a.translation_unit).equal(a, TokenTable.of(b.translation_unit), b)
 
     @classmethod
     def detect_ast_insertions(cls, before: Cursor, after: Cursor, ast_path: CursorPath) -> Iterable[CursorPath]:
-        before_children = [hex(hash(tuple((token.kind.value, token.spelling) for token in child.get_tokens()))) + '\n'
-                           for child in before.get_children()]
-        after_children = [hex(hash(tuple((token.kind.value, token.spelling) for token in child.get_tokens()))) + '\n'
-                          for child in after.get_children()]
-
-        diff = unidiff.PatchSet.from_string(''.join(difflib.unified_diff(before_children, after_children, fromfile='a',
-                                                                         tofile='a')))
-        if not diff.modified_files:
+        before_tokens = TokenTable.of(before.translation_unit)
+        after_tokens = TokenTable.of(after.translation_unit)
+        before_children = list(before.get_children())
+        after_children = list(after.get_children())
+        if not before_children:
+            # Insertions are located relative to existing siblings, see `apply`.
             return
-        assert len(diff.modified_files) == 1
-        modified: PatchedFile = diff.modified_files[0]
-        for hunk in modified:  # type: Hunk
-            for i, line in enumerate(hunk):  # type: (int, Line)
-                if not line.is_context and line.is_added:
-                    if i != 0 and hunk[i - 1].is_removed:
-                        before_child = list(before.get_children())[hunk[i - 1].source_line_no - 1]
-                        after_child = list(after.get_children())[line.target_line_no - 1]
-                        yield from cls.detect_ast_insertions(before_child, after_child,
-                                                             ast_path.appended(after, after_child))
-                    else:
-                        line_no = line.target_line_no
-                        yield ast_path.appended(after, list(after.get_children())[line_no - 1])
+        for hunk in diff([before_tokens.key(child) for child in before_children],
+                         [after_tokens.key(child) for child in after_children]):
+            inserted = range(hunk.b_start, hunk.b_end)
+            if hunk.a_start < hunk.a_end and inserted:
+                # The first child that replaced others is taken to be the last of them, changed - look within it.
+                before_child = before_children[hunk.a_end - 1]
+                after_child = after_children[inserted[0]]
+                yield from cls.detect_ast_insertions(before_child, after_child, ast_path.appended(after, after_child))
+                inserted = inserted[1:]
+            for i in inserted:
+                yield ast_path.appended(after, after_children[i])
 
     @classmethod
     def detect(cls, repo: SmartRepo, diff: git.DiffIndex) -> Iterable['SubASTInserted']:
         for m in diff.iter_change_type('M'):
-            with repo.ast(m.a_blob) as a_ast, file_from_blob(m.b_blob) as b_file:
+            if not may_parse(repo, m):
+                continue
+            with tracing.span('detect file', change_type=cls.name(), path=m.a_path), \
+                    repo.ast(m.a_blob, m.a_path, cls.parse_profile) as a_ast, file_from_blob(m.b_blob) as b_file:
                 b_file.seek(0)
-                b_ast = repo.get_cindex().parse(b_file.name)
+                b_ast = repo.parse(b_file.name, m.b_path, cls.parse_profile)
                 for inserted_path in cls.detect_ast_insertions(a_ast.cursor, b_ast.cursor, CursorPath([m.a_path])):
-                    yield SubASTInserted(repo, b_file.readlines(), inserted_path)
+                    yield SubASTInserted(repo, repo.content_store.buffer(m.b_blob), inserted_path)
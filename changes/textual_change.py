@@ -1,20 +1,16 @@
-import os
-import difflib
-from io import BytesIO
-from typing import Dict, Any, Type, List, Iterable
+from typing import Dict, Any, Type, Sequence, Iterable, Tuple
 
 import git
-import unidiff
-from unidiff import Hunk, PatchedFile
 
 from repo_state import RepoState
 from smart_repo import SmartRepo
+from utils.diff import diff as diff_lines
 from .change import Change, Conflict
 
 
 class TextualChange(Change):
 
-    def __init__(self, file_path: str, from_line: int, to_line: int, content: List[bytes]):
+    def __init__(self, file_path: str, from_line: int, to_line: int, content: Sequence[bytes]):
         self.file_path = file_path
         self.from_line = from_line
         self.to_line = to_line
@@ -29,6 +25,9 @@ class TextualChange(Change):
         contents[self.from_line:self.to_line] = self.content
         repo_state[self.file_path] = contents
 
+    def touched_paths(self) -> Tuple[str, ...]:
+        return self.file_path,
+
     @property
     def removed_line_count(self):
         return self.to_line - self.from_line
@@ -47,32 +46,34 @@ class TextualChange(Change):
                 return self
             # Otherwise - we're overlapping - complain
             raise Conflict
+        from changes import FileRenamed
+        if isinstance(other, FileRenamed) and other.from_name == self.file_path:
+            return TextualChange(other.to_name, self.from_line, self.to_line, self.content)
+        if self.file_path not in other.touched_paths():
+            # A change in another file - we don't care.
+            return self
         raise Conflict
 
     def to_json(self) -> Dict[str, Any]:
         return dict(super(TextualChange, self).to_json(), **{'file_path': self.file_path, 'from_line': self.from_line,
                                                              'to_line': self.to_line,
-                                                             'content': [line.decode('utf-8')
+                                                             'content': [bytes(line).decode('utf-8')
                                                                          for line in self.content]})
 
     @classmethod
     def from_json(cls: Type['TextualChange'], repo: SmartRepo, json: Dict[str, Any]) -> 'TextualChange':
         return TextualChange(file_path=json['file_path'], from_line=json['from_line'], to_line=json['to_line'],
-                             content=[line.encode('utf-8') for line in json['content']])
+                             content=repo.content_store.intern(line.encode('utf-8') for line in json['content']))
 
     @classmethod
-    def detect(cls: Type['TextualChange'], repo: git.Repo, diff: git.DiffIndex) -> Iterable['TextualChange']:
+    def detect(cls: Type['TextualChange'], repo: SmartRepo, diff: git.DiffIndex) -> Iterable['TextualChange']:
         for file_diff in diff:
             if file_diff.change_type != 'M':
                 continue
-            a = file_diff.a_blob.data_stream.read().decode('utf-8').splitlines(keepends=True)
-            b = file_diff.b_blob.data_stream.read().decode('utf-8').splitlines(keepends=True)
-            diff = unidiff.PatchSet.from_string(''.join(difflib.unified_diff(a, b, fromfile=file_diff.a_path,
-                                                                             tofile=file_diff.b_path)))
-            for hunk in diff[0]:
-                assert isinstance(hunk, Hunk)
-                for i, line in enumerate(hunk, hunk.source_start - 1):
-                    if line.is_removed:
-                        yield TextualChange(file_diff.a_path, i, i + 1, [])
-                    elif line.is_added:
-                        yield TextualChange(file_diff.a_path, i, i, [line.value.encode('utf-8')])
+            a = repo.content_store.lines(file_diff.a_blob)
+            b = repo.content_store.lines(file_diff.b_blob)
+            # The changes' contents are ranges of the new file's buffer, rather than copies of its lines.
+            b_buffer = repo.content_store.buffer(file_diff.b_blob)
+            # A change per hunk, each relative to the original file (they are applied from the last one).
+            for hunk in diff_lines(a, b):
+                yield TextualChange(file_diff.a_path, hunk.a_start, hunk.a_end, b_buffer[hunk.b_start:hunk.b_end])
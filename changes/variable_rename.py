@@ -1,18 +1,23 @@
-from typing import Iterable, Dict, Any, Optional, Type
+from typing import Iterable, Dict, Any, Optional, Type, Tuple
 
 import git
 from clang.cindex import CursorKind, SourceRange, SourceLocation
 
+import tracing
 from changes.change import Change, T, Conflict
 from cursor_path import CursorPath
+from detection_budget import may_parse
+from parse_options import FULL
 from renaming_detector import RenamingDetector
 from repo_state import RepoState
 from smart_repo import SmartRepo
 from utils.ast import search_ast
-from utils.file import apply_replacements, file_from_blob, file_from_text, Replacement
+from utils.file import apply_replacements, file_from_blob, Replacement
 
 
 class VariableRenamed(Change):
+    # Renamed variables (and their usages) are found within function bodies.
+    parse_profile = FULL
 
     def __init__(self, path: CursorPath, new_name: str):
         self.path = path
@@ -24,24 +29,26 @@ class VariableRenamed(Change):
 
     def apply(self, repo: SmartRepo, repo_state: RepoState) -> None:
         file_text = repo_state[self.path.file]
-        with file_from_text(file_text, self.path.file) as file:
-            translation_unit = repo.get_cindex().parse(file.name)
-            variable = self.path.locate(translation_unit, self.path.file)
-            usages = search_ast(translation_unit, self.path.file,
-                                lambda cursor: cursor.kind == CursorKind.DECL_REF_EXPR
-                                               and cursor.get_definition() == variable)
-            replacements = [Replacement(variable.location.line - 1, variable.location.column - 1,
-                                        variable.location.column + len(variable.spelling) - 1, self.new_name)]
-            for usage_path in usages:
-                usage = usage_path.locate(translation_unit, self.path.file)
-                range: SourceRange = usage.extent
-                start: SourceLocation = range.start
-                end: SourceLocation = range.end
-                assert start.line == end.line
-                assert file_text[start.line - 1][start.column - 1:end.column - 1] == variable.spelling.encode('utf-8')
-                replacements.append(Replacement(start.line - 1, start.column - 1, end.column - 1, self.new_name))
-            file_text = apply_replacements(file_text, replacements)
-        repo_state[self.path.file] = file_text
+        translation_unit = repo_state.ast(self.path.file, self.parse_profile)
+        variable = self.path.locate(translation_unit, self.path.file)
+        usages = search_ast(translation_unit, self.path.file,
+                            lambda cursor: cursor.kind == CursorKind.DECL_REF_EXPR
+                                           and cursor.get_definition() == variable)
+        replacements = [Replacement(variable.location.line - 1, variable.location.column - 1,
+                                    variable.location.column + len(variable.spelling) - 1, self.new_name)]
+        for usage in CursorPath.locate_many(translation_unit, usages, self.path.file).values():
+            if isinstance(usage, KeyError):
+                raise usage
+            range: SourceRange = usage.extent
+            start: SourceLocation = range.start
+            end: SourceLocation = range.end
+            assert start.line == end.line
+            assert file_text[start.line - 1][start.column - 1:end.column - 1] == variable.spelling.encode('utf-8')
+            replacements.append(Replacement(start.line - 1, start.column - 1, end.column - 1, self.new_name))
+        repo_state[self.path.file] = apply_replacements(file_text, replacements)
+
+    def touched_paths(self) -> Tuple[str, ...]:
+        return self.path.file,
 
     def transform(self, repo: git.Repo, other: 'Change') -> Optional['VariableRenamed']:
         if isinstance(other, VariableRenamed) and other.path == self.path:
@@ -60,7 +67,10 @@ class VariableRenamed(Change):
     @classmethod
     def detect(cls: Type['VariableRenamed'], repo: SmartRepo, diff: git.DiffIndex) -> Iterable['VariableRenamed']:
         for m in diff.iter_change_type('M'):
-            with file_from_blob(m.a_blob) as a, file_from_blob(m.b_blob) as b:
-                for renamed, new_name in RenamingDetector(repo.get_cindex()).get_renamed_variables(m.a_path, a.name,
-                                                                                                   b.name).items():
+            if not may_parse(repo, m):
+                continue
+            with tracing.span('detect file', change_type=cls.name(), path=m.a_path), \
+                    file_from_blob(m.a_blob) as a, file_from_blob(m.b_blob) as b:
+                detector = RenamingDetector(repo, cls.parse_profile)
+                for renamed, new_name in detector.get_renamed_variables(m.a_path, a.name, b.name).items():
                     yield VariableRenamed(renamed, new_name)
@@ -0,0 +1,196 @@
+import binascii
+import hashlib
+import itertools
+import subprocess
+from array import array
+from collections.abc import Sequence
+from io import BytesIO
+from typing import Dict, Iterable, List, Union, Iterator
+
+import git
+from gitdb.util import NULL_BIN_SHA
+
+import tracing
+
+# The size of the chunks in which `ContentStore.iter_lines` reads blobs.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class ContentBuffer:
+    """ Immutable contents of a file, with the offset of every line (split like `bytes.splitlines`) in them. """
+
+    __slots__ = ('data', 'offsets')
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offsets = array('q', [0])
+        self.offsets.extend(itertools.accumulate(map(len, data.splitlines(keepends=True))))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def lines(self) -> 'Lines':
+        return Lines(self, 0, len(self))
+
+
+class Lines(Sequence):
+    """
+    A range of the lines of a content buffer, which are read-only memoryview slices of its data rather than copies.
+
+    Lines compare equal to any sequence of the same lines (e.g. a list of bytes), and slicing them makes another range
+    of the same buffer.
+    """
+
+    __slots__ = ('buffer', 'start', 'end')
+
+    def __init__(self, buffer: ContentBuffer, start: int, end: int):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, end, step)]
+            return Lines(self.buffer, self.start + start, self.start + max(start, end))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        offsets = self.buffer.offsets
+        return memoryview(self.buffer.data)[offsets[self.start + index]:offsets[self.start + index + 1]]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        data, offsets = memoryview(self.buffer.data), self.buffer.offsets
+        for i in range(self.start, self.end):
+            yield data[offsets[i]:offsets[i + 1]]
+
+    def tobytes(self) -> bytes:
+        """ The lines joined, which is the buffer's data itself (rather than a copy) for all its lines. """
+        if self.start == 0 and self.end == len(self.buffer):
+            return self.buffer.data
+        return self.buffer.data[self.buffer.offsets[self.start]:self.buffer.offsets[self.end]]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Lines) and other.buffer is self.buffer:
+            return (other.start, other.end) == (self.start, self.end) or self.tobytes() == other.tobytes()
+        if not isinstance(other, Sequence) or isinstance(other, (str, bytes)):
+            return NotImplemented
+        return len(self) == len(other) and all(line == other_line for line, other_line in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({[bytes(line) for line in self]!r})'
+
+
+class ContentStore:
+    """
+    Caches the contents of blobs for the duration of a single command invocation, so that all detectors and repo states
+    share a single read of each blob.
+
+    Blobs that are about to be needed (e.g. all blobs of a diff) can be loaded in one batched pass using `prefetch`,
+    instead of a round-trip to git per read.
+
+    The contents that changes hold are `Lines` of buffers kept by the store as well, one per distinct content (by its
+    blob SHA), so that changes to the same file share a single copy of it.
+    """
+
+    def __init__(self, repo: git.Repo):
+        self.repo = repo
+        self._contents: Dict[bytes, bytes] = {}
+        self._buffers: Dict[bytes, ContentBuffer] = {}
+
+    def __contains__(self, binsha: bytes) -> bool:
+        return binsha in self._contents
+
+    def add(self, binsha: bytes, content: bytes) -> None:
+        """ Record the contents of an object that is known without reading it (e.g. one that was just written). """
+        self._contents[binsha] = content
+
+    def read(self, blob: Union[git.Blob, bytes]) -> bytes:
+        """ Return the contents of the given blob (or binary SHA of a blob). """
+        binsha = blob if isinstance(blob, bytes) else blob.binsha
+        if binsha not in self._contents:
+            self._contents[binsha] = self.repo.odb.stream(binsha).read()
+        return self._contents[binsha]
+
+    def lines(self, blob: Union[git.Blob, bytes]) -> List[bytes]:
+        """ Return the contents of the given blob as a list of lines (with line endings). """
+        return self.read(blob).splitlines(keepends=True)
+
+    def buffer(self, blob: Union[git.Blob, bytes]) -> Lines:
+        """ Return the lines of the given blob, from the buffer shared by all the holders of its contents. """
+        binsha = blob if isinstance(blob, bytes) else blob.binsha
+        if binsha not in self._buffers:
+            self._buffers[binsha] = ContentBuffer(self.read(binsha))
+        return self._buffers[binsha].lines()
+
+    def intern(self, lines: Iterable[bytes]) -> Lines:
+        """ Return the given lines from the buffer shared by all the holders of the same contents. """
+        if isinstance(lines, Lines):
+            return lines
+        data = b''.join(lines)
+        # Buffers are keyed by the SHA that the contents would have as a blob, to be shared with the blobs' buffers.
+        digest = hashlib.sha1(b'blob %d\0' % len(data))
+        digest.update(data)
+        binsha = digest.digest()
+        if binsha not in self._buffers:
+            self._buffers[binsha] = ContentBuffer(self._contents.setdefault(binsha, data))
+        return self._buffers[binsha].lines()
+
+    def iter_lines(self, blob: Union[git.Blob, bytes]) -> Iterator[bytes]:
+        """
+        Yield the lines (with line endings) of the given blob one by one.
+
+        Blobs that aren't already loaded are streamed from the object database without being loaded (or cached) as a
+        whole, so this is suitable for arbitrarily large blobs such as the change log.
+        """
+        binsha = blob if isinstance(blob, bytes) else blob.binsha
+        if binsha in self._contents:
+            yield from BytesIO(self._contents[binsha])
+            return
+        stream = self.repo.odb.stream(binsha)
+        pending = b''
+        while True:
+            chunk = stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if pending:
+            yield pending
+
+    def prefetch(self, diff: git.DiffIndex) -> None:
+        """ Load the contents of all blobs on both sides of the given diff. """
+        self.prefetch_shas(blob.binsha for file_diff in diff for blob in (file_diff.a_blob, file_diff.b_blob)
+                           if blob is not None)
+
+    def prefetch_shas(self, binshas: Iterable[bytes]) -> None:
+        """ Load the contents of the given objects with a single `git cat-file --batch` call. """
+        missing = list({binsha for binsha in binshas if binsha != NULL_BIN_SHA and binsha not in self._contents})
+        if not missing:
+            return
+        with tracing.span('git cat-file', objects=len(missing)):
+            process = subprocess.Popen([git.Git.GIT_PYTHON_GIT_EXECUTABLE, '--git-dir', self.repo.git_dir, 'cat-file',
+                                        '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output, _ = process.communicate(b''.join(binascii.hexlify(binsha) + b'\n' for binsha in missing))
+        if process.returncode:
+            raise git.GitCommandError(['git', 'cat-file', '--batch'], process.returncode)
+        position = 0
+        for binsha in missing:
+            header_end = output.index(b'\n', position)
+            header = output[position:header_end].split()
+            if header[-1] == b'missing':
+                position = header_end + 1
+                continue
+            size = int(header[2])
+            self._contents[binsha] = output[header_end + 1:header_end + 1 + size]
+            # Skip the object's contents and the trailing newline.
+            position = header_end + 1 + size + 1
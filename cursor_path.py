@@ -1,9 +1,28 @@
-from typing import Tuple, Union, List, Optional, Sequence
+import functools
+import weakref
+from typing import Tuple, Union, List, Optional, Sequence, Iterator, Iterable, Dict
 
 from clang.cindex import Cursor, TranslationUnit, CursorKind
 
+import tracing
+
 CursorPathElement = Union[str, Tuple[CursorKind, int]]
 
+# Elements as they are stored: cursor kinds are encoded by their (small integer) ids.
+_Element = Union[str, Tuple[int, int]]
+
+
+@functools.lru_cache(maxsize=None)
+def _kind_name(kind_id: int) -> str:
+    return CursorKind.from_id(kind_id).name
+
+
+def _encode_element(element: CursorPathElement) -> _Element:
+    if isinstance(element, str):
+        return element
+    kind, index = element
+    return kind.value if isinstance(kind, CursorKind) else kind, index
+
 
 class CursorPath:
     """
@@ -19,88 +38,195 @@ class CursorPath:
     }
 
     Might be: file.c:main().COMPOUND_STMT#0.DECL_STMT#1.a
+
+    Paths are hash-consed: a path is its parent path plus one element, and there is only ever one instance of each path,
+    so paths share their prefixes and are compared by identity.
     """
+    __slots__ = ('parent', 'element', 'file', '_hash', '__weakref__')
+
+    _interned: 'weakref.WeakValueDictionary[Tuple[Optional[CursorPath], _Element], CursorPath]' = \
+        weakref.WeakValueDictionary()
+    _empty: 'CursorPath'
 
-    def __init__(self, elements: Sequence[Union[Cursor, CursorPathElement]] = ()):
+    def __new__(cls, elements: Sequence[Union[Cursor, CursorPathElement]] = ()):
+        path = cls._empty
         if len(elements) == 0:
-            self._path: Tuple[CursorPathElement, ...] = ()
-        elif isinstance(elements[0], Cursor):
-            self._path: Tuple[CursorPathElement, ...] = (elements[0].displayname, )
+            return path
+        if isinstance(elements[0], Cursor):
+            path = path._child(elements[0].displayname)
             for parent, child in zip(elements, elements[1:]):
-                self._path += (self.element_from_cursor(parent, child), )
-        else:
-            self._path: Tuple[CursorPathElement, ...] = tuple(elements)
+                path = path._child(cls.element_from_cursor(parent, child))
+            return path
+        for element in elements:
+            path = path._child(_encode_element(element))
+        return path
 
-    def appended(self, parent: Union[Cursor, str], child: Optional[Cursor]=None):
+    @classmethod
+    def _create(cls, parent: Optional['CursorPath'], element: Optional[_Element]) -> 'CursorPath':
+        path = object.__new__(cls)
+        path.parent = parent
+        path.element = element
+        if parent is None:
+            path.file = None
+            path._hash = hash(())
+        else:
+            path.file = element if parent.file is None else parent.file
+            path._hash = hash((parent._hash, element))
+        return path
+
+    def _child(self, element: _Element) -> 'CursorPath':
+        key = (self, element)
+        child = self._interned.get(key)
+        if child is None:
+            child = self._interned[key] = self._create(self, element)
+        return child
+
+    def appended(self, parent: Union[Cursor, str], child: Optional[Cursor]=None) -> 'CursorPath':
         if isinstance(parent, str):
-            return CursorPath(self._path + (parent, ))
+            return self._child(parent)
         assert isinstance(parent, Cursor) and isinstance(child, Cursor)
-        return CursorPath(self._path + (self.element_from_cursor(parent, child), ))
-
-    def drop(self, n: int):
-        return CursorPath(self._path[:len(self._path) - n])
+        return self._child(self.element_from_cursor(parent, child))
+
+    def children(self, parent: Cursor) -> Iterator[Tuple[Cursor, 'CursorPath']]:
+        """
+        Yield the children of the given cursor (which this path points to) along with their paths.
+
+        This is equivalent to calling `appended(parent, child)` for every child, without rescanning the siblings of
+        each child.
+        """
+        kind_counts = {}
+        for child in parent.get_children():
+            kind_id = child.kind.value
+            index = kind_counts.get(kind_id, 0)
+            kind_counts[kind_id] = index + 1
+            yield child, self._child(child.displayname or (kind_id, index))
+
+    def drop(self, n: int) -> 'CursorPath':
+        path = self
+        for _ in range(n):
+            if path.parent is None:
+                break
+            path = path.parent
+        return path
 
     @staticmethod
-    def element_from_cursor(parent: Cursor, child: Cursor) -> CursorPathElement:
+    def element_from_cursor(parent: Cursor, child: Cursor) -> _Element:
         if child.displayname:
             return child.displayname
         children_of_kind = [sibling for sibling in parent.get_children() if sibling.kind == child.kind]
-        return child.kind, children_of_kind.index(child)
+        return child.kind.value, children_of_kind.index(child)
 
     @property
-    def file(self):
-        return self._path[0]
-
-    @staticmethod
-    def match_element(parent: Cursor, element: CursorPathElement):
-        if isinstance(element, str):
-            for child in parent.get_children():
-                if child.displayname == element:
-                    yield child
-        else:
-            children_of_kind = [child for child in parent.get_children() if child.kind == element[0]]
-            if len(children_of_kind) > element[1]:
-                yield children_of_kind[element[1]]
+    def elements(self) -> Tuple[_Element, ...]:
+        """ The (encoded) elements of this path, starting with the file name. """
+        elements = []
+        path = self
+        while path.parent is not None:
+            elements.append(path.element)
+            path = path.parent
+        return tuple(reversed(elements))
 
     def locate(self, translation_unit: TranslationUnit, file_name: str) -> Cursor:
-        if file_name != self.file:
-            raise KeyError(f'This path points to file {self.file}, given translation unit is '
-                           f'{translation_unit.spelling}')
-        current: Cursor = translation_unit.cursor
-        found: Tuple[str, ...] = (self.file, )
-        path = self._path[1:]
-        while path:
-            candidates = list(self.match_element(current, path[0]))
+        result = self.locate_many(translation_unit, [self], file_name)[self]
+        if isinstance(result, KeyError):
+            raise result
+        return result
+
+    @classmethod
+    def locate_many(cls, translation_unit: TranslationUnit, paths: Iterable['CursorPath'],
+                    file_name: Optional[str] = None) -> Dict['CursorPath', Union[Cursor, KeyError]]:
+        """
+        Locate several paths in a translation unit at once.
+
+        Paths share their prefixes, so the AST is walked like a trie: the cursor of every prefix is located once, and the
+        children of every cursor are listed once.
+        :param translation_unit: The translation unit to locate the paths in.
+        :param paths: The paths to locate.
+        :param file_name: The file the translation unit was parsed from. If given, paths into other files fail.
+        :return: The cursor each path points to, or the KeyError describing why it couldn't be located.
+        """
+        # Cursors (or errors) of the paths and prefixes located so far.
+        located: Dict[CursorPath, Union[Cursor, KeyError]] = {}
+        # The children of located cursors, by display name and by kind.
+        children: Dict[CursorPath, Tuple[Dict[str, List[Cursor]], Dict[int, List[Cursor]]]] = {}
+
+        def locate(path: CursorPath) -> Union[Cursor, KeyError]:
+            if path in located:
+                return located[path]
+            if path.parent is None:
+                result = KeyError('Cannot locate an empty path')
+            elif path.parent is cls._empty:
+                if file_name is not None and path.file != file_name:
+                    result = KeyError(f'This path points to file {path.file}, given translation unit is '
+                                      f'{translation_unit.spelling}')
+                else:
+                    result = translation_unit.cursor
+            else:
+                result = locate(path.parent)
+                if not isinstance(result, KeyError):
+                    result = match(path.parent, result, path.element)
+            located[path] = result
+            return result
+
+        def match(parent_path: CursorPath, parent: Cursor, element: _Element) -> Union[Cursor, KeyError]:
+            if parent_path not in children:
+                by_name, by_kind = {}, {}
+                for child in parent.get_children():
+                    if child.displayname:
+                        by_name.setdefault(child.displayname, []).append(child)
+                    by_kind.setdefault(child.kind.value, []).append(child)
+                children[parent_path] = by_name, by_kind
+            by_name, by_kind = children[parent_path]
+            if isinstance(element, str):
+                candidates = by_name.get(element, [])
+            else:
+                children_of_kind = by_kind.get(element[0], [])
+                candidates = children_of_kind[element[1]:element[1] + 1]
             if len(candidates) == 0:
-                raise KeyError(f'Could not find cursor named `{path[0]}` in {".".join(found)}')
+                return KeyError(f'Could not find cursor named `{cls._format_element(element)}` in '
+                                f'{parent_path!r}')
             if len(candidates) != 1:
-                raise KeyError(f'Multiple children matching `{path[0]}` in {".".join(found)}')
-            current = candidates[0]
-            path = path[1:]
-        return current
+                return KeyError(f'Multiple children matching `{cls._format_element(element)}` in {parent_path!r}')
+            return candidates[0]
+
+        paths = list(paths)
+        with tracing.span('locate', paths=len(paths)):
+            return {path: locate(path) for path in paths}
+
+    @staticmethod
+    def _format_element(element: _Element) -> str:
+        return element if isinstance(element, str) else f'{_kind_name(element[0])}#{element[1]}'
 
     def __repr__(self):
-        return f'{self.file}:' + '.'.join(element if isinstance(element, str) else f'{element[0].name}#{element[1]}'
-                                          for element in self._path[1:])
+        return f'{self.file}:' + '.'.join(self._format_element(element) for element in self.elements[1:])
 
     def __eq__(self, other):
-        return isinstance(other, CursorPath) and other.path == self.path
+        # Paths are interned, so equal paths are the same object.
+        return self is other
 
     def __hash__(self):
-        return hash(self._path)
+        return self._hash
+
+    def __reduce__(self):
+        return CursorPath, (self.elements, )
 
     def to_json(self) -> List:
-        return [element if isinstance(element, str) else [element[0].name, element[1]] for element in self._path]
+        return [element if isinstance(element, str) else [_kind_name(element[0]), element[1]]
+                for element in self.elements]
 
     @classmethod
     def from_json(cls, json: List) -> 'CursorPath':
-        return cls(tuple(element_json if isinstance(element_json, str) else (getattr(CursorKind, element_json[0]),
+        return cls(tuple(element_json if isinstance(element_json, str) else (getattr(CursorKind, element_json[0]).value,
                                                                              element_json[1])
                          for element_json in json))
 
     @property
     def path(self) -> Tuple[CursorPathElement, ...]:
-        return self._path
+        return tuple(element if isinstance(element, str) else (CursorKind.from_id(element[0]), element[1])
+                     for element in self.elements)
 
     def with_file(self, file: str) -> 'CursorPath':
-        return CursorPath((file, ) + self._path[1:])
\ No newline at end of file
+        return CursorPath((file, ) + self.elements[1:])
+
+
+CursorPath._empty = CursorPath._create(None, None)
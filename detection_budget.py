@@ -0,0 +1,96 @@
+"""
+Limits on clang-based change detection, so that the latency of a commit doesn't depend on what gets committed.
+
+Configured in git config:
+ - smart.maxFileBytes, smart.maxFileLines, smart.maxFileTokens: files beyond any of these limits are not parsed.
+ - smart.detectionBudget: the wall-clock seconds that detecting the changes of a commit may take. Once it is used up,
+   no more files are parsed. (A parse that already started isn't interrupted - the per-file limits bound those.)
+Setting a limit to 0 disables it. The changes to files that are not parsed are recorded as textual changes instead.
+"""
+import re
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Optional, Dict, List, Iterator
+
+import git
+
+import tracing
+
+DEFAULT_MAX_FILE_BYTES = 2 * 1024 * 1024
+DEFAULT_MAX_FILE_LINES = 50000
+DEFAULT_MAX_FILE_TOKENS = 500000
+DEFAULT_DETECTION_BUDGET = 30.
+
+# Approximates C tokens (identifiers, numbers and punctuation), without a lexer.
+_TOKEN = re.compile(rb'\w+|[^\w\s]')
+
+
+class Fallback(NamedTuple):
+    path: str
+    reason: str
+
+
+class DetectionBudget:
+    """ The limits of detecting the changes of a single commit, and the files that exceeded them so far. """
+
+    def __init__(self, repo):
+        config = repo.config_reader()
+        self.max_bytes = int(config.get_value('smart', 'maxFileBytes', DEFAULT_MAX_FILE_BYTES))
+        self.max_lines = int(config.get_value('smart', 'maxFileLines', DEFAULT_MAX_FILE_LINES))
+        self.max_tokens = int(config.get_value('smart', 'maxFileTokens', DEFAULT_MAX_FILE_TOKENS))
+        self.seconds = float(config.get_value('smart', 'detectionBudget', DEFAULT_DETECTION_BUDGET))
+        self.repo = repo
+        self.deadline = time.monotonic() + self.seconds
+        # The files that clang-based detectors skip, in the order they were skipped.
+        self.fallbacks: List[Fallback] = []
+        # Whether each file checked so far may be parsed. Denials are final.
+        self._within_limits: Dict[str, bool] = {}
+
+    @contextmanager
+    def active(self) -> Iterator['DetectionBudget']:
+        """ Make this the budget of the repository's clang-based detectors during the context. """
+        previous = self.repo.detection_budget
+        self.repo.detection_budget = self
+        try:
+            yield self
+        finally:
+            self.repo.detection_budget = previous
+
+    def _exceeded(self, contents: bytes) -> Optional[str]:
+        if self.max_bytes and len(contents) > self.max_bytes:
+            return f'{len(contents)} bytes exceed the limit of {self.max_bytes}'
+        lines = contents.count(b'\n')
+        if self.max_lines and lines > self.max_lines:
+            return f'{lines} lines exceed the limit of {self.max_lines}'
+        if self.max_tokens:
+            tokens = sum(1 for _ in _TOKEN.finditer(contents))
+            if tokens > self.max_tokens:
+                return f'~{tokens} tokens exceed the limit of {self.max_tokens}'
+        return None
+
+    def allows(self, file_diff: git.Diff) -> bool:
+        """
+        Whether clang-based detectors may parse both sides of the given file diff.
+
+        Once a file is denied, it stays denied for the rest of the commit, so that all of its changes are textual.
+        """
+        path = file_diff.b_path or file_diff.a_path
+        if self._within_limits.get(path) is False:
+            return False
+        reason = None
+        if path not in self._within_limits:
+            for blob in (file_diff.a_blob, file_diff.b_blob):
+                if reason is None and blob is not None:
+                    reason = self._exceeded(self.repo.content_store.read(blob))
+        if reason is None and self.seconds and time.monotonic() > self.deadline:
+            reason = f'the detection budget of {self.seconds:g}s was used up'
+        self._within_limits[path] = reason is None
+        if reason is not None:
+            with tracing.span('fallback', path=path, reason=reason):
+                self.fallbacks.append(Fallback(path, reason))
+        return reason is None
+
+
+def may_parse(repo, file_diff: git.Diff) -> bool:
+    """ Whether clang-based detectors may parse the given file diff, under the repository's active budget (if any). """
+    return repo.detection_budget is None or repo.detection_budget.allows(file_diff)
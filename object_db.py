@@ -0,0 +1,189 @@
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+from typing import Dict, Tuple, Iterable, Optional, IO
+
+from git.objects.fun import tree_entries_from_data
+from gitdb import IStream, OInfo, OStream
+from gitdb.pack import PackEntity
+
+# Above this many bytes of objects held in memory, the overlay spills the oldest ones to a temporary file.
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# Objects too large to be held in memory are hashed and spilled in chunks of this many bytes.
+SPILL_CHUNK_SIZE = 1024 * 1024
+
+# Persisting at least this many objects writes a single packfile rather than one loose object per object.
+PACK_THRESHOLD = 64
+
+
+def _children(object_type: bytes, data: bytes) -> Iterable[bytes]:
+    """ The objects that an object refers to. """
+    if object_type == b'tree':
+        for child_binsha, mode, _ in tree_entries_from_data(data):
+            if mode >> 12 != 0o16:  # Submodule entries refer to commits in other repositories
+                yield child_binsha
+    elif object_type == b'commit':
+        for line in data[:data.find(b'\n\n')].splitlines():
+            key, _, value = line.partition(b' ')
+            if key in (b'tree', b'parent'):
+                yield bytes.fromhex(value.decode('ascii'))
+
+
+class OverlayObjectDB:
+    """
+    An object database that keeps newly stored objects in memory, on top of a repository's own object database.
+
+    Reads fall back to the underlying database. Objects are only written to disk by `persist`, which writes just the
+    objects reachable from a given tree, so that intermediate objects created while manipulating trees never reach the
+    disk. To keep memory bounded, the oldest objects are spilled to an (unlinked) temporary file next to the objects
+    directory once the memory limit is exceeded, where they stay out of the repository until persisted or discarded.
+    """
+
+    def __init__(self, odb, objects_dir: str, memory_limit: int = DEFAULT_MEMORY_LIMIT):
+        self.odb = odb
+        self.objects_dir = objects_dir
+        self.memory_limit = memory_limit
+        self._objects: Dict[bytes, Tuple[bytes, bytes]] = {}
+        self._memory_size = 0
+        # The type, offset and size of the objects in the spill file.
+        self._spilled: Dict[bytes, Tuple[bytes, int, int]] = {}
+        self._spill_file: Optional[IO[bytes]] = None
+
+    def __getattr__(self, item):
+        # Anything we don't override (e.g. resolving partial SHAs) is handled by the underlying database.
+        return getattr(self.odb, item)
+
+    def has_object(self, binsha: bytes) -> bool:
+        return binsha in self or self.odb.has_object(binsha)
+
+    def info(self, binsha: bytes) -> OInfo:
+        if binsha in self._objects:
+            object_type, data = self._objects[binsha]
+            return OInfo(binsha, object_type, len(data))
+        if binsha in self._spilled:
+            object_type, _, size = self._spilled[binsha]
+            return OInfo(binsha, object_type, size)
+        return self.odb.info(binsha)
+
+    def stream(self, binsha: bytes) -> OStream:
+        if binsha in self:
+            object_type, data = self._object(binsha)
+            return OStream(binsha, object_type, len(data), BytesIO(data))
+        return self.odb.stream(binsha)
+
+    def store(self, istream: IStream) -> IStream:
+        object_type = istream.type if isinstance(istream.type, bytes) else istream.type.encode('ascii')
+        if istream.size > self.memory_limit:
+            # Don't load objects that would exceed the limit on their own (e.g. a streamed change log) into memory.
+            istream.binsha = self._spill_stream(object_type, istream.size, istream)
+            return istream
+        data = istream.read()
+        binsha = hashlib.sha1(b'%s %d\0' % (object_type, len(data)) + data).digest()
+        if binsha not in self:
+            self._objects[binsha] = (object_type, data)
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_limit:
+                self._spill_oldest()
+        istream.binsha = binsha
+        return istream
+
+    def _object(self, binsha: bytes) -> Tuple[bytes, bytes]:
+        """ The type and data of an object held in memory or in the spill file. """
+        if binsha in self._objects:
+            return self._objects[binsha]
+        object_type, offset, size = self._spilled[binsha]
+        self._spill_file.seek(offset)
+        return object_type, self._spill_file.read(size)
+
+    def _spill_end(self) -> int:
+        """ The offset to append to the spill file at, creating it if needed. """
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix='smart-git-objects-',
+                                                      dir=os.path.dirname(os.path.abspath(self.objects_dir)))
+        return self._spill_file.seek(0, os.SEEK_END)
+
+    def _spill_oldest(self) -> None:
+        binsha = next(iter(self._objects))
+        object_type, data = self._objects.pop(binsha)
+        self._memory_size -= len(data)
+        self._spilled[binsha] = (object_type, self._spill_end(), len(data))
+        self._spill_file.write(data)
+
+    def _spill_stream(self, object_type: bytes, size: int, stream) -> bytes:
+        """ Hash and spill an object from a stream, a chunk at a time. """
+        sha = hashlib.sha1(b'%s %d\0' % (object_type, size))
+        offset = self._spill_end()
+        for chunk in iter(lambda: stream.read(SPILL_CHUNK_SIZE), b''):
+            sha.update(chunk)
+            self._spill_file.write(chunk)
+        binsha = sha.digest()
+        if binsha not in self:
+            self._spilled[binsha] = (object_type, offset, size)
+        return binsha
+
+    def _forget(self, binsha: bytes) -> None:
+        if binsha in self._objects:
+            self._memory_size -= len(self._objects.pop(binsha)[1])
+        else:
+            del self._spilled[binsha]
+
+    def _reachable_in_memory(self, binsha: bytes) -> Iterable[bytes]:
+        """
+        Yield the in-memory objects reachable from the given object (through trees, and the trees and parents of
+        commits), children first.
+
+        Objects on disk never refer to objects that are only held in memory (or spilled), so on-disk objects are not
+        traversed. The traversal is iterative, since chains of in-memory commits can be arbitrarily long.
+        """
+        seen = set()
+        stack = [(binsha, False)]
+        while stack:
+            binsha, children_done = stack.pop()
+            if children_done:
+                yield binsha
+            elif binsha in self and binsha not in seen:
+                seen.add(binsha)
+                stack.append((binsha, True))
+                if self.info(binsha).type != b'blob':
+                    stack.extend((child_binsha, False) for child_binsha in _children(*self._object(binsha)))
+
+    def persist(self, binsha: bytes, pack: Optional[bool] = None) -> int:
+        """
+        Write the given object and everything reachable from it to disk.
+
+        :param binsha: the object (usually a tree) to persist.
+        :param pack: whether to write a single packfile instead of loose objects. By default, a packfile is written
+                     when there are at least PACK_THRESHOLD objects to persist.
+        :return: the number of objects written.
+        """
+        binshas = list(dict.fromkeys(self._reachable_in_memory(binsha)))
+        if pack is None:
+            pack = len(binshas) >= PACK_THRESHOLD
+        if pack and binshas:
+            PackEntity.create((self.stream(binsha) for binsha in binshas), os.path.join(self.objects_dir, 'pack'),
+                              object_count=len(binshas))
+        else:
+            for binsha in binshas:
+                object_type, data = self._object(binsha)
+                self.odb.store(IStream(object_type, len(data), BytesIO(data)))
+        for binsha in binshas:
+            self._forget(binsha)
+        return len(binshas)
+
+    def discard(self) -> None:
+        """ Drop all objects that were not persisted. """
+        self._objects.clear()
+        self._memory_size = 0
+        self._spilled.clear()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def __contains__(self, binsha: bytes) -> bool:
+        return binsha in self._objects or binsha in self._spilled
+
+    def __len__(self):
+        return len(self._objects) + len(self._spilled)
+
@@ -0,0 +1,112 @@
+"""
+How files are parsed with clang: named parse profiles, and the compiler arguments configured for a repository.
+
+Each change type declares the profile its detection needs (see `Change.parse_profile`). The arguments come from the
+repository's git config:
+ - smart.clangArgs: extra compiler arguments for every parse (e.g. '-Iinclude -DDEBUG').
+ - smart.compileCommands: a compile_commands.json file (or the directory containing it), from which the arguments of
+   each file are taken.
+ - smart.precompiledHeader: a header (relative to the repository) to include in every parsed file. It is precompiled
+   once per invocation and reused by every parse.
+"""
+import os
+import shlex
+import shutil
+import tempfile
+from typing import NamedTuple, Tuple, Optional, Dict, List
+
+from clang.cindex import TranslationUnit, CompilationDatabase, Index
+
+
+class ParseProfile(NamedTuple):
+    name: str
+    options: int = 0
+    args: Tuple[str, ...] = ()
+
+
+# Full semantic analysis, for detectors that look into function bodies.
+FULL = ParseProfile('full')
+# Declarations only, without warnings, for detectors that only need the top-level structure of files.
+STRUCTURE_ONLY = ParseProfile('structure-only',
+                              TranslationUnit.PARSE_SKIP_FUNCTION_BODIES | TranslationUnit.PARSE_INCOMPLETE, ('-w', ))
+
+PROFILES = {profile.name: profile for profile in (FULL, STRUCTURE_ONLY)}
+
+# Arguments of compile commands that don't apply to parsing a (temporary copy of a) file, and whether they take a value.
+_IGNORED_COMPILE_ARGS = {'--': False, '-c': False, '-o': True, '-MF': True, '-MT': True, '-MQ': True, '-MD': False,
+                         '-MMD': False}
+# Arguments of compile commands whose value is a path, relative to the directory the command runs in. (Passing that
+# directory with -working-directory would change the working directory of this whole process.)
+_PATH_ARGS = ('-I', '-iquote', '-isystem', '-idirafter', '-include', '-imacros')
+
+
+class ParseSettings:
+    """ The configured compiler arguments of a repository, read once per invocation. """
+
+    def __init__(self, repo):
+        self.repo = repo
+        config = repo.config_reader()
+        self.args: Tuple[str, ...] = tuple(shlex.split(str(config.get_value('smart', 'clangArgs', ''))))
+        compile_commands = str(config.get_value('smart', 'compileCommands', ''))
+        self._database: Optional[CompilationDatabase] = None
+        if compile_commands:
+            compile_commands = os.path.join(repo.working_dir, compile_commands)
+            if not os.path.isdir(compile_commands):
+                compile_commands = os.path.dirname(compile_commands)
+            self._database = CompilationDatabase.fromDirectory(compile_commands)
+        self._header = str(config.get_value('smart', 'precompiledHeader', ''))
+        self._pch_dir: Optional[str] = None
+        self._file_args: Dict[str, Tuple[str, ...]] = {}
+
+    def file_args(self, path: Optional[str]) -> Tuple[str, ...]:
+        """ The arguments from the compile command of the file at the given path in the repository, if any. """
+        if path is None or self._database is None:
+            return ()
+        if path not in self._file_args:
+            absolute_path = os.path.join(self.repo.working_dir, path)
+            # For files missing from the database (e.g. headers), libclang infers a command from similar files.
+            commands = self._database.getCompileCommands(absolute_path)
+            args = []
+            if commands:
+                command = next(iter(commands))
+                skip = False
+                path_follows = False
+                for arg in list(command.arguments)[1:]:
+                    if skip:
+                        skip = False
+                    elif arg in _IGNORED_COMPILE_ARGS:
+                        skip = _IGNORED_COMPILE_ARGS[arg]
+                    elif path_follows:
+                        path_follows = False
+                        args.append(os.path.join(command.directory, arg))
+                    elif arg in _PATH_ARGS:
+                        path_follows = True
+                        args.append(arg)
+                    elif arg.startswith(_PATH_ARGS):
+                        option = next(option for option in _PATH_ARGS if arg.startswith(option))
+                        args.append(option + os.path.join(command.directory, arg[len(option):]))
+                    elif os.path.normpath(os.path.join(command.directory, arg)) != os.path.normpath(absolute_path):
+                        args.append(arg)
+            self._file_args[path] = tuple(args)
+        return self._file_args[path]
+
+    def _precompiled_header_args(self, index: Index) -> Tuple[str, ...]:
+        if not self._header:
+            return ()
+        if self._pch_dir is None:
+            self._pch_dir = tempfile.mkdtemp(prefix='smart-git-pch-')
+            header = index.parse(os.path.join(self.repo.working_dir, self._header),
+                                 args=['-x', 'c-header', *self.args, *self.file_args(self._header)],
+                                 options=TranslationUnit.PARSE_INCOMPLETE)
+            header.save(os.path.join(self._pch_dir, 'header.pch'))
+        return '-include-pch', os.path.join(self._pch_dir, 'header.pch')
+
+    def args_for(self, index: Index, path: Optional[str], profile: ParseProfile) -> List[str]:
+        """ All the arguments to parse the file at the given path in the repository with. """
+        return [*self.args, *self.file_args(path), *self._precompiled_header_args(index), *profile.args]
+
+    def close(self) -> None:
+        """ Delete the precompiled header. """
+        if self._pch_dir is not None:
+            shutil.rmtree(self._pch_dir, ignore_errors=True)
+            self._pch_dir = None
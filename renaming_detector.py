@@ -1,10 +1,14 @@
-from typing import List, Dict
+from typing import List, Dict, TYPE_CHECKING
 
 import clang.cindex
 
 from cursor_path import CursorPath
+from parse_options import ParseProfile, FULL
 from utils.ast import search_ast
 
+if TYPE_CHECKING:
+    from smart_repo import SmartRepo
+
 """
 For mac clanglib.so should be under:
 "/Applications/Xcode.app/Contents/Developer/Toolchains/XcodeDefault.xctoolchain/usr/lib/"
@@ -12,14 +16,15 @@ For mac clanglib.so should be under:
 
 
 class RenamingDetector:
-    def __init__(self, index: clang.cindex.Index):
-        self.index = index
+    def __init__(self, repo: 'SmartRepo', profile: ParseProfile = FULL):
+        self.repo = repo
+        self.profile = profile
 
     def get_renamed_variables(self, file_name: str, first_file: str, second_file: str):
         def is_variable_definition(cursor):
             return cursor.is_definition and cursor.kind == clang.cindex.CursorKind.VAR_DECL
-        first_tu = self.index.parse(first_file)
-        second_tu = self.index.parse(second_file)
+        first_tu = self.repo.parse(first_file, file_name, self.profile)
+        second_tu = self.repo.parse(second_file, file_name, self.profile)
         return self.match_renamed_variables(file_name, first_tu,
                                             list(search_ast(first_tu, file_name, is_variable_definition)), second_tu,
                                             list(search_ast(second_tu, file_name, is_variable_definition)))
@@ -30,17 +35,21 @@ class RenamingDetector:
         a_mismatches = set(a_vars) - set(b_vars)
         b_mismatches = set(b_vars) - set(a_vars)
         possible_renames = {
-            variable: {candidate for candidate in b_mismatches if candidate.path[:-1] == variable.path[:-1]}
+            variable: {candidate for candidate in b_mismatches if candidate.parent is variable.parent}
             for variable in a_mismatches
         }
 
+        a_cursors = CursorPath.locate_many(a_tu, possible_renames, file_name)
+        b_cursors = CursorPath.locate_many(b_tu, set().union(*possible_renames.values()), file_name)
+
         def is_rename(a: CursorPath, b: CursorPath):
-            var_a = a.locate(a_tu, file_name)
-            var_b = b.locate(b_tu, file_name)
+            var_a, var_b = a_cursors[a], b_cursors[b]
+            if isinstance(var_a, KeyError) or isinstance(var_b, KeyError):
+                return False
             return var_a.spelling != var_b.spelling and var_a.type.spelling == var_b.type.spelling
 
         actual_renames = {variable: {candidate for candidate in candidates if is_rename(variable, candidate)}
                           for variable, candidates in possible_renames.items()}
 
-        return {variable: next(iter(candidates)).locate(b_tu, file_name).spelling
+        return {variable: b_cursors[next(iter(candidates))].spelling
                 for variable, candidates in actual_renames.items() if len(candidates) == 1}
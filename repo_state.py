@@ -1,18 +1,29 @@
 import abc
+import os
+from collections import OrderedDict
 from io import BytesIO
-from typing import Tuple, List, Callable, Optional
+from typing import Tuple, List, Callable, Optional, BinaryIO, Sequence
 
 import git
+from clang.cindex import TranslationUnit
 from gitdb import IStream
 
+import tracing
+from parse_options import ParseProfile, FULL
 from smart_repo import SmartRepo
-from utils.file import file_from_text
+
+
+# The number of translation units each repo state keeps alive, to be reparsed after their files are edited.
+LIVE_TRANSLATION_UNITS = 8
 
 
 class RepoState(metaclass=abc.ABCMeta):
 
     def __init__(self, repo: SmartRepo):
         self.repo = repo
+        # The most recently used translation units by (file name, profile name), with the contents they were parsed
+        # from.
+        self._translation_units: 'OrderedDict[Tuple[str, str], Tuple[TranslationUnit, bytes]]' = OrderedDict()
 
     @abc.abstractmethod
     def __setitem__(self, file_name: str, contents: List[bytes]):
@@ -24,10 +35,27 @@ class RepoState(metaclass=abc.ABCMeta):
         """ Return the contents of the given file as a list of lines (with line endings). """
         raise NotImplementedError
 
-    def ast(self, file_name: str):
-        """ Return the parsed AST of the given file """
-        with file_from_text(self[file_name], path=file_name) as file:
-            return self.repo.get_cindex().parse(file.name)
+    def ast(self, file_name: str, profile: ParseProfile = FULL) -> TranslationUnit:
+        """
+        Return the parsed AST of the given file.
+
+        The translation unit is kept alive, and reparsed in place once the file is edited, which is much cheaper than
+        parsing it again. So it (and its cursors) are only valid until the next call for the same file.
+        """
+        key = file_name, profile.name
+        contents = b''.join(self[file_name])
+        live = self._translation_units.pop(key, None)
+        if live is not None:
+            translation_unit, parsed_contents = live
+            if parsed_contents != contents and not self.repo.reparse(translation_unit, contents, file_name):
+                live = None
+        if live is None:
+            translation_unit = self.repo.parse(os.path.join(self.repo.working_dir, file_name), file_name, profile,
+                                               contents)
+        self._translation_units[key] = translation_unit, contents
+        if len(self._translation_units) > LIVE_TRANSLATION_UNITS:
+            self._translation_units.popitem(last=False)
+        return translation_unit
 
     @abc.abstractmethod
     def rename(self, from_name: str, to_name: str) -> None:
@@ -39,21 +67,23 @@ class RepoState(metaclass=abc.ABCMeta):
 
 
 class SingleFileRepoState(RepoState):
+    """ The contents of a single file, kept in the content store's shared buffers (see `ContentStore.intern`). """
 
-    def __init__(self, repo: SmartRepo, path: str, content: Optional[List[bytes]]=None):
+    def __init__(self, repo: SmartRepo, path: str, content: Optional[Sequence[bytes]]=None):
         super(SingleFileRepoState, self).__init__(repo)
         self.path = path
-        self.content = content
+        self.content = None if content is None else repo.content_store.intern(content)
 
     def __setitem__(self, file_name: str, contents: List[bytes]):
         if file_name != self.path:
             raise KeyError(f'Only writes to {self.path} are supported.')
-        self.content = contents
+        self.content = self.repo.content_store.intern(contents)
 
     def __getitem__(self, file_name: str) -> List[bytes]:
         if file_name != self.path:
             raise KeyError(f'Only reads from {self.path} are supported.')
-        return self.content
+        # A list of views of the buffer's lines, which callers may edit without copying the lines themselves.
+        return None if self.content is None else list(self.content)
 
     def rename(self, from_name: str, to_name: str) -> None:
         raise NotImplementedError(f'Renaming not supported in {self.__class__.__name__}')
@@ -87,12 +117,19 @@ class TreeBackedRepoState(RepoState):
         return tree, tokens[-1]
 
     def __setitem__(self, file_name: str, contents: List[bytes]):
-        tree, name = self._get_subtree(file_name)
-        content = b''.join(contents)
-        self.tree = self._modify(self.tree, lambda t: t.add(self.tree.repo.odb.store(IStream(git.Blob.type,
-                                                                                             len(content),
-                                                                                             BytesIO(content))).binsha,
-                                                            git.Blob.file_mode, name, force=True))
+        with tracing.span('write', path=file_name):
+            tree, name = self._get_subtree(file_name)
+            content = b''.join(contents)
+            binsha = self.tree.repo.odb.store(IStream(git.Blob.type, len(content), BytesIO(content))).binsha
+            self.repo.content_store.add(binsha, content)
+            self.tree = self._modify(self.tree, lambda t: t.add(binsha, git.Blob.file_mode, name, force=True))
+
+    def write_stream(self, file_name: str, stream: BinaryIO, size: int) -> None:
+        """ Create/change the contents of a file, reading them from a stream instead of holding them in memory. """
+        with tracing.span('write', path=file_name):
+            tree, name = self._get_subtree(file_name)
+            binsha = self.tree.repo.odb.store(IStream(git.Blob.type, size, stream)).binsha
+            self.tree = self._modify(self.tree, lambda t: t.add(binsha, git.Blob.file_mode, name, force=True))
 
     @staticmethod
     def _modify(tree: git.Tree, modifier: Callable[[git.TreeModifier], None]):
@@ -111,17 +148,19 @@ class TreeBackedRepoState(RepoState):
         return new_tree
 
     def __getitem__(self, file_name: str) -> List[bytes]:
-        return self.tree[file_name].data_stream.read().splitlines(keepends=True)
+        return self.repo.content_store.lines(self.tree[file_name])
 
     def rename(self, from_name: str, to_name: str) -> None:
         """ Rename a file. """
-        binsha = self.tree[from_name].binsha
-        del self[from_name]
-        tree, name = self._get_subtree(to_name)
-        self.tree = self._modify(self.tree, lambda t: t.add(binsha, git.Blob.file_mode, name))
+        with tracing.span('rename', path=from_name, to_path=to_name):
+            binsha = self.tree[from_name].binsha
+            del self[from_name]
+            tree, name = self._get_subtree(to_name)
+            self.tree = self._modify(self.tree, lambda t: t.add(binsha, git.Blob.file_mode, name))
 
     def __delitem__(self, file_name: str):
-        tree, name = self._get_subtree(file_name)
-        self.tree = self._modify(self.tree, lambda t: t.__delitem__(name))
+        with tracing.span('delete', path=file_name):
+            tree, name = self._get_subtree(file_name)
+            self.tree = self._modify(self.tree, lambda t: t.__delitem__(name))
 
 
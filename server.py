@@ -0,0 +1,84 @@
+import json
+import os
+import socket
+import socketserver
+import traceback
+from contextlib import contextmanager
+from typing import List, Dict, Any
+
+from click.testing import CliRunner
+
+from smart_git_client import socket_path, FORWARDED_ENV_PREFIXES
+from smart_repo import SmartRepo, stats
+
+
+@contextmanager
+def _request_environment(cwd: str, env: Dict[str, str]):
+    """ Temporarily take on the working directory and git (and smart git) environment variables of a client. """
+    previous_cwd = os.getcwd()
+    previous_env = {key: value for key, value in os.environ.items() if key.startswith(FORWARDED_ENV_PREFIXES)}
+    os.chdir(cwd)
+    for key in previous_env:
+        del os.environ[key]
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.chdir(previous_cwd)
+        for key in env:
+            del os.environ[key]
+        os.environ.update(previous_env)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        response = self.server.run(request['argv'], request['cwd'], request['env'])
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class SmartGitServer(socketserver.UnixStreamServer):
+    """
+    Serves smart git commands forwarded by smart_git_client over a Unix socket inside the repository's git directory.
+
+    Requests are handled one at a time, in-process, so that the imported modules, the clang index and the repository
+    handles stay warm between commits.
+    """
+
+    def __init__(self, repo_path: str):
+        path = socket_path(repo_path)
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                # A leftover from a server that did not shut down cleanly.
+                os.remove(path)
+            else:
+                raise RuntimeError(f'A smart git server is already listening on {path}')
+            finally:
+                probe.close()
+        SmartRepo.keep_open()
+        super(SmartGitServer, self).__init__(path, _RequestHandler)
+
+    @staticmethod
+    def run(argv: List[str], cwd: str, env: Dict[str, str]) -> Dict[str, Any]:
+        """ Run a smart git command as if it was invoked by the client, and return its exit code and output. """
+        import smart_git
+        with _request_environment(cwd, env):
+            try:
+                result = CliRunner(mix_stderr=False).invoke(smart_git.smart_git, argv)
+            finally:
+                SmartRepo.end_sessions()
+                stats.clear()
+        stderr = (result.stderr_bytes or b'').decode(result.runner.charset, 'replace')
+        if result.exception is not None and not isinstance(result.exception, SystemExit):
+            stderr += ''.join(traceback.format_exception(*result.exc_info))
+        return {'exit_code': result.exit_code, 'stdout': result.stdout, 'stderr': stderr}
+
+    def server_close(self):
+        super(SmartGitServer, self).server_close()
+        SmartRepo.release_open()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
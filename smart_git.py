@@ -1,23 +1,19 @@
 import configparser
-import difflib
 import functools
-import json
 import os
 import re
+import stat
 import sys
 from enum import Enum
-from typing import List
+from typing import List, Optional, Dict, TYPE_CHECKING
 
 import click
-import git
-import git.repo.fun
-import unidiff
 
-from changes import CHANGE_CLASSES
-from changes.change import Change
-from repo_state import RepoState, TreeBackedRepoState
-from smart_repo import SmartRepo
-from utils.repo import get_changes, CHANGES_FILE_NAME, decode_changes_line, encode_changes_line, encode_changes
+if TYPE_CHECKING:
+    from smart_repo import SmartRepo
+
+# Heavy dependencies (GitPython, clang and everything under changes/) are imported inside the commands that
+# need them, so that cheap commands such as `status` start quickly.
 
 # The SHA1 hash of the 'empty commit' - a magic commit that exists in all git repos
 EMPTY_COMMIT_SHA = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
@@ -29,20 +25,55 @@ def path_for_git(path: str):
 
 PYTHON_PATH = path_for_git(sys.executable)
 
-ALIAS_COMMAND = f'!{PYTHON_PATH} {path_for_git(__file__)}'
+# Hooks and the alias go through the thin client, which forwards requests to `git smart serve` when it is running.
+CLIENT_PATH = path_for_git(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smart_git_client.py'))
+
+ALIAS_COMMAND = f'!{PYTHON_PATH} {CLIENT_PATH}'
+
+PRE_COMMIT_HOOK = f'{PYTHON_PATH} {CLIENT_PATH} pre-commit'
+
+POST_COMMIT_HOOK = f'{PYTHON_PATH} {CLIENT_PATH} post-commit'
+
+HOOKS = (('pre-commit', PRE_COMMIT_HOOK), ('post-commit', POST_COMMIT_HOOK))
 
-PRE_COMMIT_HOOK = f'{PYTHON_PATH} {path_for_git(__file__)} pre-commit'
+# The pre-commit hook that earlier versions installed, which ran this module directly (see `_migrate_hooks`).
+LEGACY_PRE_COMMIT_HOOK = f'{PYTHON_PATH} {path_for_git(__file__)} pre-commit'
+
+
+def _write_stats(path: str) -> None:
+    """ Dump the counters of expensive operations performed by this invocation as JSON. """
+    import json
+    # Commands that never touched a repository don't have anything to report, and shouldn't pay for importing one.
+    smart_repo_module = sys.modules.get('smart_repo')
+    with open(path, 'w') as stats_file:
+        json.dump(dict(smart_repo_module.stats) if smart_repo_module is not None else {}, stats_file)
 
 
 @click.group('main')
-def smart_git():
+@click.option('--trace', 'trace_path', type=click.Path(dir_okay=False, writable=True), envvar='SMART_GIT_TRACE',
+              help='Write a Chrome trace-event JSON of the phases of the command to this file.')
+@click.pass_context
+def smart_git(ctx: click.Context, trace_path: Optional[str]):
     """
     A git plugin that helps resolve merge conflicts using semantic analysis of changes on the commit level.
 
     Start by using set-alias to register a shortcut for accessing the plugin (via 'git smart <command>'), then install
     the plugin on the target repository using 'git smart install [<path-to-repo>].
+
+    Set SMART_GIT_STATS to a file path to have the command write counters of expensive operations (e.g. clang parses)
+    to it as JSON.
+
+    Set SMART_GIT_TRACE (or pass --trace) to a file path to have the command write a trace of its phases (detectors,
+    clang parses, transforms, applies, tree writes and git calls) to it, in the Chrome trace-event format that
+    chrome://tracing and Perfetto load.
     """
-    pass
+    stats_path = os.environ.get('SMART_GIT_STATS')
+    if stats_path:
+        ctx.call_on_close(functools.partial(_write_stats, stats_path))
+    if trace_path:
+        import tracing
+        tracing.enable()
+        ctx.call_on_close(functools.partial(tracing.write, trace_path))
 
 
 repo_path_argument = click.argument('repo_path',
@@ -50,6 +81,92 @@ repo_path_argument = click.argument('repo_path',
                                     default='.')
 
 
+def _read_smart_enabled(git_dir: str) -> Optional[bool]:
+    """
+    Read the smart.enabled value straight from the repository's config file.
+
+    :return: the configured value, or None if it is not set.
+    """
+    try:
+        with open(os.path.join(git_dir, 'config'), encoding='utf-8', errors='replace') as config_file:
+            lines = config_file.read().splitlines()
+    except OSError:
+        return None
+    value = None
+    in_smart_section = False
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            section, _, rest = line[1:].partition(']')
+            in_smart_section = section.strip().lower() == 'smart'
+            line = rest.strip()
+        if not in_smart_section or not line or line[0] in '#;':
+            continue
+        key, has_value, raw_value = line.partition('=')
+        if key.strip().lower() != 'enabled':
+            continue
+        raw_value = raw_value.strip().strip('"').strip().lower() if has_value else 'true'
+        value = raw_value in ('true', 'yes', 'on', '1')
+    return value
+
+
+def _read_hook(git_dir: str, hook_name: str) -> str:
+    """ The text of one of the repository's hooks, empty if it has none. """
+    try:
+        with open(os.path.join(git_dir, 'hooks', hook_name)) as hook:
+            return hook.read()
+    except OSError:
+        return ''
+
+
+def _write_hook(git_dir: str, hook_name: str, command: str) -> None:
+    """ Append a command to one of the repository's hooks (creating it if needed), and make it executable. """
+    hook_path = os.path.join(git_dir, 'hooks', hook_name)
+    if os.path.isfile(hook_path):
+        hook = open(hook_path, 'a+')
+    else:
+        hook = open(hook_path, 'w')
+        hook.write('#!/bin/sh\n')
+    hook.write(command)
+    hook.close()
+    os.chmod(hook_path, os.stat(hook_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def _has_outdated_hooks(git_dir: str) -> bool:
+    """
+    Whether an earlier version installed the plugin on the repository: its pre-commit hook may run this module directly
+    rather than through the client, and it has no post-commit hook. `git smart upgrade-hooks` brings them up to date.
+    """
+    pre_commit_hook = _read_hook(git_dir, 'pre-commit')
+    return _read_smart_enabled(git_dir) is not None \
+        and (LEGACY_PRE_COMMIT_HOOK in pre_commit_hook or PRE_COMMIT_HOOK in pre_commit_hook) \
+        and not all(command in _read_hook(git_dir, hook_name) for hook_name, command in HOOKS)
+
+
+def _migrate_hooks(git_dir: str) -> None:
+    """
+    Bring the hooks of a repository that an earlier version installed the plugin on up to date: the pre-commit hook
+    goes through the client, and the post-commit hook (which didn't exist) is added.
+    """
+    pre_commit_hook = _read_hook(git_dir, 'pre-commit')
+    if LEGACY_PRE_COMMIT_HOOK in pre_commit_hook and PRE_COMMIT_HOOK not in pre_commit_hook:
+        with open(os.path.join(git_dir, 'hooks', 'pre-commit'), 'w') as hook:
+            hook.write(pre_commit_hook.replace(LEGACY_PRE_COMMIT_HOOK, PRE_COMMIT_HOOK))
+    elif PRE_COMMIT_HOOK not in pre_commit_hook:
+        # Not installed by us.
+        return
+    if POST_COMMIT_HOOK not in _read_hook(git_dir, 'post-commit'):
+        _write_hook(git_dir, 'post-commit', POST_COMMIT_HOOK)
+
+
+def _status_cache() -> Optional[Dict[str, 'RepoStatus']]:
+    """ The RepoStatus memo of the current command invocation, or None when running outside of one. """
+    context = click.get_current_context(silent=True)
+    if context is None:
+        return None
+    return context.find_root().meta.setdefault('smart_git.status', {})
+
+
 class RepoStatus(Enum):
     """ Denotes the status of the repo w.r.t. our plugin. """
 
@@ -61,34 +178,46 @@ class RepoStatus(Enum):
 
     @classmethod
     def of(cls, repo_path: str):
-        if not git.repo.fun.is_git_dir(os.path.join(os.path.abspath(repo_path), '.git')):
-            return RepoStatus.not_a_repo
-        # noinspection PyBroadException
-        try:
-            repo = git.Repo(repo_path)
-        except Exception:
+        """
+        Find the status of the repository at repo_path.
+
+        The status is memoized for the rest of the command invocation; commands that change it should call `forget`.
+        """
+        repo_path = os.path.abspath(repo_path)
+        cache = _status_cache()
+        if cache is not None and repo_path in cache:
+            return cache[repo_path]
+        status = cls._read(repo_path)
+        if cache is not None:
+            cache[repo_path] = status
+        return status
+
+    @classmethod
+    def forget(cls, repo_path: str) -> None:
+        """ Drop the memoized status of the repository at repo_path. """
+        cache = _status_cache()
+        if cache is not None:
+            cache.pop(os.path.abspath(repo_path), None)
+
+    @classmethod
+    def _read(cls, repo_path: str):
+        git_dir = os.path.join(repo_path, '.git')
+        if not (os.path.isfile(os.path.join(git_dir, 'HEAD')) and os.path.isdir(os.path.join(git_dir, 'objects'))
+                and os.path.isdir(os.path.join(git_dir, 'refs'))):
             return RepoStatus.not_a_repo
-        config_reader = repo.config_reader()
-        try:
-            config_value = config_reader.get_value('smart', 'enabled', None)
-        except configparser.NoSectionError:
-            config_value = None
-        finally:
-            del config_reader
+        config_value = _read_smart_enabled(git_dir)
         has_config_value = config_value is not None
-        pre_commit_hook_path = os.path.join(repo_path, '.git', 'hooks', 'pre-commit')
-        has_pre_commit_hook = os.path.isfile(pre_commit_hook_path) and PRE_COMMIT_HOOK in open(
-            pre_commit_hook_path).read()
-        if has_config_value != has_pre_commit_hook:
-            return RepoStatus.bad_installation
+        has_hooks = [command in _read_hook(git_dir, hook_name) for hook_name, command in HOOKS]
         if not has_config_value:
-            return RepoStatus.not_installed
+            return RepoStatus.bad_installation if any(has_hooks) else RepoStatus.not_installed
+        if not all(has_hooks):
+            return RepoStatus.bad_installation
         if config_value:
             return RepoStatus.installed_enabled
         return RepoStatus.installed_disabled
 
 
-def get_repo(repo_path: str, *expected_statuses: RepoStatus) -> (SmartRepo, RepoStatus):
+def get_repo(repo_path: str, *expected_statuses: RepoStatus) -> ('SmartRepo', RepoStatus):
     """
     Open a GitPython Repo object for the given repository path.
 
@@ -108,8 +237,16 @@ def get_repo(repo_path: str, *expected_statuses: RepoStatus) -> (SmartRepo, Repo
             ),
             err=True
         )
+        _echo_upgrade_hint(repo_path)
         raise click.Abort
-    return SmartRepo(repo_path), current_status
+    from smart_repo import SmartRepo
+    return SmartRepo.open(repo_path), current_status
+
+
+def _echo_upgrade_hint(repo_path: str) -> None:
+    if _has_outdated_hooks(os.path.join(repo_path, '.git')):
+        click.echo("The hooks were installed by an earlier version, run 'git smart upgrade-hooks' to upgrade them",
+                   err=True)
 
 
 def print_post_status(command):
@@ -128,6 +265,7 @@ def print_post_status(command):
 def print_status(repo_path: str):
     """ Check the status of the repository with respect to the smart git plugin. """
     click.echo(RepoStatus.of(repo_path).name)
+    _echo_upgrade_hint(repo_path)
 
 
 @smart_git.command()
@@ -141,14 +279,10 @@ def install(repo_path: str, libclang_path: str):
     config_writer.add_section('smart')
     config_writer.set_value('smart', 'enabled', True)
     config_writer.set_value('smart', 'libclangPath', repr(libclang_path))
-    pre_commit_hook_path = os.path.join(repo_path, '.git', 'hooks', 'pre-commit')
-    if os.path.isfile(pre_commit_hook_path):
-        pre_commit_hook = open(pre_commit_hook_path, 'a+')
-    else:
-        pre_commit_hook = open(pre_commit_hook_path, 'w')
-        pre_commit_hook.write('#!/bin/sh\n')
-    pre_commit_hook.write(PRE_COMMIT_HOOK)
-    pre_commit_hook.close()
+    config_writer.release()
+    for hook_name, command in HOOKS:
+        _write_hook(os.path.join(repo_path, '.git'), hook_name, command)
+    RepoStatus.forget(repo_path)
 
 
 @smart_git.command()
@@ -160,17 +294,20 @@ def uninstall(repo_path: str):
 
     This will also remove any traces of bad installations.
     """
+    import git
     get_repo(repo_path, RepoStatus.installed_disabled, RepoStatus.installed_enabled, RepoStatus.bad_installation)
     try:
         git.Git(repo_path).config('--remove-section', 'smart')
     except configparser.NoSectionError:
         pass
-    pre_commit_hook_path = os.path.join(repo_path, '.git', 'hooks', 'pre-commit')
-    if os.path.isfile(pre_commit_hook_path):
-        lines = open(pre_commit_hook_path, 'r').read().splitlines()
-        if any('smart_git' in line for line in lines):
-            with open(pre_commit_hook_path, 'w') as pre_commit_hook:
-                pre_commit_hook.write('\n'.join(line for line in lines if 'smart_git' not in line))
+    for hook_name, _ in HOOKS:
+        hook_path = os.path.join(repo_path, '.git', 'hooks', hook_name)
+        if os.path.isfile(hook_path):
+            lines = open(hook_path, 'r').read().splitlines()
+            if any('smart_git' in line for line in lines):
+                with open(hook_path, 'w') as hook:
+                    hook.write('\n'.join(line for line in lines if 'smart_git' not in line))
+    RepoStatus.forget(repo_path)
 
 
 @smart_git.command()
@@ -183,6 +320,22 @@ def reinstall(ctx: click.Context, repo_path: str):
     ctx.invoke(install, repo_path=repo_path, silent=True)
 
 
+@smart_git.command('upgrade-hooks')
+@repo_path_argument
+@print_post_status
+def upgrade_hooks(repo_path: str):
+    """
+    Upgrade the hooks that an earlier version installed on the given repository, keeping its configuration.
+
+    The pre-commit hook is rewritten to go through the client, and the post-commit hook is added.
+    """
+    if not _has_outdated_hooks(os.path.join(repo_path, '.git')):
+        click.echo(f'{repo_path} has no hooks of an earlier installation to upgrade', err=True)
+        raise click.Abort
+    _migrate_hooks(os.path.join(repo_path, '.git'))
+    RepoStatus.forget(repo_path)
+
+
 @smart_git.command('set-alias')
 @click.option('--local', default=False, is_flag=True)
 def set_alias(local):
@@ -196,6 +349,7 @@ def set_alias(local):
 
     :param local: If passed, will only set the alias for the repository at the current directory.
     """
+    import git
     try:
         git.Git('.').config('--global' if not local else '--local', 'alias.smart')
     except git.GitCommandError:
@@ -218,6 +372,7 @@ def clear_alias(local, force):
     :param force: If passed, will also clear the alias in case it is mapped to another (possibly old version or
                   user-defined) command.
     """
+    import git
     try:
         current_alias = git.Git('.').config('--global' if not local else '--local', 'alias.smart')
     except git.GitCommandError:
@@ -239,7 +394,10 @@ def disable(repo_path: str):
 
     This will disable any git hooks set by the plugin from running.
     """
-    get_repo(repo_path, RepoStatus.installed_enabled)[0].config_writer().set_value('smart', 'enabled', False)
+    config_writer = get_repo(repo_path, RepoStatus.installed_enabled)[0].config_writer()
+    config_writer.set_value('smart', 'enabled', False)
+    config_writer.release()
+    RepoStatus.forget(repo_path)
 
 
 @smart_git.command()
@@ -251,45 +409,200 @@ def enable(repo_path: str):
 
     This will enable all git hooks set by the plugin.
     """
-    get_repo(repo_path, RepoStatus.installed_disabled)[0].config_writer().set_value('smart', 'enabled', True)
+    config_writer = get_repo(repo_path, RepoStatus.installed_disabled)[0].config_writer()
+    config_writer.set_value('smart', 'enabled', True)
+    config_writer.release()
+    RepoStatus.forget(repo_path)
+
+
+@smart_git.command()
+@repo_path_argument
+@click.argument('revisions', nargs=-1, required=True, type=click.STRING)
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of worker processes to rebase changes to different files in.')
+def merge(repo_path: str, revisions: List[str], jobs: int):
+    """
+    Merge one or more revisions into HEAD.
+
+    The changes of every revision are rebased onto HEAD in a single pass, and recorded as one merge commit whose parents
+    are HEAD and all the given revisions. With several jobs, changes to unrelated files are rebased in parallel.
+    """
+    import git
+    from change_log import change_log, MissingChangeLog
+    from repo_state import TreeBackedRepoState
+    from smart_merge import MergeSession
+    from tracing import span
+
+    repo, _ = get_repo(repo_path, RepoStatus.installed_enabled)
+    revs = []
+    for revision in revisions:
+        rev = repo.rev_parse(revision)
+        assert isinstance(rev, git.Commit)
+        revs.append(rev)
+    head_commit = repo.head.commit
+    head_tree = head_commit.tree
+    log = change_log(repo)
+    try:
+        start, head_log, logs = log.merge_logs(head_commit, list(zip(revisions, revs)))
+    except MissingChangeLog as e:
+        raise click.ClickException(f'{e.revision} has no change log.')
+    # Intermediate trees and blobs are kept in memory, only the merged tree is written to disk. The change logs are
+    # streamed rather than loaded as a whole.
+    with MergeSession(repo, TreeBackedRepoState(repo, head_tree), head_log, start) as session:
+        with repo.overlay_odb() as odb:
+            for i, (revision, rev_log) in enumerate(zip(revisions, logs)):
+                with span('merge', revision=revision):
+                    session.merge(rev_log, remember=i < len(revs) - 1, jobs=jobs)
+            log.stage_merge(session)
+            state = session.state
+            with span('persist'):
+                odb.persist(state.tree.binsha)
+        if len(revisions) == 1:
+            message = f"Smart merge branch '{revisions[0]}' into {repo.head.reference.name}"
+        else:
+            message = f"Smart merge branches {', '.join(repr(revision) for revision in revisions)} into " \
+                      f"{repo.head.reference.name}"
+        merge_commit = git.Commit.create_from_tree(repo, state.tree, message, parent_commits=[head_commit] + revs,
+                                                   head=True)
+        log.commit_merge(merge_commit, session)
+    # Only the files changed by the merge are written, the rest of the index and working tree is left untouched.
+    with span('checkout'):
+        repo.checkout_changes(head_tree, state.tree)
+
+
+@smart_git.command()
+@repo_path_argument
+@click.argument('upstream', type=click.STRING)
+def rebase(repo_path: str, upstream: str):
+    """
+    Rebase the current branch onto UPSTREAM.
+
+    The recorded changes of every commit of the branch are replayed on top of UPSTREAM, transformed over the changes
+    they are missing, without checking out any commit. One commit is written per original commit, the branch is moved
+    once they are all written (keeping the original one as ORIG_HEAD), and only the final result is checked out.
+    """
+    from change_log import MissingChangeLog
+    from changes.change import Conflict
+    from smart_rebase import rebase as rebase_branch, NotRecorded
+
+    repo, _ = get_repo(repo_path, RepoStatus.installed_enabled)
+    if repo.is_dirty():
+        raise click.ClickException('Commit or stash your changes before rebasing.')
+    try:
+        result = rebase_branch(repo, upstream)
+    except MissingChangeLog as e:
+        raise click.ClickException(f'{e.revision} has no change log.')
+    except NotRecorded as e:
+        raise click.ClickException(f'{e.commit.hexsha[:7]} has no recorded changes, it cannot be replayed.')
+    except Conflict:
+        raise click.ClickException(f'The branch conflicts with {upstream}, nothing was rebased.')
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if result.rebased == result.original:
+        click.echo(f'[smart-git] The branch is up to date with {upstream}.')
+    elif not result.commits:
+        click.echo(f'[smart-git] Fast-forwarded the branch to {upstream}.')
+    else:
+        click.echo(f'[smart-git] Rebased {len(result.commits)} commit{"" if len(result.commits) == 1 else "s"} onto '
+                   f'{upstream}.')
 
 
 @smart_git.command()
 @repo_path_argument
-@click.argument('revision', type=click.STRING)
-def merge(repo_path: str, revision: str):
+@click.argument('revisions', nargs=-1, required=True, type=click.STRING)
+@click.option('--json', 'as_json', is_flag=True, default=False, help='Print the results as JSON.')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=os.cpu_count() or 1, show_default=True,
+              help='Number of worker processes.')
+def check(repo_path: str, revisions: List[str], as_json: bool, jobs: int):
+    """
+    Check which revisions would merge cleanly into HEAD.
+
+    Nothing is written: only the transform phase of the merge runs, in memory, and the conflicting changes of each
+    revision are reported. Revisions are checked in parallel. Exits with status 1 if any revision conflicts or can't be
+    merged at all.
+    """
+    import json
+    from smart_merge import check as check_revision
+    from utils.workers import map_in_workers
+
     repo, _ = get_repo(repo_path, RepoStatus.installed_enabled)
-    rev = repo.rev_parse(revision)
-    assert isinstance(rev, git.Commit)
-    changes_diff: git.Diff = next(diff for diff in repo.index.diff(revision) if diff.a_path == CHANGES_FILE_NAME)
-    a_changes = changes_diff.a_blob.data_stream.read().splitlines(keepends=True)
-    b_changes = changes_diff.b_blob.data_stream.read().splitlines(keepends=True)
-    diff = unidiff.PatchSet.from_string(''.join(difflib.unified_diff([line.decode('utf-8') for line in a_changes],
-                                                                     [line.decode('utf-8') for line in b_changes],
-                                                                     fromfile=CHANGES_FILE_NAME,
-                                                                     tofile=CHANGES_FILE_NAME)))
-    total_changes = [decode_changes_line(repo, line)[1] for line in a_changes]
-    changes_to_rebase = [decode_changes_line(repo, line.value.encode('utf-8'))[1]
-                         for hunk in diff[0] for line in hunk if line.is_added]
-    missing_changes = [decode_changes_line(repo, line.value.encode('utf-8'))[1]
-                       for hunk in diff[0] for line in hunk if line.is_removed]
-    state = TreeBackedRepoState(repo, repo.head.commit.tree)
-    for change_list in changes_to_rebase:
-        transformed_changes = []
-        for change in change_list:
-            for missing_change_list in missing_changes:
-                for missing_change in missing_change_list:
-                    if change is not None:
-                        change = change.transform(repo, missing_change)
-            if change is not None:
-                transformed_changes.append(change)
-                change.apply(repo, state)
-        total_changes.append(transformed_changes)
-    state[CHANGES_FILE_NAME] = encode_changes(total_changes)
-    git.IndexFile.from_tree(repo, state.tree).write(repo.index.path)
-    repo.index.commit(f"Smart merge branch '{revision}' into {repo.head.reference.name}",
-                      parent_commits=(repo.head.commit, rev), skip_hooks=True)
-    repo.index.reset(head=True, working_tree=True)
+    head = repo.head.commit.hexsha
+    results = map_in_workers(repo, check_revision, [(head, revision) for revision in revisions], jobs)
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            if result['clean']:
+                click.echo(f"{result['revision']}: clean")
+                continue
+            if 'error' in result:
+                click.echo(f"{result['revision']}: cannot be merged, {result['error']}")
+                continue
+            click.echo(f"{result['revision']}: {len(result['conflicts'])} conflicting "
+                       f"change{'' if len(result['conflicts']) == 1 else 's'}")
+            for conflict in result['conflicts']:
+                change, other = conflict['change'], conflict['conflicts_with']
+                click.echo(f"    #{change['entry']} {change['type']} ({', '.join(change['paths'])}) conflicts with "
+                           f"#{other['entry']} {other['type']} ({', '.join(other['paths'])})")
+    if not all(result['clean'] for result in results):
+        sys.exit(1)
+
+
+@smart_git.command()
+@repo_path_argument
+@click.argument('revision_range', type=click.STRING)
+@click.option('--branch', help='Rewrite the commits onto this new branch, adding the change log to each of them.')
+@click.option('--notes', is_flag=True, default=False,
+              help='Attach the changes of each commit to it as a git note (under refs/notes/smart).')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=os.cpu_count() or 1, show_default=True,
+              help='Number of worker processes.')
+def backfill(repo_path: str, revision_range: str, branch: Optional[str], notes: bool, jobs: int):
+    """
+    Build the change log of existing commits.
+
+    Detects the changes of every commit in REVISION_RANGE (e.g. 'v1.0..master', following first parents) the same way
+    pre-commit does, spreading the commits across worker processes, and writes the resulting change log to a new
+    branch or to git notes.
+    """
+    if not branch and not notes:
+        raise click.UsageError('Pass --branch and/or --notes to choose where to write the change log.')
+    import backfill as backfill_module
+
+    repo, _ = get_repo(repo_path, RepoStatus.installed_disabled, RepoStatus.installed_enabled)
+    if branch and branch in repo.heads:
+        raise click.ClickException(f'Branch {branch} already exists.')
+    result = backfill_module.backfill(repo, revision_range, jobs)
+    if not result.commits:
+        click.echo(f'[smart-git] No commits in {revision_range}.', err=True)
+        return
+    click.echo(f'[smart-git] Processed {len(result.commits)} commit{"" if len(result.commits) == 1 else "s"} in '
+               f'{result.seconds:.2f}s ({result.commits_per_second:.2f} commits/s, {result.parses} parses, '
+               f'{result.parses_per_second:.2f} parses/s).', err=True)
+    if branch:
+        backfill_module.write_branch(repo, result, branch)
+        click.echo(f'[smart-git] Wrote the change log to branch {branch}.')
+    if notes:
+        written = backfill_module.write_notes(repo, result)
+        click.echo(f'[smart-git] Wrote {written} note{"" if written == 1 else "s"} to {backfill_module.NOTES_REF}.')
+
+
+@smart_git.command()
+@repo_path_argument
+def serve(repo_path: str):
+    """
+    Serve hook and merge requests for the given repository until interrupted.
+
+    While the server is running, the pre-commit hook and 'git smart merge' are forwarded to it instead of starting a new
+    Python process, which keeps the libclang index and the repository handles warm between commits.
+    """
+    get_repo(repo_path, RepoStatus.installed_disabled, RepoStatus.installed_enabled)
+    from server import SmartGitServer
+    with SmartGitServer(repo_path) as server:
+        click.echo(f'[smart-git] Serving {os.path.abspath(repo_path)} on {server.server_address}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
 
 
 @smart_git.command('pre-commit')
@@ -298,9 +611,14 @@ def pre_commit(repo_path: str):
     """
     This command should not normally be used directly.
 
-    This command will be ran before each commit, analyzing and recording the staged changes into the .changes auxiliary
-    file.
+    This command will be ran before each commit, analyzing and recording the staged changes into the change log (the
+    .changes auxiliary file, or a git note - see migrate-log).
     """
+    import git
+    from change_log import change_log
+    from detection_budget import DetectionBudget
+    from utils.repo import detect_changes
+
     repo, status = get_repo(repo_path, RepoStatus.installed_disabled, RepoStatus.installed_enabled)
     if status is RepoStatus.installed_disabled:
         return
@@ -311,52 +629,90 @@ def pre_commit(repo_path: str):
         diffed_tree = git.Tree.new_from_sha(repo, bytes.fromhex(EMPTY_COMMIT_SHA))
         diffed_tree.path = ''
 
-    changes = []
-    # Start with the previous repository state, and attempt to detect changes. When a change is detected, it is applied
-    # to the state and we attempt to detect changes in the new state.
-    state = TreeBackedRepoState(repo, diffed_tree)
-    while True:
-        diff = state.tree.diff()
-        if not diff:
-            break
-        for change_class in CHANGE_CLASSES:
-            new_changes: List[Change] = list(change_class.detect(repo, diff))
-            if new_changes:
-                changes.extend(new_changes)
-                applied_changes = []
-                while new_changes:
-                    change = new_changes.pop()
-                    for applied_change in applied_changes:
-                        change = change.transform(repo, applied_change)
-                        if change is None:
-                            break
-                    else:
-                        change.apply(repo, state)
-                        applied_changes.append(change)
-                break
-
-    if not changes:
-        return
-
-    changes_file_path = os.path.join(repo_path, CHANGES_FILE_NAME)
-    prev_changes = get_changes(repo)
+    budget = DetectionBudget(repo)
+    changes = detect_changes(repo, diffed_tree, budget=budget)
+    for fallback in budget.fallbacks:
+        click.echo(f'[smart-git] Recorded textual changes to {fallback.path}: {fallback.reason}.', err=True)
 
-    with open(changes_file_path, 'wb') as changes_file:
-        changes_file.write(b''.join(encode_changes(prev_changes + [changes])))
     try:
-        repo.index.add([CHANGES_FILE_NAME])
+        change_log(repo).record(changes)
     except OSError:
         # User might have run git commit -a, which locks the index, preventing us from adding the .changes file.
-        if prev_changes is None:
-            os.remove(changes_file_path)
-        else:
-            with open(changes_file_path, 'w') as changes_file:
-                changes_file.write(prev_changes)
         click.echo('[smart-git] ERROR: `git commit -a` is not currently supported with smart-git, please add the files '
                    'manually before committing (e.g. `git add .`)', err=True)
         raise click.Abort
 
-    click.echo(f'[smart-git] Recorded {len(changes)} change{"" if len(changes) == 1 else "s"}.')
+    if changes:
+        click.echo(f'[smart-git] Recorded {len(changes)} change{"" if len(changes) == 1 else "s"}.')
+
+
+@smart_git.command('post-commit')
+@repo_path_argument
+def post_commit(repo_path: str):
+    """
+    This command should not normally be used directly.
+
+    This command will be ran after each commit, attaching the changes recorded by pre-commit to the new commit when the
+    change log is stored in git notes.
+    """
+    from change_log import change_log
+
+    repo, status = get_repo(repo_path, RepoStatus.installed_disabled, RepoStatus.installed_enabled)
+    if status is RepoStatus.installed_disabled:
+        return
+    change_log(repo).committed(repo.head.commit)
+
+
+@smart_git.command('migrate-log')
+@repo_path_argument
+@click.argument('backend', type=click.Choice(['file', 'notes']))
+def migrate_log(repo_path: str, backend: str):
+    """
+    Move the change log to another storage backend.
+
+    'file' stores the change log in the tracked .changes file, 'notes' stores the changes of each commit as a git note
+    on it (under refs/notes/smart). Migrating to notes stages the deletion of the .changes file, migrating to a file
+    stages the file with HEAD's change log - commit them to complete the migration.
+    """
+    import change_log
+
+    repo, _ = get_repo(repo_path, RepoStatus.installed_disabled, RepoStatus.installed_enabled)
+    try:
+        migrated = change_log.migrate(repo, backend)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'[smart-git] Migrated {migrated} change log entr{"y" if migrated == 1 else "ies"} to {backend}.')
+
+
+@smart_git.command()
+@repo_path_argument
+@click.argument('commit', required=False, type=click.STRING)
+def compact(repo_path: str, commit: Optional[str]):
+    """
+    Fold old change log entries into a checkpoint.
+
+    The entries up to COMMIT (by default, the newest commit of the branch that all branches contain) are replaced by a
+    checkpoint, which merges and readers of the change log start from. Branches that don't contain COMMIT can't be
+    merged anymore. With the 'file' backend the compacted .changes file is staged - commit it to complete compaction.
+    Logs are also compacted when recording changes, past smart.compactThreshold entries.
+    """
+    import git
+    from change_log import change_log
+
+    repo, _ = get_repo(repo_path, RepoStatus.installed_disabled, RepoStatus.installed_enabled)
+    log = change_log(repo)
+    try:
+        onto = log.checkpoint() if commit is None else repo.commit(commit)
+    except git.BadName:
+        raise click.ClickException(f'Unknown commit {commit}.')
+    if onto is None:
+        raise click.ClickException('The branches share no history, there is nothing to compact.')
+    try:
+        count = log.compact(onto)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'[smart-git] Folded {count} change log entr{"y" if count == 1 else "ies"} into a checkpoint at '
+               f'{onto.hexsha[:7]}.')
 
 
 def main():
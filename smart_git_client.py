@@ -0,0 +1,79 @@
+"""
+A thin client for the smart git server (see `git smart serve`).
+
+Git hooks and the 'git smart' alias run this script instead of smart_git.py. It only imports from the standard library,
+so that forwarding a request to a running server costs little more than starting the interpreter. When no server is
+listening on the repository's socket, the full smart_git CLI is executed in-process instead.
+"""
+import json
+import os
+import socket
+import sys
+from typing import List, Optional, Tuple
+
+SOCKET_NAME = 'smart-git.sock'
+
+# Commands that are forwarded to a running server. All of them take the repository path as their first argument.
+FORWARDED_COMMANDS = ('pre-commit', 'post-commit', 'merge', 'rebase')
+
+# Environment variables with these prefixes are passed on to the server with each request.
+FORWARDED_ENV_PREFIXES = ('GIT_', 'SMART_GIT_')
+
+
+def socket_path(repo_path: str) -> str:
+    return os.path.join(os.path.abspath(repo_path), '.git', SOCKET_NAME)
+
+
+def request(argv: List[str]) -> Optional[Tuple[int, str, str]]:
+    """
+    Forward a smart git command to the server of the repository it operates on.
+
+    :param argv: the command line arguments of smart_git.py, starting with the command name.
+    :return: the exit code, stdout and stderr of the command, or None if no server is running for the repository.
+    """
+    if not argv or argv[0] not in FORWARDED_COMMANDS or not hasattr(socket, 'AF_UNIX'):
+        return None
+    command, args = argv[0], list(argv[1:])
+    positional = [i for i, arg in enumerate(args) if not arg.startswith('-')]
+    if positional:
+        args[positional[0]] = os.path.abspath(args[positional[0]])
+        repo_path = args[positional[0]]
+    else:
+        repo_path = os.path.abspath('.')
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except OSError:
+        return None
+    with connection:
+        try:
+            connection.connect(socket_path(repo_path))
+        except OSError:
+            return None
+        message = {'argv': [command] + args,
+                   'cwd': os.getcwd(),
+                   'env': {key: value for key, value in os.environ.items() if key.startswith(FORWARDED_ENV_PREFIXES)}}
+        with connection.makefile('rwb') as stream:
+            stream.write(json.dumps(message).encode('utf-8') + b'\n')
+            stream.flush()
+            response = stream.readline()
+    if not response:
+        return None
+    response = json.loads(response.decode('utf-8'))
+    return response['exit_code'], response['stdout'], response['stderr']
+
+
+def main():
+    response = request(sys.argv[1:])
+    if response is None:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import smart_git
+        smart_git.main()
+        return
+    exit_code, stdout, stderr = response
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,413 @@
+"""
+Merging change logs (see `git smart merge`).
+
+Change logs are append-only, so a revision's change log and HEAD's share a prefix and then diverge. The changes after
+that prefix in the revision's log are rebased onto HEAD: each of them is transformed against the changes after the
+prefix in HEAD's log (the changes the revision is missing), then applied. Several revisions are merged one after
+another into the same repo state, each against the change log that already includes the previous ones.
+
+The merge is a pipeline over change log lines: the shared prefix is copied without being decoded, and the revision's
+change sets are decoded, transformed, applied and re-encoded one at a time. Only the missing changes are held in
+memory, since every rebased change is transformed against them - and only those that may interact with the rebased
+ones, judging by the paths in the headers of the lines (see `interacting`), are decoded at all.
+
+Either log may start with a checkpoint (see `change_log.ChangeLog.compact`), which stands for the entries up to a commit
+that both revisions contain: the entries it folds are skipped in the other log too, without being compared.
+
+With several jobs, the rebased changes are instead partitioned by the files they touch (see `partition`), and each
+partition is transformed and applied in a worker process. The workers return the final contents of the files they
+changed, which are assembled into the merged state. Changes to the same file are still applied in the same order as
+in a serial merge.
+"""
+import heapq
+import itertools
+import os
+import tempfile
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, Any
+
+import git
+
+from change_log import change_log, MissingChangeLog
+from changes import FileRenamed
+from changes.change import Change, Conflict
+from changes.changes import change_from_json
+from repo_state import TreeBackedRepoState
+from smart_repo import SmartRepo
+from tracing import span
+from utils.repo import CHANGES_FILE_NAME, decode_changes_line, encode_changes_line, encode_changes_json_line, \
+    is_checkpoint, line_index, line_header, EntryHeader
+from utils.workers import map_in_workers
+
+# Merged change logs larger than this are written to a temporary file rather than held in memory.
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def split_logs(log: Iterable[bytes], other_log: Iterable[bytes]) -> Tuple[List[bytes], Iterator[bytes]]:
+    """
+    Skip the common prefix of two change logs.
+
+    :return: The (remaining) lines only in the first log, and an iterator over the lines only in the second one.
+    """
+    log, other_log = _skip_checkpoint(iter(log), iter(other_log))
+    for line in log:
+        other_line = next(other_log, None)
+        if other_line != line:
+            return [line] + list(log), other_log if other_line is None else itertools.chain((other_line, ), other_log)
+    return [], other_log
+
+
+def _skip_checkpoint(log: Iterator[bytes], other_log: Iterator[bytes]) -> Tuple[Iterator[bytes], Iterator[bytes]]:
+    """ Skip the entries of both logs up to the latest of the checkpoints they start with, and the checkpoints. """
+    first_lines = [next(log, None), next(other_log, None)]
+    logs = [itertools.chain((line, ), rest) if line is not None else rest
+            for line, rest in zip(first_lines, (log, other_log))]
+    checkpoints = [line_index(line) for line in first_lines if line is not None and is_checkpoint(line)]
+    if not checkpoints:
+        return logs[0], logs[1]
+    last = max(checkpoints)
+    return tuple(itertools.dropwhile(lambda line: line_index(line) <= last, rest) for rest in logs)
+
+
+def transform(repo: SmartRepo, change: Change, missing_changes: List[List[Change]]) -> Optional[Change]:
+    """ Transform a change against all the given changes, returning None if it becomes irrelevant. """
+    with span('transform', change_type=change.name(), paths=change.touched_paths()):
+        for missing_change_list in missing_changes:
+            for missing_change in missing_change_list:
+                change = change.transform(repo, missing_change)
+                if change is None:
+                    return None
+    return change
+
+
+class _PathSets:
+    """ Disjoint sets of paths (union-find, with path compression). """
+
+    def __init__(self):
+        self._parents: Dict[str, str] = {}
+
+    def find(self, path: str) -> str:
+        root = path
+        while self._parents.setdefault(root, root) != root:
+            root = self._parents[root]
+        while path != root:
+            path, self._parents[path] = self._parents[path], root
+        return root
+
+    def union(self, paths: Iterable[str]) -> None:
+        roots = [self.find(path) for path in paths]
+        for root in roots[1:]:
+            self._parents[root] = roots[0]
+
+
+def interacting(missing_lines: List[bytes], rebased_lines: Iterable[bytes]) -> List[bool]:
+    """
+    Which of the missing change log entries may interact with the rebased ones, judging by the headers of their lines.
+
+    An entry may interact if it touches a path that a rebased entry touches, or that is renamed to or from one by the
+    missing entries. If any line has no header, all the missing entries may interact.
+    """
+    headers = [line_header(line) for line in missing_lines]
+    rebased_headers = [line_header(line) for line in rebased_lines]
+    if None in headers or None in rebased_headers:
+        return [True] * len(missing_lines)
+    paths = _PathSets()
+    for header in headers:
+        if FileRenamed.name() in header.types:
+            paths.union(header.paths)
+    roots = {paths.find(path) for header in rebased_headers for path in header.paths}
+    return [any(paths.find(path) in roots for path in header.paths) for header in headers]
+
+
+# A rebased change, by its change log entry (among the rebased ones) and its position in the entry.
+ChangeKey = Tuple[int, int]
+
+
+def partition(entries: List[List[Change]], missing_changes: List[List[Change]]) -> List[List[Tuple[ChangeKey, Change]]]:
+    """
+    Partition rebased changes into groups that can be applied independently of each other.
+
+    Changes that touch a common path are in the same partition, and renames (both rebased and missing ones) join the
+    partitions of their old and new paths, since changes to the old path are transformed into changes to the new one.
+    :param entries: The change sets to rebase.
+    :param missing_changes: The change sets they are transformed against.
+    :return: The changes of every partition, in log order.
+    """
+    paths = _PathSets()
+    for change in itertools.chain.from_iterable(missing_changes):
+        if isinstance(change, FileRenamed):
+            paths.union(change.touched_paths())
+    for change in itertools.chain.from_iterable(entries):
+        paths.union(change.touched_paths())
+    partitions: Dict[str, List[Tuple[ChangeKey, Change]]] = {}
+    for entry, changes in enumerate(entries):
+        for position, change in enumerate(changes):
+            partitions.setdefault(paths.find(change.touched_paths()[0]), []).append(((entry, position), change))
+    return list(partitions.values())
+
+
+def _rebase_partitions(repo: SmartRepo, item: Tuple[str, List[bytes], List[Tuple[ChangeKey, Dict[str, Any]]]]) \
+        -> Tuple[Dict[ChangeKey, Optional[Tuple[Dict[str, Any], Tuple[str, ...]]]], Dict[str, Optional[bytes]]]:
+    """
+    Transform and apply (in a worker process) the changes of some partitions to the given tree.
+
+    :param item: The hexsha of the tree to apply the changes to, the missing change log lines to transform the changes
+                 against, and the (serialized) changes, in the order to apply them.
+    :return: The transformed changes (serialized along with their touched paths, or None if they became irrelevant), and
+             the final contents of the files that changed (None for deleted files).
+    """
+    tree_sha, missing_lines, changes_json = item
+    missing_changes = [decode_changes_line(repo, line)[1] for line in missing_lines]
+    transformed: Dict[ChangeKey, Optional[Tuple[Dict[str, Any], Tuple[str, ...]]]] = {}
+    paths = set()
+    # The workers' trees and blobs are never persisted, only the contents of the changed files are returned.
+    with repo.overlay_odb():
+        tree = git.Tree.new_from_sha(repo, bytes.fromhex(tree_sha))
+        tree.path = ''
+        state = TreeBackedRepoState(repo, tree)
+        for key, change_json in changes_json:
+            change = change_from_json(repo, change_json)
+            paths.update(change.touched_paths())
+            change = transform(repo, change, missing_changes)
+            transformed[key] = None if change is None else (change.to_json(), change.touched_paths())
+            if change is not None:
+                paths.update(change.touched_paths())
+                with span('apply', change_type=change.name(), paths=change.touched_paths()):
+                    change.apply(repo, state)
+        contents = {}
+        for path in paths:
+            before, after = (_blob_sha(state_tree, path) for state_tree in (tree, state.tree))
+            if before != after:
+                contents[path] = None if after is None else repo.content_store.read(state.tree[path])
+    return transformed, contents
+
+
+def _blob_sha(tree, path: str) -> Optional[bytes]:
+    try:
+        return tree[path].binsha
+    except KeyError:
+        return None
+
+
+class MergeSession:
+    """ Merges change logs into a repo state, streaming the merged change log into a temporary file. """
+
+    def __init__(self, repo: SmartRepo, state: TreeBackedRepoState, log: Iterable[bytes], start: int = 0):
+        """
+        :param repo: The repository being merged into.
+        :param state: The state to apply rebased changes to, initially HEAD's.
+        :param log: The lines of HEAD's change log. Lines of rebased changes are appended to it.
+        :param start: The number of change log entries before the given lines (which the merged logs all share).
+        """
+        self.repo = repo
+        self.state = state
+        self._log = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._length = start
+        line = None
+        for line in log:
+            self._log.write(line if line.endswith(b'\n') else line + b'\n')
+        if line is not None:
+            # Checkpoints make the number of lines differ from the number of entries.
+            self._length = line_index(line) + 1
+        self._log_start = self._log.tell()
+        # Change sets decoded or encoded by this session, which later revisions might be missing.
+        self._decoded: Dict[bytes, List[Change]] = {}
+
+    def close(self) -> None:
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def decode(self, line: bytes) -> List[Change]:
+        if line in self._decoded:
+            return self._decoded[line]
+        return decode_changes_line(self.repo, line)[1]
+
+    def _log_lines(self) -> Iterator[bytes]:
+        self._log.seek(0)
+        yield from self._log
+
+    def transform(self, change: Change, missing_changes: List[List[Change]]) -> Optional[Change]:
+        """ Transform a change against all the given changes, returning None if it becomes irrelevant. """
+        return transform(self.repo, change, missing_changes)
+
+    def merge(self, other_log: Iterable[bytes], remember: bool = True, jobs: int = 1) -> int:
+        """
+        Rebase the changes of another change log onto the merged state.
+
+        :param other_log: The lines of the other change log.
+        :param remember: Whether to keep the rebased changes in memory, for the merges of later revisions (which are
+                         missing them) not to decode them again.
+        :param jobs: The maximal number of worker processes to rebase the changes in.
+        :return: The number of change log entries that were rebased.
+        """
+        missing_lines, missing_changes, lines_to_rebase = self.split(other_log)
+        entries = (self.decode(line) for line in lines_to_rebase)
+        if jobs > 1:
+            # Partitioning holds all the rebased changes in memory, rather than streaming them.
+            entries = list(entries)
+            partitions = partition(entries, missing_changes)
+            if len(partitions) > 1:
+                return self._merge_partitions(entries, partitions, missing_lines, jobs)
+        return sum(1 for _ in self.rebase(entries, missing_changes, remember))
+
+    def split(self, other_log: Iterable[bytes], rebased_lines: Optional[List[bytes]] = None) \
+            -> Tuple[List[bytes], List[List[Change]], Iterator[bytes]]:
+        """
+        Compare the merged change log with another one.
+
+        Lines that the other log is missing are only decoded if they may interact with the rebased ones (see
+        `interacting`), the others are left out.
+        :param rebased_lines: The lines that will be rebased, by default those only in the other log (which are then
+                              read ahead, without being decoded).
+        :return: The lines that the other log is missing and that may interact with the rebased ones, the change sets
+                 they hold, and an iterator over the lines only in the other log.
+        """
+        missing_lines, lines_to_rebase = split_logs(self._log_lines(), other_log)
+        if rebased_lines is None:
+            rebased_lines = list(lines_to_rebase)
+            lines_to_rebase = iter(rebased_lines)
+        missing_lines = [line for line, interacts in zip(missing_lines, interacting(missing_lines, rebased_lines))
+                         if interacts]
+        missing_changes = [self.decode(line) for line in missing_lines]
+        self._decoded = dict(zip(missing_lines, missing_changes))
+        return missing_lines, missing_changes, lines_to_rebase
+
+    def rebase(self, entries: Iterable[List[Change]], missing_changes: List[List[Change]], remember: bool = False) \
+            -> Iterator[bytes]:
+        """
+        Transform change sets against the given missing changes and apply them, appending them to the merged log.
+
+        :param entries: The change sets to rebase.
+        :param missing_changes: The change sets to transform them against.
+        :param remember: Whether to keep the rebased changes in memory (see `merge`).
+        :return: An iterator over the log lines of the rebased change sets, which must be consumed for them to be
+                 rebased.
+        """
+        for changes in entries:
+            transformed_changes = []
+            # The changes of a set are all relative to the state before it, so they are applied from the last one (as
+            # `utils.repo.detect_changes` does).
+            for change in reversed(changes):
+                change = self.transform(change, missing_changes)
+                if change is not None:
+                    transformed_changes.append(change)
+                    with span('apply', change_type=change.name(), paths=change.touched_paths()):
+                        change.apply(self.repo, self.state)
+            transformed_changes.reverse()
+            line = encode_changes_line(self._length, transformed_changes) + b'\n'
+            if remember:
+                self._decoded[line] = transformed_changes
+            self._log.seek(0, os.SEEK_END)
+            self._log.write(line)
+            self._length += 1
+            yield line
+
+    def _merge_partitions(self, entries: List[List[Change]], partitions: List[List[Tuple[ChangeKey, Change]]],
+                          missing_lines: List[bytes], jobs: int) -> int:
+        """
+        Rebase change sets whose changes were partitioned (see `partition`) in worker processes.
+
+        The rebased changes are not remembered, since the workers return them serialized.
+        """
+        # Spread the partitions over the workers, the largest ones first, each to the least loaded worker so far.
+        groups: List[List[Tuple[ChangeKey, Change]]] = [[] for _ in range(min(jobs, len(partitions)))]
+        loads = [(0, i) for i in range(len(groups))]
+        for changes in sorted(partitions, key=len, reverse=True):
+            load, i = heapq.heappop(loads)
+            groups[i].extend(changes)
+            heapq.heappush(loads, (load + len(changes), i))
+        # The workers read the current state from disk.
+        persist = getattr(self.repo.odb, 'persist', None)
+        if persist is not None:
+            persist(self.state.tree.binsha)
+        # Within a change set, changes are applied from the last one (see `rebase`).
+        items = [(self.state.tree.hexsha, missing_lines,
+                  [(key, change.to_json()) for key, change in sorted(group, key=lambda keyed: (keyed[0][0],
+                                                                                            -keyed[0][1]))])
+                 for group in groups]
+        transformed: Dict[ChangeKey, Optional[Tuple[Dict[str, Any], Tuple[str, ...]]]] = {}
+        with span('rebase partitions', partitions=len(partitions), jobs=len(groups)):
+            for group_transformed, contents in map_in_workers(self.repo, _rebase_partitions, items, jobs):
+                transformed.update(group_transformed)
+                for path, content in sorted(contents.items()):
+                    if content is None:
+                        del self.state[path]
+                    else:
+                        self.state[path] = content.splitlines(keepends=True)
+        self._log.seek(0, os.SEEK_END)
+        for entry, changes in enumerate(entries):
+            changes_json = [transformed[(entry, position)] for position in range(len(changes))
+                            if transformed[(entry, position)] is not None]
+            header = EntryHeader(frozenset(change_json['type'] for change_json, _ in changes_json),
+                                 frozenset(path for _, paths in changes_json for path in paths))
+            line = encode_changes_json_line(self._length, [change_json for change_json, _ in changes_json], header)
+            self._log.write(line + b'\n')
+            self._length += 1
+        return len(entries)
+
+    def new_lines(self) -> Iterator[bytes]:
+        """ The lines of the change log entries rebased by this session. """
+        self._log.seek(self._log_start)
+        yield from self._log
+
+    def write_log(self) -> None:
+        """ Write the merged change log to the state's change log file. """
+        self._log.seek(0, os.SEEK_END)
+        size = self._log.tell()
+        self._log.seek(0)
+        self.state.write_stream(CHANGES_FILE_NAME, self._log, size)
+
+
+def _describe(entry: int, change: Change) -> Dict[str, Any]:
+    return {'entry': entry, 'type': change.name(), 'paths': list(change.touched_paths())}
+
+
+def check(repo: SmartRepo, revisions: Tuple[str, str]) -> Dict[str, Any]:
+    """
+    Find out whether a revision would merge cleanly into another one, without changing anything.
+
+    Only the transform phase of the merge runs: the revision's changes are transformed against the changes it is
+    missing, but nothing is applied, so conflicts that only surface when applying changes are not detected.
+    :param repo: The repository both revisions belong to.
+    :param revisions: The revision to merge into (e.g. HEAD), and the revision to check.
+    :return: A JSON report, listing the conflicting changes (by their change log entry) and the changes they conflict
+             with. Revisions that can't be merged at all (having no change log) are not clean, with the reason as the
+             report's error.
+    """
+    into, revision = (repo.rev_parse(rev) for rev in revisions)
+    log = change_log(repo)
+    try:
+        _, into_log, (revision_log, ) = log.merge_logs(into, [(revisions[1], revision)])
+    except MissingChangeLog as e:
+        return {'revision': revisions[1], 'clean': False, 'rebased': 0, 'missing': 0, 'conflicts': [],
+                'error': f'{e.revision} has no change log.'}
+    missing_lines, lines_to_rebase = split_logs(into_log, revision_log)
+    lines_to_rebase = list(lines_to_rebase)
+    missing_changes = [(missing_entry, missing_change)
+                       for line, interacts in zip(missing_lines, interacting(missing_lines, lines_to_rebase))
+                       if interacts
+                       for missing_entry, missing_change_list in [decode_changes_line(repo, line)]
+                       for missing_change in missing_change_list]
+    conflicts = []
+    rebased = 0
+    for line in lines_to_rebase:
+        rebased += 1
+        entry, changes = decode_changes_line(repo, line)
+        for change in changes:
+            original = change
+            for missing_entry, missing_change in missing_changes:
+                try:
+                    with span('transform', change_type=change.name(), paths=change.touched_paths()):
+                        change = change.transform(repo, missing_change)
+                except Conflict:
+                    conflicts.append({'change': _describe(entry, original),
+                                      'conflicts_with': _describe(missing_entry, missing_change)})
+                    break
+                if change is None:
+                    break
+    return {'revision': revisions[1], 'clean': not conflicts, 'rebased': rebased, 'missing': len(missing_lines),
+            'conflicts': conflicts}
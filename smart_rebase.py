@@ -0,0 +1,104 @@
+"""
+Rebasing the current branch onto another revision (see `git smart rebase`).
+
+No commit is checked out: the change sets recorded for the branch's commits are transformed against the upstream's
+changes that the branch is missing, and applied one commit at a time to an in-memory repo state (through a
+`smart_merge.MergeSession`), which is committed after each of them. The new commits are only written to disk once they
+are all created, the branch is then moved to the last one, and only the files that differ from the original branch
+are written to the working tree.
+"""
+from typing import List, NamedTuple
+
+import git
+from git.objects.util import altz_to_utctz_str
+
+from change_log import change_log
+from repo_state import TreeBackedRepoState
+from smart_merge import MergeSession
+from smart_repo import SmartRepo
+from tracing import span
+from utils.repo import CHANGES_FILE_NAME
+
+
+class NotRecorded(Exception):
+    """ A commit to rebase changed files without recording its changes. """
+
+    def __init__(self, commit: git.Commit):
+        super(NotRecorded, self).__init__(commit.hexsha)
+        self.commit = commit
+
+
+class RebaseResult(NamedTuple):
+    original: git.Commit
+    rebased: git.Commit
+    # The rebased commits, in the order of the original ones they replace.
+    commits: List[git.Commit]
+
+
+def _changes_files(repo: SmartRepo, commit: git.Commit) -> bool:
+    """ Whether a commit changed any file but the change log file. """
+    before = commit.parents[0].tree.binsha if commit.parents else None
+    return any(path != CHANGES_FILE_NAME for path, _, _ in repo.diff_trees(before, commit.tree.binsha))
+
+
+def rebase(repo: SmartRepo, upstream: str) -> RebaseResult:
+    """
+    Replay the commits of HEAD's first-parent chain that the upstream doesn't have on top of it.
+
+    Authors, author dates and messages are preserved, merge commits are replayed as regular commits. Nothing is written
+    if any of the commits conflicts with the upstream (`changes.change.Conflict` is raised).
+    :param repo: The repository to rebase the current branch of.
+    :param upstream: The revision to rebase onto.
+    :return: The original and the rebased HEAD, and the rebased commits. If the branch is behind the upstream, there are
+             no commits to rebase and it is fast-forwarded to the upstream.
+    :raises NotRecorded: If a commit has changes but no change log entries.
+    """
+    log = change_log(repo)
+    head = repo.head.commit
+    onto = repo.rev_parse(upstream)
+    commits = list(repo.iter_commits(f'{onto.hexsha}..{head.hexsha}', first_parent=True, reverse=True))
+    if not commits:
+        if head != onto and repo.is_ancestor(head, onto):
+            # The branch is behind the upstream, which is fast-forwarded to (as `git rebase` does).
+            _move_head(repo, head, onto, f'smart rebase: fast-forward to {onto.hexsha}')
+            return RebaseResult(head, onto, [])
+        return RebaseResult(head, head, [])
+    if not commits[0].parents:
+        raise ValueError(f'The branch has no history in common with {upstream}')
+    base = commits[0].parents[0]
+    # The upstream's change log, and the base's (which lacks the changes the commits are transformed against).
+    start, onto_log, (base_log, ) = log.merge_logs(onto, [(base.hexsha, base)])
+    commit_lines = [log.entries(commit) for commit in commits]
+    rebased_commits = []
+    entries = {}
+    with MergeSession(repo, TreeBackedRepoState(repo, onto.tree), onto_log, start) as session:
+        with repo.overlay_odb() as odb:
+            _, missing_changes, _ = session.split(base_log, [line for lines in commit_lines for line in lines])
+            parent = onto
+            for commit, lines in zip(commits, commit_lines):
+                if not lines and _changes_files(repo, commit):
+                    raise NotRecorded(commit)
+                with span('rebase', commit=commit.hexsha):
+                    rebased_lines = list(session.rebase((session.decode(line) for line in lines), missing_changes))
+                    log.stage_merge(session)
+                parent = git.Commit.create_from_tree(
+                    repo, session.state.tree, commit.message, parent_commits=[parent], author=commit.author,
+                    author_date=f'{commit.authored_date} {altz_to_utctz_str(commit.author_tz_offset)}')
+                rebased_commits.append(parent)
+                if rebased_lines:
+                    entries[parent.hexsha] = b''.join(rebased_lines)
+            with span('persist'):
+                odb.persist(parent.binsha)
+    log.commit_rebase(entries)
+    _move_head(repo, head, parent, f'smart rebase onto {onto.hexsha}')
+    return RebaseResult(head, parent, rebased_commits)
+
+
+def _move_head(repo: SmartRepo, head: git.Commit, commit: git.Commit, message: str) -> None:
+    """ Move the current branch from HEAD to a commit (keeping HEAD as ORIG_HEAD), and check out what changed. """
+    reference = repo.head if repo.head.is_detached else repo.head.reference
+    repo.git.update_ref('ORIG_HEAD', head.hexsha)
+    reference.set_commit(commit, logmsg=message)
+    # Only the files changed by the rebase are written, the rest of the index and working tree is left untouched.
+    with span('checkout'):
+        repo.checkout_changes(head.tree, commit.tree)
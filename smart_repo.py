@@ -1,22 +1,170 @@
 import ast
+import os
+import subprocess
+import weakref
+from collections import Counter
 from contextlib import contextmanager
-from typing import List, Callable, Union, Optional, Iterable
+from typing import List, Callable, Union, Optional, Iterable, Dict, Tuple, Any, TYPE_CHECKING
 
 import clang
 import git
 from clang.cindex import Cursor, TranslationUnit
+from git.objects.fun import tree_entries_from_data
 
+import tracing
+from content_store import ContentStore
 from cursor_path import CursorPath
+from object_db import OverlayObjectDB, DEFAULT_MEMORY_LIMIT
+from parse_options import ParseProfile, ParseSettings, FULL
 from utils.file import file_from_blob, file_from_text
 
+if TYPE_CHECKING:
+    from detection_budget import DetectionBudget
+
+# A (mode, binsha) pair describing a tree entry.
+TreeEntry = Tuple[int, bytes]
+
+# Counters of expensive operations performed by this process (e.g. 'parses'), reported via SMART_GIT_STATS.
+stats = Counter()
+
+# Indexes derived from translation units (see `derived_indexes`).
+_derived_indexes: 'weakref.WeakKeyDictionary[TranslationUnit, Dict[str, Any]]' = weakref.WeakKeyDictionary()
+
+
+def derived_indexes(translation_unit: TranslationUnit) -> Dict[str, Any]:
+    """
+    A place to cache indexes derived from a translation unit (by name), which are dropped when it is reparsed.
+    """
+    if translation_unit not in _derived_indexes:
+        _derived_indexes[translation_unit] = {}
+    return _derived_indexes[translation_unit]
+
 
 class SmartRepo(git.Repo):
 
+    # When not None, repositories opened through `SmartRepo.open` are kept here by path and reused (see `keep_open`).
+    _open_repos: Optional[Dict[str, 'SmartRepo']] = None
+
+    # The limits of the clang-based detectors while `utils.repo.detect_changes` runs (see detection_budget).
+    detection_budget: Optional['DetectionBudget'] = None
+
+    @classmethod
+    def keep_open(cls) -> None:
+        """
+        Reuse repository handles opened through `SmartRepo.open` for the rest of the process' lifetime.
+
+        Used by long-lived processes (e.g. `git smart serve`) to keep the repository and the clang index warm between
+        requests.
+        """
+        if cls._open_repos is None:
+            cls._open_repos = {}
+
+    @classmethod
+    def release_open(cls) -> None:
+        """ Close all repositories kept open since `keep_open` and stop reusing them. """
+        for repo in (cls._open_repos or {}).values():
+            repo.git.clear_cache()
+            repo.close()
+        cls._open_repos = None
+
+    @classmethod
+    def end_sessions(cls) -> None:
+        """ Drop the per-invocation state of all repositories kept open since `keep_open`. """
+        for repo in (cls._open_repos or {}).values():
+            repo.end_session()
+
+    @classmethod
+    def open(cls, repo_path: str) -> 'SmartRepo':
+        if cls._open_repos is None:
+            return cls(repo_path)
+        key = os.path.realpath(repo_path)
+        if key not in cls._open_repos:
+            cls._open_repos[key] = cls(repo_path)
+        return cls._open_repos[key]
+
+    @property
+    def content_store(self) -> ContentStore:
+        """ Blob contents read during the current invocation. """
+        if getattr(self, '_content_store', None) is None:
+            self._content_store = ContentStore(self)
+        return self._content_store
+
+    @property
+    def parse_settings(self) -> ParseSettings:
+        """ The compiler arguments (and precompiled header) used by parses during the current invocation. """
+        if getattr(self, '_parse_settings', None) is None:
+            self._parse_settings = ParseSettings(self)
+        return self._parse_settings
+
+    def end_session(self) -> None:
+        """ Drop state that should only live for the duration of a single command invocation. """
+        self._content_store = None
+        self.detection_budget = None
+        if getattr(self, '_parse_settings', None) is not None:
+            self._parse_settings.close()
+            self._parse_settings = None
+
+    @contextmanager
+    def overlay_odb(self, memory_limit: int = DEFAULT_MEMORY_LIMIT) -> Iterable[OverlayObjectDB]:
+        """
+        Keep objects stored during the context in memory (see OverlayObjectDB).
+
+        Objects that were not persisted by the end of the context are discarded.
+        """
+        overlay = OverlayObjectDB(self.odb, os.path.join(self.git_dir, 'objects'), memory_limit)
+        self.odb = overlay
+        try:
+            yield overlay
+        finally:
+            self.odb = overlay.odb
+            overlay.discard()
+
     def get_cindex(self):
-        if not clang.cindex.Config.library_file:
-            clang.cindex.Config.set_library_file(ast.literal_eval(self.config_reader().get_value('smart',
-                                                                                                 'libclangPath')))
-        return clang.cindex.Index.create()
+        if getattr(self, '_cindex', None) is None:
+            if not clang.cindex.Config.library_file:
+                clang.cindex.Config.set_library_file(ast.literal_eval(self.config_reader().get_value('smart',
+                                                                                                     'libclangPath')))
+            self._cindex = clang.cindex.Index.create()
+        return self._cindex
+
+    def parse(self, file_name: str, path: Optional[str] = None, profile: ParseProfile = FULL,
+              contents: Optional[bytes] = None) -> TranslationUnit:
+        """
+        Parse the given source file with clang.
+
+        :param file_name: the file to parse (usually a temporary copy of a file in the repository).
+        :param path: the path in the repository of the parsed file, if any.
+        :param profile: how much of the file to analyze (see parse_options).
+        :param contents: the contents to parse, instead of reading them from file_name (which then needn't exist). The
+        translation unit is then prepared to be reparsed with new contents (see `reparse`).
+        """
+        stats['parses'] += 1
+        with tracing.span('parse', path=path or file_name, profile=profile.name):
+            index = self.get_cindex()
+            args = self.parse_settings.args_for(index, path, profile)
+            if contents is None:
+                return index.parse(file_name, args=args, options=profile.options)
+            return index.parse(file_name, args=args, unsaved_files=[(file_name, contents)],
+                               options=profile.options | TranslationUnit.PARSE_PRECOMPILED_PREAMBLE)
+
+    def reparse(self, translation_unit: TranslationUnit, contents: bytes, path: Optional[str] = None) -> bool:
+        """
+        Parse new contents of a file parsed with `parse(..., contents=...)`, in place.
+
+        Clang reuses the work it did for the start of the file that didn't change (e.g. included headers). Cursors
+        from before the reparse are invalid afterwards, and the indexes derived from the translation unit are dropped.
+        :return: whether the reparse succeeded. If it didn't, the translation unit can't be used anymore.
+        """
+        stats['reparses'] += 1
+        derived_indexes(translation_unit).clear()
+        with tracing.span('reparse', path=path or translation_unit.spelling):
+            # TranslationUnit.reparse only accepts str contents (and miscounts their length), so libclang is called
+            # directly.
+            unsaved_files = (clang.cindex._CXUnsavedFile * 1)()
+            unsaved_files[0].name = translation_unit.spelling.encode('utf-8')
+            unsaved_files[0].contents = contents
+            unsaved_files[0].length = len(contents)
+            return clang.cindex.conf.lib.clang_reparseTranslationUnit(translation_unit, 1, unsaved_files, 0) == 0
 
     def find_cursor(self, file_name: str, predicate: Callable[[Cursor], bool]) -> CursorPath:
         from utils.ast import search_ast
@@ -25,9 +173,10 @@ class SmartRepo(git.Repo):
         return match
 
     @contextmanager
-    def ast(self, file: Union[List[bytes], git.Blob], path: Optional[str]=None) -> Iterable[TranslationUnit]:
+    def ast(self, file: Union[List[bytes], git.Blob], path: Optional[str]=None, profile: ParseProfile = FULL) \
+            -> Iterable[TranslationUnit]:
         with (file_from_blob(file) if isinstance(file, git.Blob) else file_from_text(file, path)) as file:
-            parsed = self.get_cindex().parse(file.name)
+            parsed = self.parse(file.name, path or getattr(file, 'path', None), profile)
             yield parsed
 
     def contents(self, path: str, revision: Optional[str]='HEAD') -> Optional[List[bytes]]:
@@ -39,4 +188,72 @@ class SmartRepo(git.Repo):
         tree = commit.tree
         if path not in tree:
             return None
-        return tree[path].data_stream.read().splitlines(keepends=True)
+        return self.content_store.lines(tree[path])
+
+    def _tree_entries(self, binsha: Optional[bytes]) -> Dict[str, TreeEntry]:
+        if binsha is None:
+            return {}
+        return {name: (mode, entry_binsha)
+                for entry_binsha, mode, name in tree_entries_from_data(self.odb.stream(binsha).read())}
+
+    def diff_trees(self, a: Optional[bytes], b: Optional[bytes], prefix: str = '') \
+            -> Iterable[Tuple[str, Optional[TreeEntry], Optional[TreeEntry]]]:
+        """
+        Find the files that differ between two trees, without going through git.
+
+        Subtrees with identical SHAs on both sides are skipped entirely.
+        :param a: the binary SHA of the first tree (or None for an empty tree).
+        :param b: the binary SHA of the second tree (or None for an empty tree).
+        :return: (path, a entry, b entry) for every differing file, where a missing entry is None.
+        """
+        a_entries = self._tree_entries(a)
+        b_entries = self._tree_entries(b)
+        for name in sorted(a_entries.keys() | b_entries.keys()):
+            a_entry = a_entries.get(name)
+            b_entry = b_entries.get(name)
+            if a_entry == b_entry:
+                continue
+            path = f'{prefix}{name}'
+            a_is_tree = a_entry is not None and a_entry[0] == git.Tree.tree_id << 12
+            b_is_tree = b_entry is not None and b_entry[0] == git.Tree.tree_id << 12
+            if a_is_tree or b_is_tree:
+                if a_entry is not None and not a_is_tree:
+                    # A directory replaced a file - the file goes first.
+                    yield path, a_entry, None
+                yield from self.diff_trees(a_entry[1] if a_is_tree else None, b_entry[1] if b_is_tree else None,
+                                           f'{path}/')
+                if b_entry is not None and not b_is_tree:
+                    # A file replaced a directory - the file comes after the directory's contents are gone.
+                    yield path, None, b_entry
+                continue
+            yield path, a_entry, b_entry
+
+    def checkout_changes(self, from_tree: git.Tree, to_tree: git.Tree) -> List[str]:
+        """
+        Move the index and working tree from one tree to another, touching only the files that differ between them.
+
+        Unlike a full reset, files that are identical in both trees keep their index entries (including stat
+        information) and are not rewritten.
+        :return: the paths that were updated.
+        """
+        changed = list(self.diff_trees(from_tree.binsha, to_tree.binsha))
+        if not changed:
+            return []
+        index_info = b''.join(
+            (b'%o %s\t%s\0' % (b_entry[0], b_entry[1].hex().encode('ascii'), path.encode('utf-8'))
+             if b_entry is not None else b'0 %s\t%s\0' % (b'0' * 40, path.encode('utf-8')))
+            for path, _, b_entry in changed)
+        subprocess.run([git.Git.GIT_PYTHON_GIT_EXECUTABLE, 'update-index', '-z', '--index-info'], input=index_info,
+                       cwd=self.working_dir, check=True)
+        for path, _, b_entry in changed:
+            if b_entry is None and os.path.lexists(os.path.join(self.working_dir, path)):
+                os.remove(os.path.join(self.working_dir, path))
+                directory = os.path.dirname(path)
+                while directory and not os.listdir(os.path.join(self.working_dir, directory)):
+                    os.rmdir(os.path.join(self.working_dir, directory))
+                    directory = os.path.dirname(directory)
+        checked_out = b''.join(path.encode('utf-8') + b'\0' for path, _, b_entry in changed if b_entry is not None)
+        if checked_out:
+            subprocess.run([git.Git.GIT_PYTHON_GIT_EXECUTABLE, 'checkout-index', '-f', '-z', '--stdin'],
+                           input=checked_out, cwd=self.working_dir, check=True)
+        return [path for path, _, _ in changed]
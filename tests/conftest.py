@@ -56,6 +56,13 @@ def smart_repo(empty_repo: Repo, runner: CliRunner) -> SmartRepo:
         repo.close()
 
 
+@pytest.fixture
+def notes_smart_repo(smart_repo) -> SmartRepo:
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'changeLog', 'notes')
+    return smart_repo
+
+
 @pytest.fixture
 def disabled_smart_repo(smart_repo, runner: CliRunner) -> Repo:
     runner.invoke(smart_git.disable, [smart_repo.working_dir])
@@ -105,6 +112,10 @@ def pytest_pyfunc_call(pyfuncitem):
                         if result.exception:
                             raise result.exception
                     repo.index.commit(message=repr(tag_name or f'@commit commit #{i + 1}'), skip_hooks=True)
+                    if smart_git.RepoStatus.of(repo.working_dir) == smart_git.RepoStatus.installed_enabled:
+                        result = CliRunner().invoke(smart_git.post_commit, [repo.working_dir])
+                        if result.exception:
+                            raise result.exception
                 else:
                     what: str = marker.kwargs['what']
                     if smart_git.RepoStatus.of(repo.working_dir) == smart_git.RepoStatus.installed_enabled:
@@ -0,0 +1,41 @@
+from clang.cindex import CursorKind
+from click.testing import CliRunner
+
+import smart_git
+from backfill import NOTES_REF
+from changes import FileAdded, VariableRenamed
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.repo import get_changes, decode_changes_line
+
+
+def _check_backfill(disabled_smart_repo: SmartRepo, runner: CliRunner, jobs: int):
+    result = runner.invoke(smart_git.backfill, [disabled_smart_repo.working_dir, 'HEAD', '--branch', 'backfilled',
+                                                '--notes', '--jobs', str(jobs)])
+    assert result.exit_code == 0, result.output
+
+    b = disabled_smart_repo.find_cursor('a.c', lambda cursor: cursor.kind == CursorKind.VAR_DECL
+                                                              and cursor.spelling == 'b')
+    expected = [[FileAdded('a.c', disabled_smart_repo.contents('a.c', 'initial'))],
+                [VariableRenamed(b.drop(1).appended('a'), 'b')]]
+    assert get_changes(disabled_smart_repo, 'backfilled') == expected
+    assert get_changes(disabled_smart_repo, 'backfilled~1') == expected[:1]
+    backfilled = disabled_smart_repo.commit('backfilled')
+    assert backfilled.message == disabled_smart_repo.commit('renamed').message
+    assert backfilled.parents[0].parents == ()
+
+    for i, tag in enumerate(['initial', 'renamed']):
+        note = disabled_smart_repo.git.notes('--ref', NOTES_REF, 'show', tag).encode('utf-8')
+        assert decode_changes_line(disabled_smart_repo, note) == (i, expected[i])
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'}, tag='initial')
+@commit({'a.c': 'int main() {\n    int b = 0;\n    return b;\n}\n'}, tag='renamed')
+def test_backfill(disabled_smart_repo: SmartRepo, runner: CliRunner):
+    _check_backfill(disabled_smart_repo, runner, jobs=1)
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'}, tag='initial')
+@commit({'a.c': 'int main() {\n    int b = 0;\n    return b;\n}\n'}, tag='renamed')
+def test_backfill_in_parallel(disabled_smart_repo: SmartRepo, runner: CliRunner):
+    _check_backfill(disabled_smart_repo, runner, jobs=2)
@@ -0,0 +1,157 @@
+from click.testing import CliRunner
+
+import smart_git
+from change_log import NOTES_REF, change_log
+from smart_repo import SmartRepo
+from tests.conftest import commit, merge
+from utils.file import as_lines
+from utils.repo import get_changes, CHANGES_FILE_NAME
+
+
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    return a;
+}
+'''}, tag='initial')
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    a += 1;
+    return a;
+}
+'''}, on='other', tag='add-line')
+@commit({'a.c': '''
+int main() {
+    int b = 0;
+    return b;
+}
+'''}, tag='rename')
+@merge('other', tag='merged')
+def test_notes(notes_smart_repo: SmartRepo):
+    assert CHANGES_FILE_NAME not in notes_smart_repo.head.commit.tree
+    assert [[change.name() for change in changes] for changes in get_changes(notes_smart_repo, 'merged')] \
+        == [['file-added'], ['variable-renamed'], ['insert-sub-ast']]
+    assert [[change.name() for change in changes] for changes in get_changes(notes_smart_repo, 'add-line')] \
+        == [['file-added'], ['insert-sub-ast']]
+    # Each commit only holds its own change set.
+    note = notes_smart_repo.git.notes('--ref', NOTES_REF, 'show', 'merged')
+    assert note.startswith('2 ') and '\n' not in note
+    assert notes_smart_repo.contents('a.c', 'merged') == as_lines('',
+                                                                  'int main() {',
+                                                                  '    int b = 0;',
+                                                                  '    b += 1;',
+                                                                  '    return b;',
+                                                                  '}')
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'}, tag='initial')
+@commit({'b.c': 'int f() {\n    return 1;\n}\n'})
+@commit({'a.c': 'int main() {\n    int b = 0;\n    return b;\n}\n'}, tag='renamed')
+def test_migrate(smart_repo: SmartRepo, runner: CliRunner):
+    changes = get_changes(smart_repo)
+    log = smart_repo.contents(CHANGES_FILE_NAME)
+
+    result = runner.invoke(smart_git.migrate_log, [smart_repo.working_dir, 'notes'])
+    assert result.exit_code == 0, result.output
+    assert change_log(smart_repo).name == 'notes'
+    assert get_changes(smart_repo) == changes
+    assert get_changes(smart_repo, 'initial') == changes[:1]
+    assert (CHANGES_FILE_NAME, 0) not in smart_repo.index.entries
+    smart_repo.index.commit('Drop the change log file', skip_hooks=True)
+
+    result = runner.invoke(smart_git.migrate_log, [smart_repo.working_dir, 'file'])
+    assert result.exit_code == 0, result.output
+    smart_repo.index.commit('Add the change log file', skip_hooks=True)
+    assert change_log(smart_repo).name == 'file'
+    assert smart_repo.contents(CHANGES_FILE_NAME) == log
+    assert get_changes(smart_repo) == changes
+
+
+def _check_compact(smart_repo: SmartRepo, runner: CliRunner):
+    result = runner.invoke(smart_git.compact, [smart_repo.working_dir])
+    assert result.exit_code == 0, result.output
+    # The topic branch was forked at the initial commit, so only its entry can be folded.
+    assert f'Folded 1 change log entry into a checkpoint at {smart_repo.commit("initial").hexsha[:7]}' in result.output
+    if change_log(smart_repo).name == 'file':
+        smart_repo.index.commit('Compact the change log', skip_hooks=True)
+        assert smart_repo.contents(CHANGES_FILE_NAME)[0].startswith(b'0 #checkpoint ')
+    assert [[change.name() for change in changes] for changes in get_changes(smart_repo)] == [['variable-renamed']]
+    # The folded entries are still in the history.
+    if change_log(smart_repo).name == 'file':
+        assert [[change.name() for change in changes] for changes in get_changes(smart_repo, 'initial')] \
+            == [['file-added']]
+    else:
+        assert smart_repo.git.show(f'{NOTES_REF}~1:{smart_repo.commit("initial").hexsha}').startswith('0 @file-added:a.c [')
+
+    result = runner.invoke(smart_git.merge, [smart_repo.working_dir, 'topic'])
+    assert result.exit_code == 0, result.output
+    assert [[change.name() for change in changes] for changes in get_changes(smart_repo)] \
+        == [['variable-renamed'], ['insert-sub-ast']]
+    assert smart_repo.contents('a.c') == as_lines('int main() {',
+                                                  '    int b = 0;',
+                                                  '    b += 1;',
+                                                  '    return b;',
+                                                  '}')
+
+    result = runner.invoke(smart_git.compact, [smart_repo.working_dir])
+    assert result.exit_code == 0, result.output
+    assert 'Folded 0 change log entries' in result.output
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'}, tag='initial')
+@commit({'a.c': 'int main() {\n    int a = 0;\n    a += 1;\n    return a;\n}\n'}, on='topic')
+@commit({'a.c': 'int main() {\n    int b = 0;\n    return b;\n}\n'})
+def test_compact(smart_repo: SmartRepo, runner: CliRunner):
+    _check_compact(smart_repo, runner)
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'}, tag='initial')
+@commit({'a.c': 'int main() {\n    int a = 0;\n    a += 1;\n    return a;\n}\n'}, on='topic')
+@commit({'a.c': 'int main() {\n    int b = 0;\n    return b;\n}\n'})
+def test_compact_notes(notes_smart_repo: SmartRepo, runner: CliRunner):
+    _check_compact(notes_smart_repo, runner)
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'})
+@commit({'b.c': 'int f() {\n    return 1;\n}\n'}, tag='second')
+def test_compact_threshold(smart_repo: SmartRepo, runner: CliRunner):
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'compactThreshold', 1)
+    with open(f'{smart_repo.working_dir}/a.c', 'w') as file:
+        file.write('int main() {\n    int b = 0;\n    return b;\n}\n')
+    smart_repo.index.add(['a.c'])
+    result = runner.invoke(smart_git.pre_commit, [smart_repo.working_dir])
+    assert result.exit_code == 0, result.output
+    smart_repo.index.commit('Rename', skip_hooks=True)
+
+    log = smart_repo.contents(CHANGES_FILE_NAME)
+    assert log[0] == f'1 #checkpoint {smart_repo.commit("second").hexsha}\n'.encode('ascii')
+    assert log[1].startswith(b'2 ')
+    assert [[change.name() for change in changes] for changes in get_changes(smart_repo)] == [['variable-renamed']]
+
+
+@commit({'a.c': 'int main() {\n    return 0;\n}\n'})
+@commit({'b.c': 'int f() {\n    return 1;\n}\n'})
+def test_changes_of_paths(smart_repo: SmartRepo):
+    changes = get_changes(smart_repo)
+    assert get_changes(smart_repo, paths=['b.c']) == changes[1:]
+    assert get_changes(smart_repo, paths=['c.c']) == []
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'})
+@commit({'b.c': 'int f() {\n    return 1;\n}\n'}, tag='second')
+def test_compact_threshold_notes(notes_smart_repo: SmartRepo, runner: CliRunner):
+    with notes_smart_repo.config_writer() as config:
+        config.set_value('smart', 'compactThreshold', 1)
+    with open(f'{notes_smart_repo.working_dir}/a.c', 'w') as file:
+        file.write('int main() {\n    int b = 0;\n    return b;\n}\n')
+    notes_smart_repo.index.add(['a.c'])
+    result = runner.invoke(smart_git.pre_commit, [notes_smart_repo.working_dir])
+    assert result.exit_code == 0, result.output
+
+    second = notes_smart_repo.commit('second').hexsha
+    assert notes_smart_repo.git.show(f'{NOTES_REF}:{second}') == f'1 #checkpoint {second}'
+    # Recording compacts again only once the log grew past the threshold since.
+    assert notes_smart_repo.config_reader().get_value('smart', 'compactedIndex') == 2
+    assert get_changes(notes_smart_repo) == []
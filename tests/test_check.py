@@ -0,0 +1,70 @@
+import json
+
+from click.testing import CliRunner
+
+import smart_git
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.repo import CHANGES_FILE_NAME
+
+
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    return a;
+}
+'''}, tag='initial')
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    a += 1;
+    return a;
+}
+'''}, on='add-line')
+@commit({'a.c': '''
+int main() {
+    int c = 0;
+    return c;
+}
+'''}, on='rename-c')
+@commit({'a.c': '''
+int main() {
+    int b = 0;
+    return b;
+}
+'''}, tag='rename-b')
+def test_check(smart_repo: SmartRepo, runner: CliRunner):
+    head = smart_repo.head.commit
+
+    result = runner.invoke(smart_git.check, [smart_repo.working_dir, 'add-line', 'rename-c', '--json', '--jobs', '2'])
+
+    assert result.exit_code == 1, result.output
+    add_line, rename_c = json.loads(result.output)
+    assert add_line == {'revision': 'add-line', 'clean': True, 'rebased': 1, 'missing': 1, 'conflicts': []}
+    assert rename_c == {'revision': 'rename-c', 'clean': False, 'rebased': 1, 'missing': 1,
+                        'conflicts': [{'change': {'entry': 1, 'type': 'variable-renamed', 'paths': ['a.c']},
+                                       'conflicts_with': {'entry': 1, 'type': 'variable-renamed', 'paths': ['a.c']}}]}
+    assert smart_repo.head.commit == head
+    assert not smart_repo.is_dirty()
+
+    result = runner.invoke(smart_git.check, [smart_repo.working_dir, 'add-line', '--jobs', '1'])
+    assert result.exit_code == 0, result.output
+    assert result.output == 'add-line: clean\n'
+
+
+@commit({'a.c': 'int main() {\n    return 0;\n}\n'})
+def test_check_missing_log(smart_repo: SmartRepo, runner: CliRunner):
+    # A commit without a change log, which merge refuses.
+    smart_repo.git.checkout('--orphan', 'no-log')
+    smart_repo.git.rm('-f', '--', CHANGES_FILE_NAME)
+    smart_repo.index.commit('No change log', skip_hooks=True)
+    smart_repo.heads.master.checkout()
+
+    result = runner.invoke(smart_git.check, [smart_repo.working_dir, 'no-log', '--json', '--jobs', '1'])
+    assert result.exit_code == 1, result.output
+    assert json.loads(result.output) == [{'revision': 'no-log', 'clean': False, 'rebased': 0, 'missing': 0,
+                                          'conflicts': [], 'error': 'no-log has no change log.'}]
+
+    result = runner.invoke(smart_git.check, [smart_repo.working_dir, 'no-log', '--jobs', '1'])
+    assert result.exit_code == 1, result.output
+    assert result.output == 'no-log: cannot be merged, no-log has no change log.\n'
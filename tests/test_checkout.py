@@ -0,0 +1,25 @@
+import os
+
+from repo_state import TreeBackedRepoState
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.file import as_lines
+
+
+@commit({'a.c': 'int a;\n', 'b.c': 'int b;\n', 'c.c': 'int c;\n'})
+def test_checkout_changes(disabled_smart_repo: SmartRepo):
+    head_tree = disabled_smart_repo.head.commit.tree
+    state = TreeBackedRepoState(disabled_smart_repo, head_tree)
+    state['b.c'] = as_lines('int b = 1;')
+    del state['c.c']
+    state['d.c'] = as_lines('int d;')
+    untouched_stat = os.stat(os.path.join(disabled_smart_repo.working_dir, 'a.c'))
+
+    assert sorted(disabled_smart_repo.checkout_changes(head_tree, state.tree)) == ['b.c', 'c.c', 'd.c']
+
+    assert os.stat(os.path.join(disabled_smart_repo.working_dir, 'a.c')) == untouched_stat
+    assert not os.path.exists(os.path.join(disabled_smart_repo.working_dir, 'c.c'))
+    with open(os.path.join(disabled_smart_repo.working_dir, 'd.c')) as file:
+        assert file.read() == 'int d;\n'
+    assert disabled_smart_repo.index.write_tree() == state.tree
+    assert not disabled_smart_repo.git.diff()
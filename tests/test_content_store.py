@@ -0,0 +1,42 @@
+import content_store
+from content_store import ContentStore, Lines
+from smart_repo import SmartRepo
+from tests.conftest import commit
+
+
+@commit({'a.c': 'int a;\n'}, tag='initial')
+@commit({'a.c': 'int a = 1;\n'})
+def test_prefetch(smart_repo: SmartRepo):
+    diff = smart_repo.commit('initial').diff('HEAD')
+    store = ContentStore(smart_repo)
+    store.prefetch(diff)
+    blobs = [blob for file_diff in diff for blob in (file_diff.a_blob, file_diff.b_blob)]
+    assert len(blobs) == 4
+    assert all(blob.binsha in store for blob in blobs)
+    assert [store.read(blob) for blob in blobs] == [blob.data_stream.read() for blob in blobs]
+
+
+@commit({'a.c': 'int a;\nint b;\n\nint c;'})
+def test_iter_lines(smart_repo: SmartRepo, monkeypatch):
+    monkeypatch.setattr(content_store, 'STREAM_CHUNK_SIZE', 3)
+    blob = smart_repo.head.commit.tree['a.c']
+    store = ContentStore(smart_repo)
+    assert list(store.iter_lines(blob)) == [b'int a;\n', b'int b;\n', b'\n', b'int c;']
+    assert blob.binsha not in store
+    assert list(store.iter_lines(blob)) == store.lines(blob)
+
+
+@commit({'a.c': 'int a;\r\nint b;\n\nint c;'})
+def test_buffers(smart_repo: SmartRepo):
+    blob = smart_repo.head.commit.tree['a.c']
+    store = ContentStore(smart_repo)
+    lines = store.buffer(blob)
+    assert isinstance(lines, Lines)
+    assert lines == store.lines(blob) == [b'int a;\r\n', b'int b;\n', b'\n', b'int c;']
+    assert lines[1:3] == [b'int b;\n', b'\n'] and lines[1:3].buffer is lines.buffer
+    assert lines[-1].tobytes() == b'int c;'
+    assert lines.tobytes() is store.read(blob)
+    # Equal contents share a buffer, however they were built.
+    assert store.intern(store.lines(blob)).buffer is lines.buffer
+    assert store.intern([b'x\n']).buffer is store.intern([b'x', b'\n']).buffer
+    assert store.intern([]) == []
@@ -0,0 +1,51 @@
+import pickle
+
+import pytest
+from clang.cindex import CursorKind
+
+from cursor_path import CursorPath
+from smart_repo import SmartRepo
+from tests.conftest import commit
+
+
+def test_interned():
+    path = CursorPath(('a.c', 'main()', (CursorKind.COMPOUND_STMT, 0), (CursorKind.DECL_STMT, 1), 'a'))
+
+    assert CursorPath.from_json(path.to_json()) is path
+    assert pickle.loads(pickle.dumps(path)) is path
+    assert path.drop(1).appended('a') is path
+    assert path.drop(2) is path.drop(1).parent
+    assert path.drop(1).appended('b') != path
+    assert hash(CursorPath(('a.c', 'main()'))) == hash(path.drop(3))
+
+
+def test_representation():
+    path = CursorPath(('a.c', 'main()', (CursorKind.COMPOUND_STMT, 0), 'a'))
+
+    assert path.file == 'a.c'
+    assert path.path == ('a.c', 'main()', (CursorKind.COMPOUND_STMT, 0), 'a')
+    assert path.to_json() == ['a.c', 'main()', ['COMPOUND_STMT', 0], 'a']
+    assert repr(path) == 'a.c:main().COMPOUND_STMT#0.a'
+    assert path.with_file('b.c').path == ('b.c', 'main()', (CursorKind.COMPOUND_STMT, 0), 'a')
+
+
+@commit({'a.c': '''int main() {
+    int a = 0;
+    int b = a;
+    return b;
+}
+'''})
+def test_locate_many(smart_repo: SmartRepo):
+    main = CursorPath(('a.c', 'main()', (CursorKind.COMPOUND_STMT, 0)))
+    a = CursorPath(main.path + ((CursorKind.DECL_STMT, 0), 'a'))
+    b = CursorPath(main.path + ((CursorKind.DECL_STMT, 1), 'b'))
+    missing = CursorPath(main.path + ((CursorKind.DECL_STMT, 2), 'c'))
+    other_file = CursorPath(('b.c', 'main()'))
+    with smart_repo.ast(smart_repo.contents('a.c'), 'a.c') as translation_unit:
+        located = CursorPath.locate_many(translation_unit, [a, b, missing, other_file], 'a.c')
+        assert located[a].spelling == 'a' and located[a] == a.locate(translation_unit, 'a.c')
+        assert located[b].spelling == 'b'
+        assert isinstance(located[missing], KeyError)
+        assert isinstance(located[other_file], KeyError)
+        with pytest.raises(KeyError):
+            missing.locate(translation_unit, 'a.c')
@@ -0,0 +1,51 @@
+import os
+
+from click.testing import CliRunner
+
+import smart_git
+from changes import TextualChange, VariableRenamed
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.repo import get_changes
+
+SOURCE = '''int main() {
+    int value = 0;
+    return value;
+}
+'''
+
+
+def _rename_and_commit(smart_repo: SmartRepo, runner: CliRunner):
+    with open(os.path.join(smart_repo.working_dir, 'a.c'), 'w') as file:
+        file.write(SOURCE.replace('value', 'renamed'))
+    smart_repo.index.add(['a.c'])
+    result = runner.invoke(smart_git.pre_commit, [smart_repo.working_dir])
+    assert result.exit_code == 0, result.output
+    smart_repo.index.add(['.changes'])
+    smart_repo.index.commit('Rename', skip_hooks=True)
+    return result.output
+
+
+@commit({'a.c': SOURCE})
+def test_within_limits(smart_repo: SmartRepo, runner: CliRunner):
+    assert 'Recorded textual changes' not in _rename_and_commit(smart_repo, runner)
+    assert [type(change) for change in get_changes(smart_repo)[-1]] == [VariableRenamed]
+
+
+@commit({'a.c': SOURCE})
+def test_file_limit(smart_repo: SmartRepo, runner: CliRunner):
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'maxFileLines', '3')
+    output = _rename_and_commit(smart_repo, runner)
+    assert 'Recorded textual changes to a.c: 4 lines exceed the limit of 3.' in output
+    assert {type(change) for change in get_changes(smart_repo)[-1]} == {TextualChange}
+    assert smart_repo.contents('a.c') == SOURCE.replace('value', 'renamed').encode('utf-8').splitlines(keepends=True)
+
+
+@commit({'a.c': SOURCE})
+def test_time_budget(smart_repo: SmartRepo, runner: CliRunner):
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'detectionBudget', '0.000001')
+    output = _rename_and_commit(smart_repo, runner)
+    assert 'Recorded textual changes to a.c: the detection budget of 1e-06s was used up.' in output
+    assert {type(change) for change in get_changes(smart_repo)[-1]} == {TextualChange}
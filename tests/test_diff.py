@@ -0,0 +1,47 @@
+import random
+from typing import List, Sequence
+
+from utils import diff as diff_module
+from utils.diff import Hunk, diff
+
+
+def _patch(a: Sequence, b: Sequence, hunks: List[Hunk]) -> list:
+    patched = list(a)
+    for hunk in reversed(hunks):
+        patched[hunk.a_start:hunk.a_end] = b[hunk.b_start:hunk.b_end]
+    return patched
+
+
+def test_hunks():
+    a = [b'int a;\n', b'int b;\n', b'int c;\n', b'int d;\n']
+    b = [b'int a;\n', b'int x;\n', b'int c;\n', b'int d;\n', b'int e;\n']
+    assert diff(a, b) == [Hunk(1, 2, 1, 2), Hunk(4, 4, 4, 5)]
+    assert diff(a, a) == []
+    assert diff([], a) == [Hunk(0, 0, 0, 4)]
+    assert diff(a, []) == [Hunk(0, 4, 0, 0)]
+
+
+def test_random_edits(monkeypatch):
+    rng = random.Random(0)
+    # Small alphabets make every item common, so that both the histogram diff and its Myers fallback are exercised.
+    monkeypatch.setattr(diff_module, 'MAX_CHAIN_LENGTH', 4)
+    for _ in range(500):
+        a = [rng.randrange(8) for _ in range(rng.randrange(60))]
+        b = list(a)
+        for _ in range(rng.randrange(10)):
+            position = rng.randrange(len(b) + 1)
+            if rng.random() < 0.5:
+                b.insert(position, rng.randrange(12))
+            else:
+                del b[position:position + 1]
+        hunks = diff(a, b)
+        assert _patch(a, b, hunks) == b
+        assert all(hunk.a_start < hunk.a_end or hunk.b_start < hunk.b_end for hunk in hunks)
+        assert all(previous.a_end < hunk.a_start for previous, hunk in zip(hunks, hunks[1:]))
+
+
+def test_myers_is_minimal():
+    a, b = list('abcabba'), list('cbabac')
+    interner = diff_module.Interner()
+    matches = diff_module._myers(interner.ids(a), interner.ids(b), 0, len(a), 0, len(b))
+    assert sum(length for _, _, length in matches) == 4
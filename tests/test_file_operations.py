@@ -0,0 +1,42 @@
+import os
+
+from changes.file_operations import FileRenamed, FileAdded, FileDeleted
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.file import as_lines
+from utils.repo import detect_changes
+from utils.similarity import pair_similar
+
+LINES = [f'int variable{i} = {i};' for i in range(10)]
+
+
+@commit({'a.c': '\n'.join(LINES) + '\n'})
+def test_similar_rename(smart_repo: SmartRepo):
+    # Too different for git to detect a rename, but similar enough for the default threshold.
+    edited = LINES[:7] + [f'{line} // {"edited " * 10}' for line in LINES[7:]]
+    os.remove(os.path.join(smart_repo.working_dir, 'a.c'))
+    with open(os.path.join(smart_repo.working_dir, 'b.c'), 'w') as file:
+        file.write('\n'.join(edited) + '\n')
+    smart_repo.index.remove(['a.c'])
+    smart_repo.index.add(['b.c'])
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'renameThreshold', '0.6')
+    assert [type(change) for change in detect_changes(smart_repo, smart_repo.head.commit.tree)] \
+        == [FileAdded, FileDeleted]
+    with smart_repo.config_writer() as config:
+        config.remove_option('smart', 'renameThreshold')
+
+    changes = detect_changes(smart_repo, smart_repo.head.commit.tree)
+    assert changes[0] == FileRenamed('a.c', 'b.c')
+    # Followed by the edits to the renamed file.
+    assert changes[1:] and all(change.touched_paths() == ('b.c', ) for change in changes[1:])
+
+
+def test_pair_similar():
+    files = {f'dir/file{i}.c': as_lines(*(f'int f{i}_{j}(void) {{ return {i * j}; }}' for j in range(20)))
+             for i in range(2000)}
+    moved = {f'moved/{path}': lines[:-2] + as_lines('// moved') for path, lines in files.items()}
+    moved['moved/unrelated.c'] = as_lines('int unrelated;')
+    pairs = pair_similar(files, moved, 0.5)
+    assert sorted((before, after) for before, after, _ in pairs) == sorted((path, f'moved/{path}') for path in files)
+    assert all(0.8 < similarity < 1 for _, _, similarity in pairs)
@@ -47,3 +47,30 @@ def test_disable(disabled_smart_repo):
 def test_enable(disabled_smart_repo, runner: CliRunner):
     runner.invoke(smart_git.enable, [disabled_smart_repo.working_dir])
     assert smart_git.RepoStatus.of(disabled_smart_repo.working_dir) == smart_git.RepoStatus.installed_enabled
+
+
+def test_leftover_post_commit_hook(smart_repo: Repo):
+    smart_repo.git.config('--remove-section', 'smart')
+    os.remove(os.path.join(smart_repo.git_dir, 'hooks', 'pre-commit'))
+    assert smart_git.RepoStatus.of(smart_repo.working_dir) == smart_git.RepoStatus.bad_installation
+
+
+def test_upgrade_hooks(smart_repo: Repo, runner: CliRunner):
+    # As installed before the hooks went through the client, and before there was a post-commit hook.
+    os.remove(os.path.join(smart_repo.git_dir, 'hooks', 'post-commit'))
+    with open(os.path.join(smart_repo.git_dir, 'hooks', 'pre-commit'), 'w') as hook:
+        hook.write('#!/bin/sh\n' + smart_git.LEGACY_PRE_COMMIT_HOOK)
+    result = runner.invoke(smart_git.print_status, [smart_repo.working_dir])
+    assert result.output.startswith('bad_installation\n')
+    assert 'git smart upgrade-hooks' in result.output
+    # Reading the status leaves the hooks as they are.
+    assert not os.path.exists(os.path.join(smart_repo.git_dir, 'hooks', 'post-commit'))
+
+    result = runner.invoke(smart_git.upgrade_hooks, [smart_repo.working_dir])
+    assert result.exit_code == 0, result.output
+    assert smart_git.RepoStatus.of(smart_repo.working_dir) == smart_git.RepoStatus.installed_enabled
+    for hook_name, command in smart_git.HOOKS:
+        with open(os.path.join(smart_repo.git_dir, 'hooks', hook_name)) as hook:
+            assert hook.read() == '#!/bin/sh\n' + command
+    diffs = _test_commit(smart_repo)
+    assert any(d.a_path == d.b_path == repo.CHANGES_FILE_NAME for d in diffs)
@@ -1,11 +1,15 @@
 from clang.cindex import CursorKind
+from click.testing import CliRunner
 
-from changes import FileAdded, SubASTInserted, VariableRenamed
+import smart_git
+import smart_merge
+from changes import FileAdded, FileDeleted, FileRenamed, SubASTInserted, VariableRenamed
 from cursor_path import CursorPath
+from smart_merge import interacting, partition, split_logs
 from smart_repo import SmartRepo
 from tests.conftest import commit, merge
 from utils.file import as_lines
-from utils.repo import get_changes
+from utils.repo import get_changes, encode_changes_line, decode_changes_line, line_header, EntryHeader
 
 
 @commit({'a.c': '''
@@ -57,3 +61,179 @@ def test_rename_add_merge(smart_repo: SmartRepo):
     assert smart_repo.contents('a.c', 'other-to-master')\
         == smart_repo.contents('a.c', 'master-to-other') \
         == final_contents
+
+
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    return a;
+}
+''', 'b.c': '''int f() {
+    return 1;
+}
+'''}, tag='initial')
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    a += 1;
+    return a;
+}
+'''}, on='add-line', tag='add-line')
+@commit({'b.c': '''/* f */
+int f() {
+    return 1;
+}
+'''}, on='edit', tag='edit')
+@commit({'a.c': '''
+int main() {
+    int b = 0;
+    return b;
+}
+'''}, tag='rename')
+def test_octopus_merge(smart_repo: SmartRepo, runner: CliRunner):
+    result = runner.invoke(smart_git.merge, [smart_repo.working_dir, 'add-line', 'edit'])
+    assert result.exit_code == 0, result.output
+
+    merged = smart_repo.head.commit
+    assert tuple(merged.parents) == (smart_repo.rev_parse('rename'), smart_repo.rev_parse('add-line'),
+                                     smart_repo.rev_parse('edit'))
+    assert [[change.name() for change in changes] for changes in get_changes(smart_repo)] \
+        == [['file-added', 'file-added'], ['variable-renamed'], ['insert-sub-ast'], ['text']]
+    assert smart_repo.contents('a.c') == as_lines('',
+                                                  'int main() {',
+                                                  '    int b = 0;',
+                                                  '    b += 1;',
+                                                  '    return b;',
+                                                  '}')
+    assert smart_repo.contents('b.c') == smart_repo.contents('b.c', 'edit')
+    assert not smart_repo.is_dirty()
+
+
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    return a;
+}
+''', 'b.c': '''int f() {
+    int x = 1;
+    return x;
+}
+'''}, tag='initial')
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    a += 1;
+    return a;
+}
+''', 'b.c': '''int f() {
+    int x = 1;
+    x *= 2;
+    return x;
+}
+'''}, on='other', tag='other')
+@commit({'a.c': '''
+int main() {
+    int b = 0;
+    return b;
+}
+'''}, tag='rename')
+def test_parallel_merge(smart_repo: SmartRepo, runner: CliRunner):
+    result = runner.invoke(smart_git.merge, [smart_repo.working_dir, '--jobs', '2', 'other'])
+    assert result.exit_code == 0, result.output
+
+    assert [[change.name() for change in changes] for changes in get_changes(smart_repo)] \
+        == [['file-added', 'file-added'], ['variable-renamed'], ['insert-sub-ast', 'insert-sub-ast']]
+    assert smart_repo.contents('a.c') == as_lines('',
+                                                  'int main() {',
+                                                  '    int b = 0;',
+                                                  '    b += 1;',
+                                                  '    return b;',
+                                                  '}')
+    assert smart_repo.contents('b.c') == smart_repo.contents('b.c', 'other')
+    assert not smart_repo.is_dirty()
+
+
+def test_partition():
+    a_added, b_added, c_added = (FileAdded(path, []) for path in ('a.c', 'b.c', 'c.c'))
+    partitions = partition([[a_added, b_added], [FileRenamed('b.c', 'd.c')], [FileDeleted('c.c', [])]],
+                           [[c_added], [FileRenamed('a.c', 'e.c')]])
+    assert sorted([key for key, _ in changes] for changes in partitions) \
+        == [[(0, 0)], [(0, 1), (1, 0)], [(2, 0)]]
+
+
+def test_split_logs():
+    missing, to_rebase = split_logs([b'0\n', b'1 a\n', b'2 b\n'], [b'0\n', b'1 c\n'])
+    assert (missing, list(to_rebase)) == ([b'1 a\n', b'2 b\n'], [b'1 c\n'])
+    missing, to_rebase = split_logs([b'0\n'], [b'0\n', b'1 c\n'])
+    assert (missing, list(to_rebase)) == ([], [b'1 c\n'])
+    missing, to_rebase = split_logs([b'0\n', b'1 a\n'], [b'0\n'])
+    assert (missing, list(to_rebase)) == ([b'1 a\n'], [])
+
+
+def test_interacting():
+    missing = [encode_changes_line(i, changes) for i, changes in enumerate([
+        [FileAdded('c.c', [])], [FileRenamed('a.c', 'e.c')], [FileDeleted('e.c', [])], [FileAdded('x.c', [])]])]
+    rebased = [encode_changes_line(4, [FileDeleted('a.c', [])])]
+    assert interacting(missing, rebased) == [False, True, True, False]
+    # Lines written without headers may hold anything.
+    assert interacting(missing, [b'4 [{"type": "file-deleted", "file_name": "a.c", "content": []}]']) == [True] * 4
+
+
+def test_header(smart_repo: SmartRepo):
+    changes = [FileAdded('dir/a b,c:d.c', [b'int a;\n']), FileRenamed('x.c', 'y.c')]
+    line = encode_changes_line(3, changes)
+    assert line_header(line) == EntryHeader(frozenset({'file-added', 'file-renamed'}),
+                                            frozenset({'dir/a b,c:d.c', 'x.c', 'y.c'}))
+    assert decode_changes_line(smart_repo, line) == (3, changes)
+
+
+LINES = ''.join(f'// line {i}\n' for i in range(1, 11))
+EDITED_LINES = LINES.replace('// line 1\n', '// line 1\n// new A\n').replace('// line 6\n', '// line 6\n// new B\n')
+
+
+def _check_multi_hunk_merge(smart_repo: SmartRepo, runner: CliRunner, jobs: int):
+    result = runner.invoke(smart_git.merge, [smart_repo.working_dir, '--jobs', str(jobs), 'other'])
+    assert result.exit_code == 0, result.output
+    assert [[change.name() for change in changes] for changes in get_changes(smart_repo)][-1] \
+        == ['text', 'text', 'text']
+    assert smart_repo.contents('a.c') == smart_repo.contents('a.c', 'other')
+    assert smart_repo.contents('c.c') == smart_repo.contents('c.c', 'other')
+    assert smart_repo.contents('b.c') == smart_repo.contents('b.c', 'master^1')
+
+
+@commit({'a.c': LINES, 'c.c': '// c\n'})
+@commit({'a.c': EDITED_LINES, 'c.c': '// c\n// new C\n'}, on='other', tag='other')
+@commit({'b.c': 'int f();\n'})
+def test_multi_hunk_merge(smart_repo: SmartRepo, runner: CliRunner):
+    _check_multi_hunk_merge(smart_repo, runner, 1)
+
+
+@commit({'a.c': LINES, 'c.c': '// c\n'})
+@commit({'a.c': EDITED_LINES, 'c.c': '// c\n// new C\n'}, on='other', tag='other')
+@commit({'b.c': 'int f();\n'})
+def test_parallel_multi_hunk_merge(smart_repo: SmartRepo, runner: CliRunner):
+    _check_multi_hunk_merge(smart_repo, runner, 2)
+
+
+def _check_unrelated_changes_merge(smart_repo: SmartRepo, runner: CliRunner):
+    result = runner.invoke(smart_git.merge, [smart_repo.working_dir, 'other'])
+    assert result.exit_code == 0, result.output
+    assert smart_repo.contents('a.c') == as_lines('// line 1', '// changed 2', *(f'// line {i}' for i in range(3, 9)),
+                                                  '// changed 9', '// line 10')
+    assert smart_repo.contents('b.c', 'master^1') == smart_repo.contents('b.c')
+
+
+@commit({'a.c': LINES})
+@commit({'a.c': LINES.replace('line 2', 'changed 2')}, on='other')
+@commit({'a.c': LINES.replace('line 9', 'changed 9'), 'b.c': 'int f();\n'})
+def test_unrelated_changes_merge(smart_repo: SmartRepo, runner: CliRunner):
+    _check_unrelated_changes_merge(smart_repo, runner)
+
+
+@commit({'a.c': LINES})
+@commit({'a.c': LINES.replace('line 2', 'changed 2')}, on='other')
+@commit({'a.c': LINES.replace('line 9', 'changed 9'), 'b.c': 'int f();\n'})
+def test_unrelated_changes_merge_without_headers(smart_repo: SmartRepo, runner: CliRunner, monkeypatch):
+    # As if the change log was written before lines had headers.
+    monkeypatch.setattr(smart_merge, 'line_header', lambda line: None)
+    _check_unrelated_changes_merge(smart_repo, runner)
@@ -0,0 +1,67 @@
+import os
+from typing import Set
+
+import git
+
+from repo_state import TreeBackedRepoState
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.file import as_lines
+
+
+def _on_disk(repo: SmartRepo, binsha: bytes) -> bool:
+    try:
+        repo.git.cat_file('-e', binsha.hex())
+    except git.GitCommandError:
+        return False
+    return True
+
+
+def _loose_objects(repo: SmartRepo) -> Set[str]:
+    objects_dir = os.path.join(repo.git_dir, 'objects')
+    return {directory + name for directory in os.listdir(objects_dir) if len(directory) == 2
+            for name in os.listdir(os.path.join(objects_dir, directory))}
+
+
+@commit({'a.c': 'int a;\n'})
+def test_persist_reachable(smart_repo: SmartRepo):
+    with smart_repo.overlay_odb() as odb:
+        state = TreeBackedRepoState(smart_repo, smart_repo.head.commit.tree)
+        state['a.c'] = as_lines('int b;')
+        intermediate = state.tree['a.c'].binsha
+        state['a.c'] = as_lines('int c;')
+        assert not _on_disk(smart_repo, state.tree.binsha)
+        assert odb.persist(state.tree.binsha, pack=False) == 2
+    assert not _on_disk(smart_repo, intermediate)
+    assert _on_disk(smart_repo, state.tree.binsha)
+    assert smart_repo.git.cat_file('-p', f'{state.tree.hexsha}:a.c') == 'int c;'
+
+
+@commit({'a.c': 'int a;\n'})
+def test_persist_pack(smart_repo: SmartRepo):
+    pack_dir = os.path.join(smart_repo.git_dir, 'objects', 'pack')
+    packs_before = set(os.listdir(pack_dir))
+    with smart_repo.overlay_odb() as odb:
+        state = TreeBackedRepoState(smart_repo, smart_repo.head.commit.tree)
+        state['b.c'] = as_lines('int b;')
+        odb.persist(state.tree.binsha, pack=True)
+    assert len(set(os.listdir(pack_dir)) - packs_before) == 2
+    assert smart_repo.git.cat_file('-p', f'{state.tree.hexsha}:b.c') == 'int b;'
+
+
+@commit({'a.c': 'int a;\n'})
+def test_memory_limit(smart_repo: SmartRepo):
+    objects_before = _loose_objects(smart_repo)
+    with smart_repo.overlay_odb(memory_limit=16) as odb:
+        state = TreeBackedRepoState(smart_repo, smart_repo.head.commit.tree)
+        state['a.c'] = as_lines('int b;')
+        intermediate = state.tree['a.c'].binsha
+        state['a.c'] = as_lines('int c;', '/* longer than the limit */')
+        # Past the limit, objects are spilled out of memory rather than written to the repository.
+        assert odb._memory_size <= 16
+        assert not _on_disk(smart_repo, intermediate)
+        assert odb.stream(state.tree['a.c'].binsha).read() == b'int c;\n/* longer than the limit */\n'
+        assert odb.persist(state.tree.binsha, pack=False) == 2
+    assert not _on_disk(smart_repo, intermediate)
+    assert smart_repo.git.cat_file('-p', f'{state.tree.hexsha}:a.c') == 'int c;\n/* longer than the limit */'
+    assert _loose_objects(smart_repo) - objects_before == {state.tree.hexsha, state.tree['a.c'].hexsha}
@@ -0,0 +1,73 @@
+import json
+import os
+
+from clang.cindex import CursorKind
+
+from parse_options import STRUCTURE_ONLY, FULL, ParseProfile
+from smart_repo import SmartRepo
+from tests.conftest import commit
+
+SOURCE = '''#ifdef FEATURE
+int feature;
+#endif
+int main() {
+    int a = 0;
+    return a;
+}
+'''
+
+
+def _top_level_names(smart_repo: SmartRepo, profile: ParseProfile = FULL):
+    with smart_repo.ast(smart_repo.contents('a.c'), 'a.c', profile) as translation_unit:
+        return [cursor.spelling for cursor in translation_unit.cursor.get_children()
+                if cursor.spelling in ('feature', 'main')]
+
+
+def _main_body(smart_repo: SmartRepo, profile: ParseProfile):
+    with smart_repo.ast(smart_repo.contents('a.c'), 'a.c', profile) as translation_unit:
+        main, = (cursor for cursor in translation_unit.cursor.get_children() if cursor.spelling == 'main')
+        return [cursor.kind for cursor in main.walk_preorder()]
+
+
+@commit({'a.c': SOURCE})
+def test_structure_only(smart_repo: SmartRepo):
+    assert CursorKind.COMPOUND_STMT in _main_body(smart_repo, FULL)
+    assert CursorKind.COMPOUND_STMT not in _main_body(smart_repo, STRUCTURE_ONLY)
+    assert _top_level_names(smart_repo, STRUCTURE_ONLY) == ['main']
+
+
+@commit({'a.c': SOURCE})
+def test_clang_args(smart_repo: SmartRepo):
+    assert _top_level_names(smart_repo) == ['main']
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'clangArgs', '-DFEATURE')
+    smart_repo.end_session()
+    assert _top_level_names(smart_repo) == ['feature', 'main']
+
+
+@commit({'a.c': SOURCE})
+def test_compile_commands(smart_repo: SmartRepo):
+    with open(os.path.join(smart_repo.working_dir, 'compile_commands.json'), 'w') as commands:
+        json.dump([{'directory': smart_repo.working_dir, 'file': 'a.c',
+                    'arguments': ['cc', '-DFEATURE', '-Iinclude', '-c', 'a.c', '-o', 'a.o']}], commands)
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'compileCommands', 'compile_commands.json')
+    include = '-I' + os.path.join(smart_repo.working_dir, 'include')
+    assert smart_repo.parse_settings.file_args('a.c') == ('-DFEATURE', include)
+    assert smart_repo.parse_settings.file_args('b.c') == ('-DFEATURE', include)
+    assert _top_level_names(smart_repo) == ['feature', 'main']
+
+
+@commit({'a.c': 'int main() { return CONSTANT; }\n', 'common.h': '#define CONSTANT 1\nint common;\n'})
+def test_precompiled_header(smart_repo: SmartRepo):
+    with smart_repo.config_writer() as config:
+        config.set_value('smart', 'precompiledHeader', 'common.h')
+    with smart_repo.ast(smart_repo.contents('a.c'), 'a.c') as translation_unit:
+        assert not [diagnostic for diagnostic in translation_unit.diagnostics if diagnostic.severity >= 3]
+        assert 'common' in [cursor.spelling for cursor in translation_unit.cursor.get_children()]
+    with smart_repo.ast(smart_repo.contents('a.c'), 'a.c') as translation_unit:
+        assert 'common' in [cursor.spelling for cursor in translation_unit.cursor.get_children()]
+    pch_dir = smart_repo.parse_settings._pch_dir
+    assert os.path.isdir(pch_dir)
+    smart_repo.end_session()
+    assert not os.path.exists(pch_dir)
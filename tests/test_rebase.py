@@ -0,0 +1,113 @@
+from click.testing import CliRunner
+
+import smart_git
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.file import as_lines
+from utils.repo import get_changes
+
+
+def _check_rebase(smart_repo: SmartRepo, runner: CliRunner):
+    smart_repo.heads.topic.checkout()
+    result = runner.invoke(smart_git.rebase, [smart_repo.working_dir, 'master'])
+    assert result.exit_code == 0, result.output
+
+    rebased = smart_repo.head.commit
+    assert smart_repo.head.reference.name == 'topic'
+    assert rebased.parents[0].parents == (smart_repo.rev_parse('rename'), )
+    assert [commit.message for commit in (rebased.parents[0], rebased)] \
+        == [smart_repo.commit('add-line').message, smart_repo.commit('edit').message]
+    assert smart_repo.rev_parse('ORIG_HEAD') == smart_repo.rev_parse('edit')
+    assert [[change.name() for change in changes] for changes in get_changes(smart_repo)] \
+        == [['file-added', 'file-added'], ['variable-renamed'], ['insert-sub-ast'], ['text']]
+    assert smart_repo.contents('a.c', 'topic~1') == as_lines('',
+                                                             'int main() {',
+                                                             '    int b = 0;',
+                                                             '    b += 1;',
+                                                             '    return b;',
+                                                             '}')
+    assert smart_repo.contents('b.c') == smart_repo.contents('b.c', 'edit')
+    assert not smart_repo.is_dirty()
+    with open(f'{smart_repo.working_dir}/a.c', 'rb') as file:
+        assert file.read().splitlines(keepends=True) == smart_repo.contents('a.c')
+
+
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    return a;
+}
+''', 'b.c': '''int f() {
+    return 1;
+}
+'''}, tag='initial')
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    a += 1;
+    return a;
+}
+'''}, on='topic', tag='add-line')
+@commit({'b.c': '''/* f */
+int f() {
+    return 1;
+}
+'''}, on='topic', tag='edit')
+@commit({'a.c': '''
+int main() {
+    int b = 0;
+    return b;
+}
+'''}, tag='rename')
+def test_rebase(smart_repo: SmartRepo, runner: CliRunner):
+    _check_rebase(smart_repo, runner)
+
+
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    return a;
+}
+''', 'b.c': '''int f() {
+    return 1;
+}
+'''}, tag='initial')
+@commit({'a.c': '''
+int main() {
+    int a = 0;
+    a += 1;
+    return a;
+}
+'''}, on='topic', tag='add-line')
+@commit({'b.c': '''/* f */
+int f() {
+    return 1;
+}
+'''}, on='topic', tag='edit')
+@commit({'a.c': '''
+int main() {
+    int b = 0;
+    return b;
+}
+'''}, tag='rename')
+def test_rebase_with_notes(notes_smart_repo: SmartRepo, runner: CliRunner):
+    _check_rebase(notes_smart_repo, runner)
+
+
+@commit({'a.c': 'int main() {\n    return 0;\n}\n'}, tag='initial')
+@commit({'b.c': 'int f() {\n    return 1;\n}\n'}, tag='upstream')
+def test_rebase_behind(smart_repo: SmartRepo, runner: CliRunner):
+    smart_repo.create_head('topic', 'initial').checkout()
+    result = runner.invoke(smart_git.rebase, [smart_repo.working_dir, 'master'])
+    assert result.exit_code == 0, result.output
+    assert 'Fast-forwarded the branch to master' in result.output
+    assert smart_repo.head.reference.name == 'topic'
+    assert smart_repo.head.commit == smart_repo.commit('upstream')
+    assert smart_repo.rev_parse('ORIG_HEAD') == smart_repo.commit('initial')
+    assert not smart_repo.is_dirty()
+    with open(f'{smart_repo.working_dir}/b.c', 'rb') as file:
+        assert file.read().splitlines(keepends=True) == smart_repo.contents('b.c')
+
+    result = runner.invoke(smart_git.rebase, [smart_repo.working_dir, 'master'])
+    assert result.exit_code == 0, result.output
+    assert 'The branch is up to date with master' in result.output
@@ -3,7 +3,7 @@ from clang.cindex import CursorKind
 from changes.file_operations import FileAdded
 from changes.variable_rename import VariableRenamed
 from repo_state import TreeBackedRepoState
-from smart_repo import SmartRepo
+from smart_repo import SmartRepo, stats
 from tests.conftest import commit
 from utils.file import as_lines
 from utils.repo import get_changes
@@ -25,6 +25,24 @@ def test_apply(smart_repo: SmartRepo):
                                     '}')
 
 
+@commit({'a.c': '''int main() {
+    int a = 0;
+    return a + (a - 1);
+}
+'''})
+def test_apply_reparses(smart_repo: SmartRepo):
+    state = TreeBackedRepoState(smart_repo, smart_repo.head.commit.tree)
+    a = smart_repo.find_cursor('a.c', lambda cur: cur.kind == CursorKind.VAR_DECL and cur.spelling == 'a')
+    parses, reparses = stats['parses'], stats['reparses']
+    VariableRenamed(a, 'meow').apply(smart_repo, state)
+    VariableRenamed(a.drop(1).appended('meow'), 'woof').apply(smart_repo, state)
+    assert (stats['parses'] - parses, stats['reparses'] - reparses) == (1, 1)
+    assert state['a.c'] == as_lines('int main() {',
+                                    '    int woof = 0;',
+                                    '    return woof + (woof - 1);',
+                                    '}')
+
+
 @commit({'a.c': '''
 int main() {
     int a = 0;
@@ -0,0 +1,28 @@
+import os
+import threading
+
+import smart_git_client
+from server import SmartGitServer
+from smart_repo import SmartRepo
+from utils.repo import CHANGES_FILE_NAME
+
+
+def test_no_server(smart_repo: SmartRepo):
+    assert smart_git_client.request(['pre-commit', smart_repo.working_dir]) is None
+
+
+def test_forward_pre_commit(smart_repo: SmartRepo):
+    with open(os.path.join(smart_repo.working_dir, 'a.c'), 'w') as file:
+        file.write('int main() { }\n')
+    smart_repo.index.add(['a.c'])
+    with SmartGitServer(smart_repo.working_dir) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            exit_code, stdout, stderr = smart_git_client.request(['pre-commit', smart_repo.working_dir])
+        finally:
+            server.shutdown()
+            thread.join()
+    assert (exit_code, stdout, stderr) == (0, '[smart-git] Recorded 1 change.\n', '')
+    assert any(path == CHANGES_FILE_NAME for path, _ in smart_repo.index.entries)
+    assert not os.path.exists(smart_git_client.socket_path(smart_repo.working_dir))
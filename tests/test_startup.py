@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+from git import Repo
+
+import smart_git
+
+# Total time (in seconds) that `smart_git.py status` may spend importing modules, as reported by `python -X importtime`.
+STATUS_IMPORT_TIME_BUDGET = 0.1
+
+HEAVY_MODULES = ('git', 'gitdb', 'clang', 'unidiff', 'changes', 'smart_repo', 'repo_state')
+
+
+def _import_times(*args: str):
+    """ Run smart_git.py with the given arguments and return the self import time (in seconds) of each module. """
+    result = subprocess.run([sys.executable, '-X', 'importtime', smart_git.__file__, *args],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+                            cwd=os.path.dirname(smart_git.__file__))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, _, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(self_time) / 1e6
+    return times
+
+
+def test_status_import_time(empty_repo: Repo):
+    times = _import_times('status', empty_repo.working_dir)
+    assert not [module for module in times if module.split('.')[0] in HEAVY_MODULES]
+    assert sum(times.values()) < STATUS_IMPORT_TIME_BUDGET
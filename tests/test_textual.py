@@ -1,6 +1,6 @@
 import git
 
-from changes.file_operations import FileAdded
+from changes.file_operations import FileAdded, FileRenamed
 from changes.textual_change import TextualChange
 from tests.conftest import commit
 from utils.repo import get_changes
@@ -21,3 +21,9 @@ def test_textual(smart_repo: git.Repo):
     assert get_changes(smart_repo) \
         == [[FileAdded('a.c', as_lines('', '/// asjdlkdsjalkdsa', '/// asdkjasdlkjd', '/// aaa'))],
             [TextualChange('a.c', 1, 4, as_lines('// asjdlkdsjalkdsa', '// asdkjasdlkjd', '// aaa'))]]
+
+
+def test_transform_across_files():
+    change = TextualChange('a.c', 1, 2, as_lines('int b;'))
+    assert change.transform(None, FileAdded('b.c', [])) is change
+    assert change.transform(None, FileRenamed('a.c', 'c.c')) == TextualChange('c.c', 1, 2, as_lines('int b;'))
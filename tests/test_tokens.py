@@ -0,0 +1,40 @@
+from typing import List
+
+from clang.cindex import Cursor
+
+from smart_repo import SmartRepo
+from tests.conftest import commit
+from utils.tokens import TokenTable, _arrays
+
+SOURCE = '''#define INCREMENT(x) ((x) + 1)
+int main() {
+    int a = INCREMENT(0);
+    int b = "\\u00e9" [0];
+    return a + b;
+}
+'''
+
+
+def _statements(translation_unit) -> List[Cursor]:
+    main, = (cursor for cursor in translation_unit.cursor.get_children() if cursor.spelling == 'main')
+    body, = main.get_children()
+    return list(body.get_children())
+
+
+@commit({'a.c': SOURCE, 'b.c': SOURCE.replace('int b', 'int c').replace('+ b', '+ c')})
+def test_token_table(smart_repo: SmartRepo):
+    with smart_repo.ast(smart_repo.contents('a.c'), 'a.c') as a, smart_repo.ast(smart_repo.contents('b.c'), 'b.c') as b:
+        a_table, b_table = TokenTable.of(a), TokenTable.of(b)
+        assert TokenTable.of(a) is a_table
+        for cursor in list(a.cursor.walk_preorder())[1:]:
+            tokens = list(cursor.get_tokens())
+            # libclang tokenizes cursors within macro expansions beyond their extents (from the macro's definition).
+            if not tokens or cursor.extent.start.offset <= tokens[0].extent.start.offset \
+                    and tokens[-1].extent.end.offset <= cursor.extent.end.offset:
+                assert a_table.tokens(cursor) == _arrays(tokens)
+
+        a_statements, b_statements = _statements(a), _statements(b)
+        assert a_table.equal(a_statements[0], b_table, b_statements[0])
+        assert a_table.key(a_statements[0]) == b_table.key(b_statements[0])
+        assert not a_table.equal(a_statements[1], b_table, b_statements[1])
+        assert not a_table.equal(a_statements[2], b_table, b_statements[2])
@@ -0,0 +1,35 @@
+import json
+import os
+
+from click.testing import CliRunner
+
+import smart_git
+import tracing
+from smart_repo import SmartRepo
+from tests.conftest import commit
+
+
+def test_disabled_span_is_shared():
+    assert not tracing.enabled()
+    assert tracing.span('a', path='a.c') is tracing.span('b')
+
+
+@commit({'a.c': 'int main() {\n    int a = 0;\n    return a;\n}\n'})
+def test_pre_commit_trace(smart_repo: SmartRepo, runner: CliRunner, tmpdir):
+    with open(os.path.join(smart_repo.working_dir, 'a.c'), 'w') as file:
+        file.write('int main() {\n    int b = 0;\n    return b;\n}\n')
+    smart_repo.index.add(['a.c'])
+    trace_path = str(tmpdir.join('trace.json'))
+
+    result = runner.invoke(smart_git.smart_git, ['--trace', trace_path, 'pre-commit', smart_repo.working_dir])
+
+    assert result.exit_code == 0, result.output
+    assert not tracing.enabled()
+    with open(trace_path) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    assert {'detect', 'parse', 'transform', 'apply', 'write'} <= {event['name'] for event in events}
+    assert {event['args']['change_type'] for event in events if event['name'] == 'detect'} >= {'variable-renamed'}
+    assert any(event['args'] == {'path': 'a.c', 'profile': 'full'} for event in events if event['name'] == 'parse')
+    assert any(event['args'] == {'change_type': 'variable-renamed', 'paths': ['a.c']}
+               for event in events if event['name'] == 'apply')
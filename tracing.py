@@ -0,0 +1,69 @@
+"""
+Nested timing spans for the phases of smart git commands, written in the Chrome trace-event format (which can be loaded
+in Perfetto or chrome://tracing).
+
+Tracing is off unless `enable` is called (see the --trace option and SMART_GIT_TRACE), in which case `span` only returns
+a shared no-op context manager.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from typing import Optional, List, Dict, Any
+
+_NULL_SPAN = nullcontext()
+
+# The events recorded so far, or None while tracing is disabled.
+_events: Optional[List[Dict[str, Any]]] = None
+
+
+class _Span:
+    __slots__ = ('name', 'attributes', 'start')
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        if _events is not None:
+            _events.append({'name': self.name, 'ph': 'X', 'ts': self.start * 1e6, 'dur': (end - self.start) * 1e6,
+                            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': self.attributes})
+
+
+def span(name: str, **attributes):
+    """
+    Time the enclosed block as a span with the given name and attributes.
+
+    >>> with span('parse', path='a.c'):
+    ...     pass
+    """
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name, attributes)
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def enable() -> None:
+    """ Start recording spans. """
+    global _events
+    if _events is None:
+        _events = []
+
+
+def write(path: str) -> None:
+    """ Write the spans recorded so far to the given path as Chrome trace-event JSON, and stop recording. """
+    global _events
+    events, _events = _events or [], None
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
@@ -12,9 +12,9 @@ def search_ast(translation_unit: TranslationUnit, file_name: str, predicate: Cal
     """
 
     def helper(cursor: Cursor, path: CursorPath):
-        for child in cursor.get_children():
+        for child, child_path in path.children(cursor):
             if predicate(child):
-                yield path.appended(cursor, child)
-            yield from helper(child, path.appended(cursor, child))
+                yield child_path
+            yield from helper(child, child_path)
 
     yield from helper(translation_unit.cursor, CursorPath((file_name, )))
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""
+Diffing sequences of hashable items, such as the lines of a file or the token keys of the children of an AST node.
+
+Items are interned to integer ids first, so that the diff itself only compares small integers. The diff is a histogram
+diff (as in git): the rarest item that both sides share anchors the longest common run around it, and both sides of the
+run are diffed recursively. Regions where every shared item is too common to be a good anchor fall back to Myers' greedy
+algorithm, bounded by MAX_MYERS_COST. The result is a list of hunks, rather than text to be parsed again.
+"""
+from array import array
+from typing import Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+# Items occurring more than this many times in a region are not used as anchors of the histogram diff.
+MAX_CHAIN_LENGTH = 64
+# The maximal number of edits Myers' algorithm looks for, beyond which a region is considered replaced as a whole.
+MAX_MYERS_COST = 1024
+
+# A common run of items, by its start on both sides and its length.
+Match = Tuple[int, int, int]
+
+
+class Hunk(NamedTuple):
+    """ Items a[a_start:a_end] replaced by b[b_start:b_end]. Either side may be empty (an insertion or a deletion). """
+    a_start: int
+    a_end: int
+    b_start: int
+    b_end: int
+
+
+class Interner:
+    """ Assigns consecutive integer ids to items, so that sequences of them are compared as arrays of integers. """
+
+    def __init__(self):
+        self._ids: Dict[Hashable, int] = {}
+
+    def ids(self, items: Sequence[Hashable]) -> array:
+        ids = self._ids
+        return array('l', (ids.setdefault(item, len(ids)) for item in items))
+
+
+def diff(a: Sequence[Hashable], b: Sequence[Hashable]) -> List[Hunk]:
+    """ The hunks that turn a into b, in order. """
+    interner = Interner()
+    return diff_ids(interner.ids(a), interner.ids(b))
+
+
+def diff_ids(a: Sequence[int], b: Sequence[int]) -> List[Hunk]:
+    """ The hunks that turn a into b, which are sequences of interned ids (see `Interner`). """
+    hunks = []
+    a_position = b_position = 0
+    for a_start, b_start, length in matches(a, b) + [(len(a), len(b), 0)]:
+        if a_start > a_position or b_start > b_position:
+            hunks.append(Hunk(a_position, a_start, b_position, b_start))
+        a_position, b_position = a_start + length, b_start + length
+    return hunks
+
+
+def matches(a: Sequence[int], b: Sequence[int]) -> List[Match]:
+    """ The common runs of a and b that the diff keeps, in order. """
+    found: List[Match] = []
+    # Regions are processed from a stack rather than recursively, since they can nest as deep as the files are long.
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        a_low, a_high, b_low, b_high = regions.pop()
+        # Common prefixes and suffixes (usually most of the files) are matched without further ado.
+        prefix = 0
+        while a_low + prefix < a_high and b_low + prefix < b_high and a[a_low + prefix] == b[b_low + prefix]:
+            prefix += 1
+        if prefix:
+            found.append((a_low, b_low, prefix))
+            a_low, b_low = a_low + prefix, b_low + prefix
+        suffix = 0
+        while a_low < a_high - suffix and b_low < b_high - suffix and a[a_high - suffix - 1] == b[b_high - suffix - 1]:
+            suffix += 1
+        if suffix:
+            found.append((a_high - suffix, b_high - suffix, suffix))
+            a_high, b_high = a_high - suffix, b_high - suffix
+        if a_low == a_high or b_low == b_high:
+            continue
+        anchor, shared = _anchor(a, b, a_low, a_high, b_low, b_high)
+        if anchor is None:
+            if shared:
+                found.extend(_myers(a, b, a_low, a_high, b_low, b_high))
+            continue
+        a_start, b_start, length = anchor
+        found.append(anchor)
+        regions.append((a_low, a_start, b_low, b_start))
+        regions.append((a_start + length, a_high, b_start + length, b_high))
+    found.sort()
+    return found
+
+
+def _anchor(a: Sequence[int], b: Sequence[int], a_low: int, a_high: int, b_low: int, b_high: int) \
+        -> Tuple[Optional[Match], bool]:
+    """
+    The longest common run around the rarest items shared by both regions (None if all the shared items are too
+    common), and whether the regions share any item at all.
+    """
+    occurrences: Dict[int, List[int]] = {}
+    for i in range(a_low, a_high):
+        occurrences.setdefault(a[i], []).append(i)
+    best = None
+    best_count = MAX_CHAIN_LENGTH + 1
+    shared = False
+    j = b_low
+    while j < b_high:
+        a_positions = occurrences.get(b[j])
+        if a_positions is None:
+            j += 1
+            continue
+        shared = True
+        if len(a_positions) > best_count:
+            j += 1
+            continue
+        next_j = j + 1
+        for i in a_positions:
+            start_i, start_j = i, j
+            while start_i > a_low and start_j > b_low and a[start_i - 1] == b[start_j - 1]:
+                start_i, start_j = start_i - 1, start_j - 1
+            end_i, end_j = i + 1, j + 1
+            while end_i < a_high and end_j < b_high and a[end_i] == b[end_j]:
+                end_i, end_j = end_i + 1, end_j + 1
+            length = end_j - start_j
+            # Rarer anchors win, then longer runs.
+            if best is None or len(a_positions) < best_count or length > best[2]:
+                best = (start_i, start_j, length)
+                best_count = len(a_positions)
+            # Items within this run were already considered as part of it.
+            next_j = max(next_j, end_j)
+        j = next_j
+    return best, shared
+
+
+def _myers(a: Sequence[int], b: Sequence[int], a_low: int, a_high: int, b_low: int, b_high: int) -> List[Match]:
+    """
+    The common runs of a shortest edit script of the regions, found with Myers' greedy algorithm, or none if the script
+    takes more than MAX_MYERS_COST edits (in which case the regions are replaced as a whole).
+    """
+    n, m = a_high - a_low, b_high - b_low
+    offset = n + m + 1
+    furthest = [0] * (2 * offset + 1)
+    trace = []
+    for cost in range(min(n + m, MAX_MYERS_COST) + 1):
+        # Only the diagonals reachable so far are kept, for the trace to grow with the cost rather than the regions.
+        trace.append(furthest[offset - cost:offset + cost + 1])
+        for k in range(-cost, cost + 1, 2):
+            if k == -cost or k != cost and furthest[offset + k - 1] < furthest[offset + k + 1]:
+                x = furthest[offset + k + 1]
+            else:
+                x = furthest[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_low + x] == b[b_low + y]:
+                x, y = x + 1, y + 1
+            furthest[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m, a_low, b_low)
+    return []
+
+
+def _backtrack(trace: List[List[int]], x: int, y: int, a_low: int, b_low: int) -> List[Match]:
+    """
+    Recover the common runs of the edit script whose furthest reaching paths are traced: before each cost, the furthest
+    x of every diagonal k between -cost and cost (at index cost + k).
+    """
+    found = []
+    for cost in range(len(trace) - 1, -1, -1):
+        furthest = trace[cost]
+        offset = cost
+        k = x - y
+        if cost == 0:
+            previous_x = previous_y = 0
+        else:
+            if k == -cost or k != cost and furthest[offset + k - 1] < furthest[offset + k + 1]:
+                previous_k = k + 1
+            else:
+                previous_k = k - 1
+            previous_x = furthest[offset + previous_k]
+            previous_y = previous_x - previous_k
+        # The snake (diagonal run) after the edit that reached this cost.
+        start_x = previous_x if cost == 0 else (previous_x if previous_k == k + 1 else previous_x + 1)
+        start_y = start_x - k
+        if x > start_x:
+            found.append((a_low + start_x, b_low + start_y, x - start_x))
+        x, y = previous_x, previous_y
+    found.reverse()
+    return found
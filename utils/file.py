@@ -21,7 +21,8 @@ def apply_replacements(file_text: Sequence[bytes], replacements: Iterable[Replac
         sorted_replacements = sorted(line_replacements, key=lambda replacement: replacement.from_column)
         delta = 0
         for replacement in sorted_replacements:
-            prev_line = replaced_text[line]
+            # Lines may be views of a content buffer, only the replaced ones are copied.
+            prev_line = bytes(replaced_text[line])
             replaced_text[line] = prev_line[:replacement.from_column + delta] \
                                   + replacement.text.encode('utf-8') \
                                   + prev_line[replacement.to_column + delta:]
@@ -29,10 +30,18 @@ def apply_replacements(file_text: Sequence[bytes], replacements: Iterable[Replac
     return replaced_text
 
 
+def read_blob(blob) -> bytes:
+    """ Read the contents of a blob, through its repository's content store if it has one. """
+    content_store = getattr(blob.repo, 'content_store', None)
+    if content_store is None:
+        return blob.data_stream.read()
+    return content_store.read(blob)
+
+
 @contextmanager
 def file_from_blob(blob):
     with NamedTemporaryFile(suffix=os.path.splitext(blob.path)[-1]) as file:
-        file.write(blob.data_stream.read())
+        file.write(read_blob(blob))
         file.flush()
         yield file
 
@@ -1,35 +1,194 @@
 import json
 import os
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Dict, Any, Sequence, Iterable, Collection, FrozenSet, NamedTuple, \
+    TYPE_CHECKING
+from urllib.parse import quote, unquote
+
+import git
+from git.diff import Diffable
 
 from changes.change import Change
 from changes.changes import change_from_json
 from smart_repo import SmartRepo
+from tracing import span
+
+if TYPE_CHECKING:
+    from detection_budget import DetectionBudget
 
 CHANGES_FILE_NAME = '.changes'
 
+# Marks a change log line that stands for all the entries up to its index (see `change_log.ChangeLog.compact`).
+CHECKPOINT_MARKER = b'#checkpoint'
+# Starts the header of a change log line (see `EntryHeader`).
+HEADER_MARKER = b'@'
+
+
+class EntryHeader(NamedTuple):
+    """
+    The change types and the touched paths of a change log entry, which lead its line (before the changes' JSON) for
+    readers to tell which entries concern them without decoding any. Lines written before headers existed have none.
+    """
+    types: FrozenSet[str]
+    paths: FrozenSet[str]
+
+    @classmethod
+    def of(cls, changes: Iterable[Change]) -> 'EntryHeader':
+        changes = list(changes)
+        return cls(frozenset(change.name() for change in changes),
+                   frozenset(path for change in changes for path in change.touched_paths()))
+
+    def encode(self) -> bytes:
+        # Paths are quoted, so that the header holds no spaces (which end it), commas or colons.
+        return HEADER_MARKER + ','.join(sorted(self.types)).encode('ascii') + b':' \
+            + ','.join(quote(path, safe='/') for path in sorted(self.paths)).encode('ascii')
+
+    @classmethod
+    def decode(cls, header: bytes) -> 'EntryHeader':
+        types, _, paths = header[len(HEADER_MARKER):].decode('ascii').partition(':')
+        return cls(frozenset(types.split(',')) if types else frozenset(),
+                   frozenset(unquote(path) for path in paths.split(',')) if paths else frozenset())
+
+    def touches(self, paths: Collection[str]) -> bool:
+        return not self.paths.isdisjoint(paths)
+
+
+def line_index(line: bytes) -> int:
+    """ The index of the change log entry on a line (for a checkpoint, of the last entry it folds). """
+    return int(line.partition(b' ')[0])
+
+
+def next_index(lines: Sequence[bytes]) -> int:
+    """ The index of the entry that comes after the given change log lines. """
+    return line_index(lines[-1]) + 1 if lines else 0
+
+
+def is_checkpoint(line: bytes) -> bool:
+    return line.partition(b' ')[2].startswith(CHECKPOINT_MARKER)
+
+
+def encode_checkpoint_line(index: int, commit: str) -> bytes:
+    """ A checkpoint for the entries up to the given index, which are those of the given commit's change log. """
+    return f'{index} {CHECKPOINT_MARKER.decode("ascii")} {commit}'.encode('ascii')
+
+
+def line_header(line: bytes) -> Optional[EntryHeader]:
+    """ The header of a change log line, which is empty for checkpoints and None for lines without any. """
+    rest = line.partition(b' ')[2]
+    if rest.startswith(HEADER_MARKER):
+        return EntryHeader.decode(rest.partition(b' ')[0])
+    if rest.startswith(CHECKPOINT_MARKER):
+        return EntryHeader(frozenset(), frozenset())
+    return None
+
 
 def decode_changes_line(repo: SmartRepo, line: bytes) -> Tuple[int, List[Change]]:
+    """ The index and the change set of a change log line, checkpoints having no changes. """
     index, _, changes_json_str = line.partition(b' ')
+    if changes_json_str.startswith(CHECKPOINT_MARKER):
+        return int(index), []
+    if changes_json_str.startswith(HEADER_MARKER):
+        changes_json_str = changes_json_str.partition(b' ')[2]
     return int(index), [change_from_json(repo, change_json) for change_json in json.loads(changes_json_str)]
 
 
 def encode_changes_line(index: int, changes: List[Change]) -> bytes:
-    return f'{index} {json.dumps([change.to_json() for change in changes])}'.encode('utf-8')
+    return encode_changes_json_line(index, [change.to_json() for change in changes], EntryHeader.of(changes))
+
+
+def encode_changes_json_line(index: int, changes_json: List[Dict[str, Any]], header: EntryHeader) -> bytes:
+    """ Encode a line of the change log from changes that were already serialized with `Change.to_json`. """
+    return f'{index} '.encode('ascii') + header.encode() + f' {json.dumps(changes_json)}'.encode('utf-8')
 
 
 def encode_changes(changes: List[List[Change]]) -> List[bytes]:
     return [encode_changes_line(i, changes) + b'\n' for i, changes in enumerate(changes)]
 
 
-def decode_changes(repo: SmartRepo, text: List[bytes]) -> List[List[Change]]:
-    return [decode_changes_line(repo, line.strip())[1] for line in text]
+def decode_changes(repo: SmartRepo, text: List[bytes], paths: Optional[Collection[str]] = None) \
+        -> List[List[Change]]:
+    """
+    Decode change log lines, skipping checkpoints.
+
+    :param paths: If given, only the change sets that touch any of these paths are decoded (and returned), lines whose
+                  header says otherwise are skipped.
+    """
+    change_sets = []
+    for line in text:
+        if is_checkpoint(line):
+            continue
+        header = line_header(line)
+        if paths is not None and header is not None and not header.touches(paths):
+            continue
+        changes = decode_changes_line(repo, line.strip())[1]
+        # Lines without a header can only be told apart once decoded.
+        if paths is not None and header is None and not EntryHeader.of(changes).touches(paths):
+            continue
+        change_sets.append(changes)
+    return change_sets
+
+
+def detect_changes(repo: SmartRepo, from_tree: git.Tree, to_tree: Optional[git.Tree]=None,
+                   budget: Optional['DetectionBudget']=None) -> List[Change]:
+    """
+    Detect the changes that turn one tree into another.
+
+    Starting with the first tree, changes are detected and applied to it until it matches the second tree. Changes to
+    the .changes file itself are ignored.
+    :param repo: The repository both trees belong to.
+    :param from_tree: The tree before the changes.
+    :param to_tree: The tree after the changes, or None to use the index (which is what pre-commit does).
+    :param budget: The limits of the clang-based detectors (by default, a new budget as configured for the repository).
+    Files beyond the limits are recorded in its fallbacks.
+    :return: The detected changes, in the order they were detected.
+    """
+    from changes import CHANGE_CLASSES
+    from detection_budget import DetectionBudget
+    from repo_state import TreeBackedRepoState
+
+    changes = []
+    state = TreeBackedRepoState(repo, from_tree)
+    with repo.overlay_odb() as odb, (budget or DetectionBudget(repo)).active():
+        while True:
+            # git diffs the state against the other tree, so the state's tree (but none of the intermediate objects
+            # written while applying changes) has to be on disk.
+            with span('persist'):
+                odb.persist(state.tree.binsha)
+            with span('git diff'):
+                diff = git.DiffIndex(file_diff for file_diff in state.tree.diff(Diffable.Index if to_tree is None
+                                                                                else to_tree)
+                                     if CHANGES_FILE_NAME not in (file_diff.a_path, file_diff.b_path))
+            if not diff:
+                break
+            repo.content_store.prefetch(diff)
+            for change_class in CHANGE_CLASSES:
+                with span('detect', change_type=change_class.name()):
+                    new_changes: List[Change] = list(change_class.detect(repo, diff))
+                if new_changes:
+                    changes.extend(new_changes)
+                    applied_changes = []
+                    while new_changes:
+                        change = new_changes.pop()
+                        with span('transform', change_type=change.name(), paths=change.touched_paths()):
+                            for applied_change in applied_changes:
+                                change = change.transform(repo, applied_change)
+                                if change is None:
+                                    break
+                        if change is not None:
+                            with span('apply', change_type=change.name(), paths=change.touched_paths()):
+                                change.apply(repo, state)
+                            applied_changes.append(change)
+                    break
+    return changes
+
 
+def get_changes(repo: SmartRepo, revision: str='HEAD', paths: Optional[Collection[str]]=None) -> List[List[Change]]:
+    """
+    The change log of a revision, from the repository's change log backend (see `change_log`).
 
-def get_changes(repo: SmartRepo, revision: str='HEAD') -> List[List[Change]]:
-    changes_file_contents = repo.contents(CHANGES_FILE_NAME, revision)
-    if changes_file_contents is None:
-        return []
-    return decode_changes(repo, changes_file_contents)
+    Only the entries after the revision's latest checkpoint are read, those it folds are left out.
+    :param paths: If given, only the change sets that touch any of these paths.
+    """
+    from change_log import change_log
+    return decode_changes(repo, list(change_log(repo).lines(revision)), paths)
 
 
@@ -0,0 +1,104 @@
+import zlib
+from typing import Dict, List, Sequence, Tuple, Iterable, FrozenSet
+
+# Consecutive lines hashed together into each shingle.
+SHINGLE_LINES = 2
+# MinHash signature size, and how it is split into LSH bands: files sharing all the values of any band are compared.
+# 16 bands of 2 values find pairs above a similarity of about (1 / 16) ** (1 / 2) = 0.25 with high probability.
+SIGNATURE_SIZE = 32
+BAND_SIZE = 2
+
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+# Odd multipliers (from FNV and Fibonacci hashing) to combine and scramble line hashes with.
+_COMBINE = 0x100000001B3
+_SCRAMBLE = 0x9E3779B97F4A7C15
+
+
+def _shingle(line_hashes: Sequence[int]) -> int:
+    combined = 0
+    for line_hash in line_hashes:
+        combined = (combined * _COMBINE ^ line_hash) & _HASH_MASK
+    return combined * _SCRAMBLE & _HASH_MASK
+
+
+def shingles(lines: Sequence[bytes]) -> FrozenSet[int]:
+    """
+    The hashes of every SHINGLE_LINES consecutive lines (ignoring surrounding whitespace) of a file.
+
+    The hashes are deterministic (unlike `hash`), so that the same files are always paired the same way.
+    """
+    hashes = [zlib.crc32(line.strip()) for line in lines]
+    if len(hashes) < SHINGLE_LINES:
+        return frozenset([_shingle(hashes)]) if hashes else frozenset()
+    return frozenset(_shingle(hashes[i:i + SHINGLE_LINES]) for i in range(len(hashes) - SHINGLE_LINES + 1))
+
+
+def signature(shingle_hashes: Iterable[int]) -> Tuple[int, ...]:
+    """
+    The MinHash signature of a set of shingles, with one-permutation hashing: the hash space is split into
+    SIGNATURE_SIZE bins and each bin keeps its minimal hash, so the signature takes a single pass to compute. Empty bins
+    borrow the value of the next non-empty one (densification), so that small files still get full signatures.
+    """
+    bins = [None] * SIGNATURE_SIZE
+    for shingle_hash in shingle_hashes:
+        # The top bits of the (scrambled) hashes are the best mixed.
+        index = shingle_hash * SIGNATURE_SIZE >> _HASH_BITS
+        if bins[index] is None or shingle_hash < bins[index]:
+            bins[index] = shingle_hash
+    if all(value is None for value in bins):
+        return ()
+    for i in range(SIGNATURE_SIZE):
+        offset = 1
+        while bins[i] is None:
+            # The offset is mixed in, so that bins borrowing from the same bin don't all match each other.
+            borrowed = bins[(i + offset) % SIGNATURE_SIZE]
+            if borrowed is not None:
+                bins[i] = hash((borrowed, offset))
+            offset += 1
+    return tuple(bins)
+
+
+def jaccard(a: FrozenSet[int], b: FrozenSet[int]) -> float:
+    return len(a & b) / len(a | b)
+
+
+def pair_similar(before: Dict[str, Sequence[bytes]], after: Dict[str, Sequence[bytes]], threshold: float) \
+        -> List[Tuple[str, str, float]]:
+    """
+    Pair files that disappeared with files that appeared, by the similarity of their contents.
+
+    Candidates are found with locality sensitive hashing over MinHash signatures, so the work grows with the number of
+    files (and similar pairs) rather than with every (before, after) combination. Candidates are then scored by the exact
+    Jaccard similarity of their shingles, and paired greedily from the most similar. Empty files are never paired.
+    :param before: the contents (as lines) of the files that disappeared, by path.
+    :param after: the contents (as lines) of the files that appeared, by path.
+    :param threshold: the minimal similarity (between 0 and 1) of a pair.
+    :return: (before path, after path, similarity) for every pair, from the most similar.
+    """
+    before_shingles = {path: shingles(lines) for path, lines in before.items()}
+    after_shingles = {path: shingles(lines) for path, lines in after.items()}
+    buckets: Dict[Tuple[int, Tuple[int, ...]], List[str]] = {}
+    for path, path_shingles in before_shingles.items():
+        path_signature = signature(path_shingles)
+        for band in range(0, len(path_signature), BAND_SIZE):
+            buckets.setdefault((band, path_signature[band:band + BAND_SIZE]), []).append(path)
+    candidates = set()
+    for path, path_shingles in after_shingles.items():
+        path_signature = signature(path_shingles)
+        for band in range(0, len(path_signature), BAND_SIZE):
+            for before_path in buckets.get((band, path_signature[band:band + BAND_SIZE]), ()):
+                candidates.add((before_path, path))
+    scored = sorted(((jaccard(before_shingles[before_path], after_shingles[after_path]), before_path, after_path)
+                     for before_path, after_path in candidates), key=lambda score: (-score[0], score[1], score[2]))
+    pairs = []
+    paired_before, paired_after = set(), set()
+    for similarity, before_path, after_path in scored:
+        if similarity < threshold:
+            break
+        if before_path in paired_before or after_path in paired_after:
+            continue
+        paired_before.add(before_path)
+        paired_after.add(after_path)
+        pairs.append((before_path, after_path, similarity))
+    return pairs
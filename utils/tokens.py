@@ -0,0 +1,113 @@
+from array import array
+from bisect import bisect_left
+from ctypes import POINTER, byref, c_size_t, c_uint, c_void_p, sizeof, string_at
+from typing import Dict, Optional, Tuple, Iterable
+
+from clang.cindex import Cursor, TranslationUnit, Token, SourceLocation, conf
+
+from smart_repo import derived_indexes
+
+# Ids of token spellings, shared by all token tables so that tables of different translation units can be compared.
+_spelling_ids: Dict[bytes, int] = {}
+
+
+def _arrays(tokens: Iterable[Token]) -> Tuple[array, array]:
+    kinds = array('B')
+    spellings = array('L')
+    for token in tokens:
+        kinds.append(token.kind.value)
+        spellings.append(_spelling_ids.setdefault(token.spelling.encode('utf-8'), len(_spelling_ids)))
+    return kinds, spellings
+
+
+def _file_contents(translation_unit: TranslationUnit, file) -> Optional[bytes]:
+    """ The contents of a file of the translation unit as clang sees them, if libclang can tell (since clang 6). """
+    get_file_contents = getattr(conf.lib, 'clang_getFileContents', None)
+    if get_file_contents is None:
+        return None
+    get_file_contents.argtypes = [TranslationUnit, c_void_p, POINTER(c_size_t)]
+    get_file_contents.restype = c_void_p
+    size = c_size_t()
+    contents = get_file_contents(translation_unit, file, byref(size))
+    return None if contents is None else string_at(contents, size.value)
+
+
+class TokenTable:
+    """
+    The tokens of the main file of a translation unit, tokenized once into parallel arrays: the kind, the spelling id,
+    and the start and end offsets of each token.
+
+    The tokens of a cursor are then a slice of the arrays, found by the offsets of its extent, and comparing the tokens
+    of two cursors is comparing two slices - instead of a round-trip to libclang (and a Python object) per token.
+    """
+
+    def __init__(self, translation_unit: TranslationUnit):
+        self.file_name = translation_unit.spelling
+        file = translation_unit.get_file(self.file_name)
+        contents = _file_contents(translation_unit, file)
+        # The raw encodings of the file's locations (see below), which map cursor extents to offsets - empty if unknown.
+        self._locations = range(0)
+        if contents is None:
+            tokens = list(translation_unit.get_tokens(extent=translation_unit.cursor.extent))
+            self.kinds, self.spellings = _arrays(tokens)
+            self.starts = array('L', (token.extent.start.offset for token in tokens))
+            self.ends = array('L', (token.extent.end.offset for token in tokens))
+            return
+        # Going through Token objects costs several libclang calls per token, so the CXToken array is read directly
+        # instead: each token holds its kind, the raw encoding of its location (the file's base location plus its
+        # offset) and its length, and its spelling is sliced from the file's contents.
+        tokens = POINTER(Token)()
+        count = c_uint()
+        conf.lib.clang_tokenize(translation_unit, translation_unit.cursor.extent, byref(tokens), byref(count))
+        try:
+            fields = array('I', string_at(tokens, sizeof(Token) * count.value))
+        finally:
+            conf.lib.clang_disposeTokens(translation_unit, tokens, count)
+        stride = sizeof(Token) // fields.itemsize
+        base = SourceLocation.from_offset(translation_unit, file, 0).int_data
+        self._locations = range(base, base + len(contents) + 1)
+        self.kinds = array('B', fields[0::stride])
+        self.starts = array('L', (location - base for location in fields[1::stride]))
+        self.ends = array('L', (start + length for start, length in zip(self.starts, fields[2::stride])))
+        self.spellings = array('L', (_spelling_ids.setdefault(contents[start:end], len(_spelling_ids))
+                                     for start, end in zip(self.starts, self.ends)))
+
+    @classmethod
+    def of(cls, translation_unit: TranslationUnit) -> 'TokenTable':
+        """ The token table of the given translation unit, built once (until it is reparsed). """
+        indexes = derived_indexes(translation_unit)
+        if 'tokens' not in indexes:
+            indexes['tokens'] = cls(translation_unit)
+        return indexes['tokens']
+
+    def span(self, cursor: Cursor) -> Optional[Tuple[int, int]]:
+        """ The range of indices of the tokens within the cursor's extent, or None if it is outside the main file. """
+        extent = cursor.extent
+        if extent.begin_int_data in self._locations and extent.end_int_data in self._locations:
+            # Both ends are in the file (and not in macro expansions), so their offsets are known without asking clang.
+            base = self._locations.start
+            return (bisect_left(self.starts, extent.begin_int_data - base),
+                    bisect_left(self.starts, extent.end_int_data - base))
+        if extent.start.file is None or extent.start.file.name != self.file_name:
+            return None
+        return bisect_left(self.starts, extent.start.offset), bisect_left(self.starts, extent.end.offset)
+
+    def tokens(self, cursor: Cursor) -> Tuple[array, array]:
+        """ The kinds and spelling ids of the cursor's tokens. """
+        span = self.span(cursor)
+        if span is None:
+            # Cursors from other (e.g. included) files are tokenized on their own.
+            return _arrays(cursor.get_tokens())
+        start, end = span
+        return self.kinds[start:end], self.spellings[start:end]
+
+    def key(self, cursor: Cursor) -> bytes:
+        """ A key that two cursors (of any translation units) share exactly if their tokens are the same. """
+        kinds, spellings = self.tokens(cursor)
+        return kinds.tobytes() + spellings.tobytes()
+
+    def equal(self, cursor: Cursor, other_table: 'TokenTable', other_cursor: Cursor) -> bool:
+        """ Whether the tokens of a cursor of this table are the same as those of a cursor of the other table. """
+        kinds, spellings = self.tokens(cursor)
+        other_kinds, other_spellings = other_table.tokens(other_cursor)
+        return spellings == other_spellings and kinds == other_kinds
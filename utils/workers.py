@@ -0,0 +1,40 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List, Optional, TypeVar
+
+from smart_repo import SmartRepo
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# The repository of a worker process, opened once by the pool's initializer.
+_worker_repo: Optional[SmartRepo] = None
+
+
+def _init_worker(repo_path: str) -> None:
+    global _worker_repo
+    _worker_repo = SmartRepo(repo_path)
+
+
+def _call_in_worker(function: Callable[[SmartRepo, T], R], item: T) -> R:
+    return function(_worker_repo, item)
+
+
+def map_in_workers(repo: SmartRepo, function: Callable[[SmartRepo, T], R], items: Iterable[T], jobs: int) -> List[R]:
+    """
+    Call function(repo, item) for every item, spread across worker processes.
+
+    Each worker opens the repository (and libclang) once. Workers are spawned rather than forked, so that they don't
+    share git subprocesses with this process. With a single job (or item), everything runs in this process instead.
+    :param repo: The repository to operate on.
+    :param function: A module-level function (so that it can be sent to the workers).
+    :param items: The arguments to call the function with, which must be picklable, as must the results.
+    :param jobs: The maximal number of worker processes.
+    :return: The results, in the order of the items.
+    """
+    items = list(items)
+    if jobs == 1 or len(items) <= 1:
+        return [function(repo, item) for item in items]
+    with ProcessPoolExecutor(max_workers=min(jobs, len(items)), mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(repo.working_dir, )) as executor:
+        return list(executor.map(_call_in_worker, [function] * len(items), items))